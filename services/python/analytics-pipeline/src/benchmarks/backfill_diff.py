@@ -0,0 +1,91 @@
+# Python 3.7.1
+
+# python backfill_diff.py \
+#   --n=10000000 \
+#   --ingested-ratio=0.9
+
+# Compares the diff strategies of ../dataflow/p1_gcs_to_bq_backfill.py, which subtract the files already ingested
+# (the BigQuery list) from the files in GCS, outside of Beam:
+# - cogroup: both lists are shuffled, keyed by gspath, & grouped;
+# - broadcast: the exact set of the batch ids of the BigQuery list is broadcast & every file in GCS is probed against it.
+#   Only the accumulators of the set (16 bytes per batch id) are shuffled, at the cost of broadcasting the set to every worker.
+# The bytes shuffled are estimated from the pickled (key, value) tuples, the way Beam encodes them by default.
+
+from collections import defaultdict
+import argparse
+import hashlib
+import pickle
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataflow'))
+
+from common.digests import SortedDigestSet
+from common.gspath import encode_gspath
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n', type=int, default=10000000)  # Number of files in GCS.
+parser.add_argument('--ingested-ratio', dest='ingested_ratio', type=float, default=0.9)
+parser.add_argument('--seed', type=int, default=42)
+
+
+def generate_gspaths(n):
+    for i in range(n):
+        yield encode_gspath('project-analytics', 'jsonl', 'improbable', 'external', 'release', f'2019-{1 + i % 12:02d}-{1 + i % 28:02d}',
+                            ['00-08', '08-16', '16-24'][i % 3], f'{hashlib.md5(str(i // 50).encode("utf-8")).hexdigest()}/2019-01-01T00:00:00Z-{i:07d}.jsonl')
+
+
+def shuffle_bytes(pairs):
+    return sum(len(pickle.dumps(pair, protocol=2)) for pair in pairs)
+
+
+def diff_cogroup(gcs_list, bq_list):
+    groups = defaultdict(lambda: [0, 0])
+    for gspath in gcs_list:
+        groups[gspath][0] += 1
+    for gspath in bq_list:
+        groups[gspath][1] += 1
+    return [gspath for gspath, (in_gcs, in_bq) in groups.items() if in_gcs == 1 and in_bq == 0]
+
+
+def diff_broadcast(gcs_list, bq_batch_id_list):
+    batch_id_set = SortedDigestSet(b''.join(bytes.fromhex(batch_id) for batch_id in bq_batch_id_list))
+    missing = [gspath for gspath in gcs_list if bytes.fromhex(hashlib.md5(gspath.encode('utf-8')).hexdigest()) not in batch_id_set]
+    return missing, batch_id_set
+
+
+def run(args):
+    random.seed(args.seed)
+    gcs_list = list(generate_gspaths(args.n))
+    bq_list = [gspath for gspath in gcs_list if random.random() < args.ingested_ratio]
+    # Sample the pickled size of shuffled tuples rather than pickling all of them:
+    sample = max(1, args.n // 100000)
+    print(f'Files in GCS: {len(gcs_list):,} | already ingested: {len(bq_list):,}')
+
+    start = time.perf_counter()
+    cogroup_result = diff_cogroup(gcs_list, bq_list)
+    cogroup_seconds = time.perf_counter() - start
+    cogroup_shuffle = (shuffle_bytes((gspath, 1) for gspath in gcs_list[::sample]) + shuffle_bytes((gspath, 1) for gspath in bq_list[::sample])) * sample
+
+    start = time.perf_counter()
+    bq_batch_id_list = [hashlib.md5(gspath.encode('utf-8')).hexdigest() for gspath in bq_list]
+    broadcast_result, batch_id_set = diff_broadcast(gcs_list, bq_batch_id_list)
+    broadcast_seconds = time.perf_counter() - start
+    # The set is combined from partial accumulators of concatenated digests, so about 16 bytes are shuffled per batch id:
+    broadcast_shuffle = len(batch_id_set.data)
+    broadcast_size = len(pickle.dumps(batch_id_set, protocol=2))
+
+    if sorted(cogroup_result) != sorted(broadcast_result):
+        raise Exception('The diff strategies disagree!')
+
+    print(f'Files to backfill: {len(cogroup_result):,} (both strategies agree)')
+    print(f'cogroup:   {cogroup_seconds:.1f}s | shuffled: {cogroup_shuffle / 1024 ** 2:,.0f} MiB ({len(gcs_list) + len(bq_list):,} elements)')
+    print(f'broadcast: {broadcast_seconds:.1f}s | shuffled: {broadcast_shuffle / 1024 ** 2:,.0f} MiB ({len(bq_list):,} digests) | '
+          f'broadcast: {broadcast_size / 1024 ** 2:,.1f} MiB per worker')
+    print(f'Shuffle reduction: {1 - broadcast_shuffle / cogroup_shuffle:.0%}')
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
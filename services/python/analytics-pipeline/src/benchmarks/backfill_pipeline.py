@@ -0,0 +1,155 @@
+# Python 3.7.1
+
+# python backfill_pipeline.py \
+#   --partitions=90 \
+#   --sessions-per-partition=20 \
+#   --files-per-session=5 \
+#   --ingested-ratio=0.9 \
+#   --backfill-mode=pubsub \
+#   --diff-strategy=cogroup
+
+# Runs the pipeline of ../dataflow/p1_gcs_to_bq_backfill.py on the DirectRunner without a project: files are listed
+# & read from a local directory laid out like the bucket, the files already ingested are read from memory instead of
+# BigQuery, and rows are counted instead of loaded & messages instead of published (see ../dataflow/common/fakes.py).
+# It generates --partitions (event_ds, event_time) partitions of synthetic event batch files, of which --ingested-ratio
+# is marked as ingested, and reports the element count of every stage alongside the wall-clock throughput.
+
+import functools
+import argparse
+import datetime
+import tempfile
+import hashlib
+import random
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataflow'))
+
+from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.metrics import Metrics
+import apache_beam as beam
+
+from common.fakes import FakeGcsIO, FakePublisherClient
+from common.functions import generate_gcs_file_list
+from common.gspath import encode_gspath, get_batch_id
+from common.gcs import prune_gcs_prefix_list
+from common.metrics import Metrics as PipelineMetrics, collect_beam_metrics
+from function_startup import generate_file
+import p1_gcs_to_bq_backfill as backfill
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--partitions', type=int, default=90)  # Number of (event_ds, event_time) partitions, 3 per day.
+parser.add_argument('--sessions-per-partition', dest='sessions_per_partition', type=int, default=20)
+parser.add_argument('--files-per-session', dest='files_per_session', type=int, default=5)
+parser.add_argument('--events-per-file', dest='events_per_file', type=int, default=10)
+parser.add_argument('--ingested-ratio', dest='ingested_ratio', type=float, default=0.9)
+parser.add_argument('--event-schema', dest='event_schema', default='improbable', choices=['improbable', 'playfab'])
+parser.add_argument('--backfill-mode', dest='backfill_mode', default='pubsub', choices=['pubsub', 'dataflow'])
+parser.add_argument('--diff-strategy', dest='diff_strategy', default='cogroup', choices=['cogroup', 'broadcast'])
+parser.add_argument('--latency', type=float, default=0.0)  # Seconds added to each fake GCS listing request.
+parser.add_argument('--publish-fail-rate', dest='publish_fail_rate', type=float, default=0.0)
+parser.add_argument('--root', default=None)  # Directory to generate the bucket in, a temporary one is removed afterwards.
+parser.add_argument('--seed', type=int, default=42)
+
+bucket_name = 'project-analytics'
+
+
+class CountElements(beam.DoFn):
+
+    """ Counts the elements of the PCollection it is applied to, under the label of its step.
+    """
+
+    def __init__(self):
+        super(CountElements, self).__init__()
+        self.elements = Metrics.counter(self.__class__, 'elements')
+
+    def process(self, element):
+        self.elements.inc()
+
+
+def count_table_rows(project, dataset, table, **kwargs):
+
+    """ Stands in for p1_gcs_to_bq_backfill.write_bigquery_table(), counting rows instead of loading them.
+    """
+
+    return beam.ParDo(CountElements())
+
+
+def generate_bucket(gcs, args, event_ds_start):
+
+    """ Writes the synthetic event batch files into the fake bucket, returning their gspaths.
+    """
+
+    gspath_list, time_part_list = [], ['00-08', '08-16', '16-24']
+    for partition in range(args.partitions):
+        event_ds = event_ds_start + datetime.timedelta(days=partition // len(time_part_list))
+        for session in range(args.sessions_per_partition):
+            session_id = hashlib.md5(f'{partition}/{session}'.encode('utf-8')).hexdigest()
+            for index in range(args.files_per_session):
+                gspath = encode_gspath(bucket_name, 'jsonl', args.event_schema, 'external', 'release', event_ds, time_part_list[partition % len(time_part_list)],
+                                       f'{session_id}/{event_ds}T00:00:00Z-{index:05d}')
+                gcs.write(gspath, generate_file(args.event_schema, args.events_per_file, get_batch_id(gspath)))
+                gspath_list.append(gspath)
+    return gspath_list
+
+
+def run(args):
+    random.seed(args.seed)
+    root = args.root or tempfile.mkdtemp(prefix='backfill-pipeline-')
+    try:
+        gcs, event_ds_start = FakeGcsIO(root), datetime.date(2019, 1, 1)
+        start = time.perf_counter()
+        gspath_list = generate_bucket(gcs, args, event_ds_start)
+        ingested_rows = [{'gspath': gspath} for gspath in gspath_list if random.random() < args.ingested_ratio]
+        event_ds_stop = event_ds_start + datetime.timedelta(days=max(args.partitions - 1, 0) // 3)
+        print(f'Generated {len(gspath_list):,} files in {args.partitions:,} partitions ({time.perf_counter() - start:.1f}s) | '
+              f'already ingested: {len(ingested_rows):,}')
+
+        backfill_args = backfill.parse_arguments([
+            '--execution-environment=DirectRunner', '--gcp-region=local', '--environment=testing', '--location=EU', '--gcp=local',
+            '--topic=backfill', f'--bucket-name={bucket_name}', f'--event-schema={args.event_schema}', '--event-environment=release',
+            '--event-category=external', f'--event-ds-start={event_ds_start}', f'--event-ds-stop={event_ds_stop}', '--event-time=all',
+            f'--backfill-mode={args.backfill_mode}', f'--diff-strategy={args.diff_strategy}'])
+
+        start = time.perf_counter()
+        gcs_prefix_list = prune_gcs_prefix_list(FakeGcsIO(root, args.latency).client, generate_gcs_file_list(
+            bucket_name, args.event_schema, 'release', backfill_args.category_list, backfill_args.event_ds_start, backfill_args.event_ds_stop,
+            backfill_args.time_part_list, backfill_args.scale_test_name))
+        prune_seconds = time.perf_counter() - start
+
+        p1 = beam.Pipeline(options=PipelineOptions.from_dictionary({'runner': 'DirectRunner'}))
+        pcollections = backfill.build_pipeline(
+            p1, backfill_args, 'p1-gcs-to-bq-backfill-benchmark', gcs_prefix_list, beam.Create(ingested_rows), write_table=count_table_rows,
+            gcsio_factory=functools.partial(FakeGcsIO, root, args.latency), publisher_factory=functools.partial(FakePublisherClient, args.publish_fail_rate))
+        for name, pcollection in pcollections.items():
+            pcollection | f'Count_{name}' >> beam.ParDo(CountElements())
+
+        start = time.perf_counter()
+        result = p1.run()
+        result.wait_until_finish()
+        pipeline_seconds = time.perf_counter() - start
+
+        metrics = collect_beam_metrics(result, PipelineMetrics(namespace='analytics_backfill'))
+        element_counts = {dict(labels)['step']: value for (name, labels), value in metrics.counters.items() if name == 'elements'}
+        print(f'Pruned {len(gcs_prefix_list):,} partition prefixes in {prune_seconds:.2f}s, ran the pipeline in {pipeline_seconds:.1f}s '
+              f'({len(gspath_list) / pipeline_seconds:,.0f} files/s)')
+        for name in pcollections:
+            elements = element_counts.get(f'Count_{name}', 0)
+            print(f'{name:<16} {elements:>12,} elements {elements / pipeline_seconds:>12,.0f}/s')
+        for step, elements in sorted(element_counts.items()):
+            if not step.startswith('Count_'):
+                print(f'{step:<16} {elements:>12,} rows written')
+
+        expected = len(gspath_list) - len(ingested_rows)
+        if element_counts.get('Count_parse_list', 0) != expected:
+            raise Exception(f"Expected {expected:,} files to backfill, got {element_counts.get('Count_parse_list', 0):,}!")
+        print(metrics.render_prometheus())
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
@@ -0,0 +1,121 @@
+# Python 3.7.1
+
+# python function_startup.py \
+#   --schemas=improbable,playfab \
+#   --latency=0.05 \
+#   --warm-invocations=10 \
+#   --import-budget-ms=150 \
+#   --first-invocation-budget-ms=1000
+
+# Measures the cold start of the Cloud Functions in ../functions/*/main.py against local fakes of
+# GCS & BigQuery (see ../dataflow/common/fakes.py). Each schema is measured in a fresh interpreter,
+# so the import time reported is the one a new Cloud Function instance pays before handling anything.
+
+from statistics import median
+import subprocess
+import argparse
+import base64
+import json
+import time
+import sys
+import os
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATAFLOW_DIR = os.path.join(SRC_DIR, 'dataflow')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--schemas', default='improbable,playfab')
+parser.add_argument('--latency', type=float, default=0.0)  # Seconds added to each fake API request.
+parser.add_argument('--events-per-file', dest='events_per_file', type=int, default=100)
+parser.add_argument('--warm-invocations', dest='warm_invocations', type=int, default=10)
+parser.add_argument('--import-budget-ms', dest='import_budget_ms', type=float, default=None)
+parser.add_argument('--first-invocation-budget-ms', dest='first_invocation_budget_ms', type=float, default=None)
+parser.add_argument('--child', default=None)  # Internal: measure a single schema in this process.
+
+sample_events = {
+    'improbable': {'eventSource': 'client', 'eventClass': 'session', 'eventType': 'session_start', 'eventTimestamp': 1562599755,
+                   'eventIndex': 6, 'sessionId': 'f58179a375290599dde17f7c6d546d78', 'versionId': '2.0.13', 'eventEnvironment': 'debug',
+                   'receivedTimestamp': 1562599756, 'analyticsEnvironment': 'testing', 'eventAttributes': '{"playerId": 12345678}'},
+    'playfab': {'TitleId': 'A1B2', 'Timestamp': '2019-07-08T15:29:15.1234567Z', 'SourceType': 'BackEnd', 'Source': 'PlayFab',
+                'PlayFabEnvironment': 'Production', 'EventNamespace': 'com.playfab', 'EventName': 'player_logged_in',
+                'EntityType': 'player', 'EntityId': '12345678', 'ReceivedTimestamp': 1562599756, 'AnalyticsEnvironment': 'testing',
+                'EventAttributes': '{"Platform": "Custom"}'}
+}
+
+
+def generate_file(schema, n, batch_id):
+    events = []
+    for index in range(n):
+        event = dict(sample_events[schema])
+        if schema == 'improbable':
+            event.update({'batchId': batch_id, 'eventId': f'{batch_id}/{index}', 'eventIndex': index})
+        else:
+            event.update({'BatchId': batch_id, 'EventId': f'{batch_id}{index}'})
+        events.append(json.dumps(event))
+    return '\n'.join(events)
+
+
+def measure(schema, latency, events_per_file, warm_invocations):
+
+    """ Imports the Cloud Function of schema, injects fakes & invokes it. Must run in a fresh
+    interpreter for the import time to be meaningful.
+    """
+
+    import importlib.util
+    sys.path.insert(0, DATAFLOW_DIR)
+    os.environ.update({'ENVIRONMENT': 'benchmark', 'FUNCTION_NAME': f'function-{schema}-benchmark', 'LOCATION': 'EU',
+                       'CHECKPOINT_STORE': 'local', 'CHECKPOINT_DIR': f'/tmp/checkpoints-benchmark-{os.getpid()}'})
+
+    start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location(f'function_{schema}', os.path.join(SRC_DIR, 'functions', schema, 'main.py'))
+    function = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(function)
+    import_ms = (time.perf_counter() - start) * 1000
+    google_cloud_imported = 'google.cloud' in sys.modules
+
+    from common.fakes import FakeStorageClient, FakeBigQueryClient
+    from common.gspath import encode_object_location
+    function.client_gcs, function.client_bq = FakeStorageClient(latency), FakeBigQueryClient(latency)
+
+    def invoke(index):
+        object_location = encode_object_location('jsonl', schema, 'native', 'debug', '2019-07-08', '08-16', f'benchmark/{index}.jsonl')
+        function.client_gcs.bucket('benchmark').blob(object_location).upload_from_string(generate_file(schema, events_per_file, str(index)))
+        data = {'data': base64.b64encode(json.dumps({'bucket': 'benchmark', 'name': object_location}).encode('utf-8'))}
+        start = time.perf_counter()
+        function.ingest_into_native_bigquery_storage(data, None)
+        return (time.perf_counter() - start) * 1000
+
+    first_invocation_ms = invoke(0)
+    warm_ms = [invoke(index) for index in range(1, warm_invocations + 1)]
+    return {'schema': schema, 'import_ms': import_ms, 'google_cloud_imported_at_import': google_cloud_imported,
+            'first_invocation_ms': first_invocation_ms, 'warm_invocation_median_ms': median(warm_ms) if warm_ms else None}
+
+
+def run(args):
+    results = []
+    for schema in args.schemas.split(','):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), f'--child={schema}', f'--latency={args.latency}',
+                                          f'--events-per-file={args.events_per_file}', f'--warm-invocations={args.warm_invocations}'])
+        results.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+
+    within_budget = True
+    for result in results:
+        print(f"[{result['schema']}] Import: {result['import_ms']:.1f}ms "
+              f"(google-cloud imported: {result['google_cloud_imported_at_import']}) | "
+              f"First invocation: {result['first_invocation_ms']:.1f}ms | "
+              f"Warm invocation (median): {result['warm_invocation_median_ms'] or 0:.1f}ms")
+        if args.import_budget_ms is not None and result['import_ms'] > args.import_budget_ms:
+            print(f"[{result['schema']}] Import time exceeds budget of {args.import_budget_ms}ms!")
+            within_budget = False
+        if args.first_invocation_budget_ms is not None and result['first_invocation_ms'] > args.first_invocation_budget_ms:
+            print(f"[{result['schema']}] First invocation exceeds budget of {args.first_invocation_budget_ms}ms!")
+            within_budget = False
+    return within_budget
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure(args.child, args.latency, args.events_per_file, args.warm_invocations)))
+    else:
+        sys.exit(0 if run(args) else 1)
@@ -0,0 +1,245 @@
+# Python 3.7.1
+
+# python pipeline_e2e.py \
+#   --requests=2000 \
+#   --events-per-request=50 \
+#   --mix=improbable:60,playfab:20,malformed:10,large:10 \
+#   --latency=0.0 \
+#   --drain-every=1 \
+#   --output=pipeline-e2e.json
+
+# Replays generated traffic through the whole ingestion path on a single machine, without a project, bucket or API key:
+# requests are POST'ed to `/v1/event` of the endpoint (../endpoint/main.py, through Flask's test client), which writes objects
+# into a fake bucket (see ../dataflow/common/fakes.py). Objects matching the bucket notifications of the Cloud Functions (see
+# ../../../../terraform/module-analytics/pubsub.tf) are queued as Pub/Sub messages, which are delivered to the function of their
+# schema (../functions/*/main.py) every --drain-every requests. The functions in turn insert rows into a fake BigQuery.
+
+# Reports the events ingested per second end-to-end, percentiles of the latency of the endpoint, the functions & of a request
+# until its rows are inserted, and the CPU time spent per component. Endpoint settings such as EVENT_ATTRIBUTES_ENCODING or
+# EVENT_SAMPLING_RULES_FILE are taken from the environment, so the effect of a change can be measured before deploying it.
+# Rows of events the endpoint sampled are checked to carry the rate & rule they were sampled at in their own columns.
+# Requires the requirements of the endpoint & the functions (see ../requirements).
+
+from collections import deque, defaultdict
+from six.moves import urllib
+from unittest import mock
+import importlib.util
+import contextlib
+import argparse
+import tempfile
+import random
+import base64
+import json
+import time
+import sys
+import os
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--requests', type=int, default=2000)
+parser.add_argument('--events-per-request', dest='events_per_request', type=int, default=50)
+parser.add_argument('--mix', default='improbable:60,playfab:20,malformed:10,large:10')  # {improbable|playfab|malformed|large}:weight,..
+parser.add_argument('--large-attribute-bytes', dest='large_attribute_bytes', type=int, default=16384)
+parser.add_argument('--sessions', type=int, default=500)
+parser.add_argument('--latency', type=float, default=0.0)  # Seconds added to each fake API request.
+parser.add_argument('--drain-every', dest='drain_every', type=int, default=1)  # Requests after which queued notifications are delivered.
+parser.add_argument('--output', default=None)  # Optionally write the results as JSON.
+parser.add_argument('--seed', type=int, default=42)
+
+bucket_name = 'benchmark-analytics'
+traffic_kinds = ['improbable', 'playfab', 'malformed', 'large']
+
+
+def parse_mix(mix):
+
+    """ This function parses --mix into a list of kinds of traffic & a list of their weights.
+    """
+
+    kind_list, weight_list = [], []
+    for part in mix.split(','):
+        kind, _, weight = part.partition(':')
+        if kind not in traffic_kinds:
+            raise Exception(f"Unknown kind of traffic {kind}, must be one of {', '.join(traffic_kinds)}!")
+        kind_list.append(kind)
+        weight_list.append(float(weight or 1))
+    return kind_list, weight_list
+
+
+def generate_request(kind, index, args, rng):
+
+    """ This function returns the (event_schema, query string, body, number of events) of a request of a kind of traffic.
+    Malformed requests are truncated JSON documents, which the endpoint stores as unknown objects.
+    """
+
+    session_id = f'{rng.randrange(args.sessions):032x}'
+    event_schema = 'playfab' if kind == 'playfab' else 'improbable'
+    now = time.time()
+    events = []
+    for event_index in range(args.events_per_request):
+        if event_schema == 'playfab':
+            events.append({'TitleId': 'A1B2', 'Timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.0000000Z', time.gmtime(now)), 'SourceType': 'BackEnd',
+                           'Source': 'PlayFab', 'PlayFabEnvironment': 'Production', 'EventNamespace': 'com.playfab', 'EventName': 'player_logged_in',
+                           'EventId': f'{index:08x}{event_index:04x}', 'EntityType': 'player', 'EntityId': session_id[:16], 'Platform': 'Custom'})
+        else:
+            attributes = {'playerId': rng.randrange(10 ** 8), 'level': rng.randrange(100)}
+            if kind == 'large':
+                attributes['payload'] = 'x' * args.large_attribute_bytes
+            events.append({'eventSource': 'client', 'eventClass': 'gameplay', 'eventType': rng.choice(['tick', 'kill', 'death', 'purchase']),
+                           'eventTimestamp': now, 'eventIndex': event_index, 'sessionId': session_id, 'versionId': '2.0.13',
+                           'eventEnvironment': 'debug', 'eventAttributes': attributes})
+
+    body = json.dumps(events)
+    if kind == 'malformed':
+        body = body[:len(body) // 2]
+    query_string = urllib.parse.urlencode({'event_schema': event_schema, 'event_category': 'native', 'event_environment': 'debug',
+                                           'session_id': session_id})
+    return event_schema, query_string, body, 0 if kind == 'malformed' else len(events)
+
+
+def import_module(name, path, package_dir):
+
+    """ This function imports the module at path with package_dir first on sys.path. The endpoint & the functions each import
+    their own `common` package, so the `common` modules imported before are dropped from sys.modules first. Modules keep
+    referring to the ones they imported themselves, while deferred imports resolve to the package imported last.
+    """
+
+    for module_name in [module_name for module_name in sys.modules if module_name == 'common' or module_name.startswith('common.')]:
+        del sys.modules[module_name]
+    sys.path.insert(0, package_dir)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(value_list, q):
+    if not value_list:
+        return None
+    value_list = sorted(value_list)
+    return value_list[min(len(value_list) - 1, int(round(q / 100 * (len(value_list) - 1))))]
+
+
+def summarize(value_list):
+    return {f'p{q}': percentile(value_list, q) for q in [50, 90, 99]}
+
+
+def count_sampled_rows(table, table_rows):
+
+    """ This function counts the rows of events the endpoint sampled (see EVENT_SAMPLING_RULES_FILE), raising whenever
+    the rate & rule the endpoint added to an event did not both end up in their columns, e.g. as the formatter of its
+    schema gathered them into its event attributes instead.
+    """
+
+    sampled_rows = 0
+    for row in table_rows:
+        leaked_keys = [key for key in ['samplingRate', 'samplingRule', 'SamplingRate', 'SamplingRule'] if key in str(row.get('event_attributes', ''))]
+        if (row.get('sampling_rate') is None) != (row.get('sampling_rule') is None) or leaked_keys:
+            raise Exception(f"A row of {table} has sampling_rate={row.get('sampling_rate')} & sampling_rule={row.get('sampling_rule')}, "
+                            f"with {', '.join(leaked_keys) or 'none'} in its event_attributes!")
+        sampled_rows += row.get('sampling_rate') is not None
+    return sampled_rows
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    os.environ.update({'ANALYTICS_ENVIRONMENT': 'benchmark', 'ANALYTICS_BUCKET_NAME': bucket_name, 'ENVIRONMENT': 'benchmark',
+                       'LOCATION': 'EU', 'CHECKPOINT_STORE': 'local', 'CHECKPOINT_DIR': tempfile.mkdtemp(prefix='pipeline-e2e-')})
+
+    # The fakes do not import anything of either `common` package, so they are loaded under a name of their own ahead of both:
+    fakes = import_module('benchmark_fakes', os.path.join(SRC_DIR, 'dataflow', 'common', 'fakes.py'), os.path.join(SRC_DIR, 'dataflow'))
+
+    # Notifications are queued alongside the time the request which wrote their object started at:
+    notification_queue, request_state, function_dict = deque(), {'start': None}, dict()
+
+    def notify(notified_bucket_name, object_location):
+        path = decode_gspath(object_location)
+        if path.data_type == 'jsonl' and path.event_category == 'native' and path.event_schema in function_dict:
+            notification_queue.append((path.event_schema, notified_bucket_name, object_location, request_state['start']))
+
+    client_gcs, client_bq = fakes.FakeStorageClient(args.latency, notify=notify), fakes.FakeBigQueryClient(args.latency)
+
+    # The endpoint provisions its bucket & URL signer when it is imported, from the fake storage client & an unused key here.
+    # It is imported first, as the functions' `common` package (../dataflow/common) has to be the one left in sys.modules:
+    key_file = tempfile.NamedTemporaryFile(prefix='pipeline-e2e-', suffix='.der')
+    os.environ.update({'GOOGLE_SECRET_KEY_JSON_ANALYTICS_GCS_WRITER': key_file.name, 'GOOGLE_SECRET_KEY_DER_ANALYTICS_GCS_WRITER': key_file.name,
+                       'GOOGLE_SERVICE_ACCOUNT_EMAIL_ANALYTICS_GCS_WRITER': 'benchmark@benchmark.iam.gserviceaccount.com'})
+    with mock.patch('google.cloud.storage.Client.from_service_account_json', return_value=client_gcs), \
+            mock.patch('Crypto.PublicKey.RSA.importKey'):
+        endpoint = import_module('endpoint_main', os.path.join(SRC_DIR, 'endpoint', 'main.py'), os.path.join(SRC_DIR, 'endpoint'))
+    function_dict.update({schema: import_module(f'function_{schema}', os.path.join(SRC_DIR, 'functions', schema, 'main.py'), os.path.join(SRC_DIR, 'dataflow'))
+                          for schema in ['improbable', 'playfab']})
+    from common.gspath import decode_gspath
+
+    for function in function_dict.values():
+        function.client_gcs, function.client_bq = client_gcs, client_bq
+    client = endpoint.app.test_client()
+
+    kind_list, weight_list = parse_mix(args.mix)
+    request_list = [generate_request(kind, index, args, rng) for index, kind in enumerate(rng.choices(kind_list, weight_list, k=args.requests))]
+    print(f"Generated {len(request_list):,} requests of {sum(request[3] for request in request_list):,} events ({args.mix}) | "
+          f"{sum(len(request[2]) for request in request_list) / 1024 / 1024:,.1f} MiB")
+
+    cpu_seconds, latency_ms, counts = defaultdict(float), defaultdict(list), defaultdict(int)
+
+    def deliver(devnull):
+        while notification_queue:
+            event_schema, notified_bucket_name, object_location, request_start = notification_queue.popleft()
+            data = {'data': base64.b64encode(json.dumps({'bucket': notified_bucket_name, 'name': object_location}).encode('utf-8'))}
+            os.environ['FUNCTION_NAME'] = f'function-{event_schema}-benchmark'
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                # The functions log their metrics on every invocation, which is not what we are after here:
+                with contextlib.redirect_stdout(devnull):
+                    function_dict[event_schema].ingest_into_native_bigquery_storage(data, None)
+            except Exception:
+                counts['function_errors'] += 1
+            end = time.perf_counter()
+            cpu_seconds[f'function_{event_schema}'] += time.thread_time() - cpu_start
+            latency_ms['function'].append((end - start) * 1000)
+            latency_ms['end_to_end'].append((end - request_start) * 1000)
+            counts['notifications'] += 1
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        for index, (event_schema, query_string, body, _) in enumerate(request_list):
+            request_state['start'], cpu_start = time.perf_counter(), time.thread_time()
+            response = client.post(f'/v1/event?{query_string}', data=body, content_type='application/json')
+            cpu_seconds['endpoint'] += time.thread_time() - cpu_start
+            latency_ms['endpoint'].append((time.perf_counter() - request_state['start']) * 1000)
+            if response.get_json().get('statusCode') != 200:
+                counts['endpoint_errors'] += 1
+            if (index + 1) % args.drain_every == 0:
+                deliver(devnull)
+        deliver(devnull)
+    wall_seconds = time.perf_counter() - start
+
+    rows = {table: len(table_rows) for table, table_rows in sorted(client_bq.rows.items())}
+    events_ingested = sum(table_rows for table, table_rows in rows.items() if table.startswith('native.'))
+    sampled_rows = {table: count_sampled_rows(table, table_rows) for table, table_rows in sorted(client_bq.rows.items()) if table.startswith('native.')}
+    results = {
+        'requests': len(request_list), 'events_sent': sum(request[3] for request in request_list), 'events_ingested': events_ingested,
+        'objects_written': sum(len(bucket.objects) for bucket in client_gcs.buckets.values()), 'wall_seconds': wall_seconds,
+        'events_per_second': events_ingested / wall_seconds, 'requests_per_second': len(request_list) / wall_seconds,
+        'latency_ms': {name: summarize(value_list) for name, value_list in latency_ms.items()},
+        'cpu_seconds': dict(cpu_seconds), 'cpu_us_per_event': {name: seconds * 10 ** 6 / max(events_ingested, 1) for name, seconds in cpu_seconds.items()},
+        'counts': dict(counts), 'rows': rows, 'sampled_rows': sampled_rows}
+
+    print(f"Ingested {events_ingested:,} events in {wall_seconds:.1f}s: {results['events_per_second']:,.0f} events/s end-to-end, "
+          f"{results['requests_per_second']:,.0f} requests/s | {results['objects_written']:,} objects, {counts['notifications']:,} notifications, "
+          f"{counts['endpoint_errors']:,} endpoint & {counts['function_errors']:,} function errors")
+    for name, summary in results['latency_ms'].items():
+        print(f"{name:<16} latency  p50 {summary['p50']:>9.2f}ms  p90 {summary['p90']:>9.2f}ms  p99 {summary['p99']:>9.2f}ms")
+    for name, seconds in sorted(cpu_seconds.items()):
+        print(f"{name:<20} CPU {seconds:>8.2f}s {results['cpu_us_per_event'][name]:>9.1f}us/event")
+    for table, table_rows in rows.items():
+        print(f"{table:<40} {table_rows:>12,} rows{f' ({sampled_rows[table]:,} sampled)' if sampled_rows.get(table) else ''}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
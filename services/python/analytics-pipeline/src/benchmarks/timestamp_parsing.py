@@ -0,0 +1,112 @@
+# Python 3.7.1
+
+# python timestamp_parsing.py \
+#   --n=1000000 \
+#   --batch-size=1000
+
+# Compares casting event timestamps to unixtime one at a time (the way the Cloud Functions used
+# to, trying float() & then each format with strptime()) against cast_to_unix_timestamps(), which
+# detects the format once per batch & parses fixed-layout ISO strings by slicing.
+
+from datetime import datetime, timedelta
+import argparse
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataflow'))
+
+from common.functions import cast_to_unix_timestamps
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n', type=int, default=1000000)
+parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000)
+parser.add_argument('--seed', type=int, default=42)
+
+improbable_formats = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S %Z']
+playfab_formats = ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%S.%f']
+
+
+def legacy_cast_to_unix_timestamp(timestamp, timestamp_format_list):
+
+    """ The per-event implementation the Cloud Functions used before, kept as the baseline.
+    """
+
+    try:
+        timestamp = float(timestamp)
+    except (ValueError, TypeError):
+        pass
+    if isinstance(timestamp, (int, float)):
+        return timestamp
+    if isinstance(timestamp, str):
+        for format in timestamp_format_list:
+            try:
+                return datetime.strptime(timestamp, format)
+            except ValueError:
+                continue
+    return None
+
+
+def generate_batches(n, batch_size):
+
+    """ Generates batches of timestamps the way they arrive within files: mostly a single format per
+    file, with a mix of formats across files, and the occasional malformed value.
+    """
+
+    start = datetime(2019, 1, 1)
+    kinds = ['float', 'numeric_string', 'iso', 'iso_utc', 'playfab']
+    batches, generated = [], 0
+    while generated < n:
+        kind, size = random.choice(kinds), min(batch_size, n - generated)
+        batch = []
+        for _ in range(size):
+            ts = start + timedelta(seconds=random.randint(0, 3600 * 24 * 365), microseconds=random.randint(0, 999999))
+            if random.random() < 0.001:
+                batch.append('not-a-timestamp')
+            elif kind == 'float':
+                batch.append((ts - datetime(1970, 1, 1)).total_seconds())
+            elif kind == 'numeric_string':
+                batch.append(str((ts - datetime(1970, 1, 1)).total_seconds()))
+            elif kind == 'iso':
+                batch.append(ts.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            elif kind == 'iso_utc':
+                batch.append(ts.strftime('%Y-%m-%d %H:%M:%S UTC'))
+            else:
+                batch.append(ts.strftime('%Y-%m-%dT%H:%M:%S.%f') + '7Z')
+        batches.append(('playfab' if kind == 'playfab' else 'improbable', batch))
+        generated += size
+    return batches
+
+
+def run(args):
+    random.seed(args.seed)
+    batches = generate_batches(args.n, args.batch_size)
+
+    start = time.perf_counter()
+    for schema, batch in batches:
+        if schema == 'playfab':
+            # The PlayFab function used to right trim the 7th fractional digit:
+            [legacy_cast_to_unix_timestamp(ts[:26] if ts else None, ['%Y-%m-%dT%H:%M:%S.%f']) for ts in batch]
+        else:
+            [legacy_cast_to_unix_timestamp(ts, improbable_formats) for ts in batch]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parsed, unparsed = 0, 0
+    for schema, batch in batches:
+        for unix_timestamp in cast_to_unix_timestamps(batch, playfab_formats if schema == 'playfab' else improbable_formats):
+            if unix_timestamp is None:
+                unparsed += 1
+            else:
+                parsed += 1
+    batched_seconds = time.perf_counter() - start
+
+    print(f'Timestamps: {args.n} in batches of {args.batch_size} ({parsed} parsed, {unparsed} unparseable)')
+    print(f'Per-event strptime: {legacy_seconds:.2f}s ({args.n / legacy_seconds:,.0f} timestamps/s)')
+    print(f'Batched & sniffed:  {batched_seconds:.2f}s ({args.n / batched_seconds:,.0f} timestamps/s)')
+    print(f'Speed-up: {legacy_seconds / batched_seconds:.1f}x')
+
+
+if __name__ == '__main__':
+    run(parser.parse_args())
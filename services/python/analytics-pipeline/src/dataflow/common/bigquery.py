@@ -36,45 +36,103 @@ def generate_bigquery_assets(client_bq, bigquery_asset_list):
     # Create table if it does not exist..
     table_list = []
     for bq_asset in bigquery_asset_list:
-        dataset_name, table_name, table_schema, table_partition = bq_asset
+        dataset_name, table_name, table_schema, table_partition, table_layout = bq_asset
         table_ref = client_bq.dataset(dataset_name).table(table_name)
         if not asset_exists(client_bq, 'table', table_ref):
             table = bigquery.Table(table_ref, schema=bigquery_table_schema_dict[table_schema])
-            if table_partition:
-                table.time_partitioning = bigquery.TimePartitioning(
-                    type_=bigquery.TimePartitioningType.DAY,
-                    field=table_partition)
-            table_list.append(client_bq.create_table(table))
+            table_list.append(client_bq.create_table(apply_bigquery_table_layout(table, table_partition, table_layout)))
         else:
-            table_list.append(client_bq.get_table(table_ref))
+            table_list.append(reconcile_bigquery_table_layout(client_bq, client_bq.get_table(table_ref), table_layout, bigquery_table_schema_dict[table_schema]))
 
     return table_list
 
 
+def get_bigquery_table_layout(table_layout):
+
+    """ This function returns the physical layout of a table (see common/bigquery_schema.py), with defaults filled in.
+    """
+
+    from common.bigquery_schema import bigquery_table_layout_dict, bigquery_table_layout_defaults
+
+    return dict(bigquery_table_layout_defaults, **bigquery_table_layout_dict.get(table_layout, {}))
+
+
+def apply_bigquery_table_layout(table, table_partition, table_layout):
+
+    """ This function sets the partitioning & clustering of a table which is about to be created.
+    """
+
+    from google.cloud import bigquery
+
+    layout = get_bigquery_table_layout(table_layout)
+    if table_partition:
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY,
+            field=table_partition,
+            require_partition_filter=layout['require_partition_filter'])
+    table.clustering_fields = layout['clustering_fields']
+    return table
+
+
+def reconcile_bigquery_table_layout(client_bq, table, table_layout, table_schema=None):
+
+    """ This function updates the clustering & partition filter requirement of an existing table whenever they
+    differ from its layout, which costs no API requests if they already match. Whenever table_schema is passed,
+    its columns missing from the table (such as newly promoted attributes) are added as well.
+
+    Failing updates are reported rather than raised, as table metadata updates are rate limited & many instances
+    may try to reconcile the same table at once: one of them succeeding suffices.
+    """
+
+    layout, fields = get_bigquery_table_layout(table_layout), []
+    if table_schema and table.schema:
+        existing_columns = set(field.name for field in table.schema)
+        missing_columns = [field for field in table_schema if field.name not in existing_columns]
+        if missing_columns:
+            # Columns can only be appended, they must be NULLABLE (or REPEATED) so existing rows remain valid:
+            table.schema = list(table.schema) + missing_columns
+            fields.append('schema')
+    if (table.clustering_fields or None) != layout['clustering_fields']:
+        table.clustering_fields = layout['clustering_fields']
+        fields.append('clustering_fields')
+
+    partitioning = table.time_partitioning
+    if partitioning is not None and bool(partitioning.require_partition_filter) != layout['require_partition_filter']:
+        partitioning.require_partition_filter = layout['require_partition_filter']
+        table.time_partitioning = partitioning
+        fields.append('time_partitioning')
+
+    if not fields:
+        return table
+    try:
+        return client_bq.update_table(table, fields)
+    except Exception as e:
+        print(f'Could not reconcile the layout of {table.table_id}: {e}')
+        return table
+
+
 def source_bigquery_assets(client_bq, bigquery_asset_list):
 
-    """ This function sources BigQuery assets. If this operation fails,
+    """ This function sources BigQuery assets & reconciles their layout & columns. If this operation fails,
     generate_bigquery_assets() should be invoked.
     """
 
+    from common.bigquery_schema import bigquery_table_schema_dict
+
     table_list = []
     for bq_asset in bigquery_asset_list:
-        dataset_name, table_name, partition = bq_asset
+        dataset_name, table_name, table_schema, _, table_layout = bq_asset
         dataset_ref = client_bq.dataset(dataset_name)
         table_ref = dataset_ref.table(table_name)
-        table_list.append(client_bq.get_table(table_ref))
+        table_list.append(reconcile_bigquery_table_layout(client_bq, client_bq.get_table(table_ref), table_layout, bigquery_table_schema_dict[table_schema]))
 
     return table_list
 
 
-def generate_backfill_query(gcp, environment, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple, scale_test_name=''):
-
-    """ This function generates a SQL query used to verify which files are already ingested into native BigQuery storage.
-    Generally, the pipeline calling this function will omit these files from the total set of files it is tasked to ingest
-    into native BigQuery storage.
+def generate_backfill_filters(ds_start, ds_stop, scale_test_name=''):
 
-    When you pass an argument as `--event-category=` or `--event-category=None` it will be None. However, it will be parsed as
-    an empty string. This means we assume the gspath in this case should match `.*/event_category=/.*`.
+    """ This function generates the SQL conditions shared by the backfill queries below. It returns a tuple of a
+    function formatting (sql_condition_list, name) tuples, the event_ds condition & the scale test conditions on logs & events.
     """
 
     def extract_filter_tuple(sql_condition_list, name):
@@ -94,6 +152,21 @@ def generate_backfill_query(gcp, environment, event_schema, event_environment, c
     else:
         scale_test_logs_filter, scale_test_events_filter = '', ''
 
+    return extract_filter_tuple, ds_filter, scale_test_logs_filter, scale_test_events_filter
+
+
+def generate_backfill_query(gcp, environment, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple, scale_test_name=''):
+
+    """ This function generates a SQL query used to verify which files are already ingested into native BigQuery storage.
+    Generally, the pipeline calling this function will omit these files from the total set of files it is tasked to ingest
+    into native BigQuery storage.
+
+    When you pass an argument as `--event-category=` or `--event-category=None` it will be None. However, it will be parsed as
+    an empty string. This means we assume the gspath in this case should match `.*/event_category=/.*`.
+    """
+
+    extract_filter_tuple, ds_filter, scale_test_logs_filter, scale_test_events_filter = generate_backfill_filters(ds_start, ds_stop, scale_test_name)
+
     query = f"""
     SELECT DISTINCT
       a.gspath
@@ -132,3 +205,409 @@ def generate_backfill_query(gcp, environment, event_schema, event_environment, c
     """
 
     return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+def generate_manifest_backfill_query(gcp, environment, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple, scale_test_name=''):
+
+    """ This function generates a SQL query used to verify which files are already ingested into native BigQuery storage,
+    based on the ingestion manifest the Cloud Functions & Dataflow backfill maintain. Unlike generate_backfill_query(),
+    it only reads the manifest partitions within the requested date range, instead of all events.
+    """
+
+    extract_filter_tuple, ds_filter, scale_test_logs_filter, _ = generate_backfill_filters(ds_start, ds_stop, scale_test_name)
+
+    query = f"""
+    SELECT DISTINCT
+      gspath
+    FROM `{gcp}.logs.ingestion_manifest_{environment}`
+    WHERE event_schema = '{event_schema}'
+    AND event_category IN {extract_filter_tuple(*category_tuple)}
+    AND event_environment = '{event_environment}'
+    AND event_ds {ds_filter}
+    AND event_time IN {extract_filter_tuple(*time_part_tuple)}
+    {scale_test_logs_filter}
+    AND status IN ('ingested', 'malformed')
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+def generate_manifest_count_query(gcp, environment, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple, scale_test_name=''):
+
+    """ This function generates a SQL query counting the files the ingestion manifest holds for the requested range. A range
+    without any is not diffed against the manifest, as its files were most likely ingested before the manifest existed.
+    """
+
+    extract_filter_tuple, ds_filter, scale_test_logs_filter, _ = generate_backfill_filters(ds_start, ds_stop, scale_test_name)
+
+    query = f"""
+    SELECT
+      COUNT(*) AS files
+    FROM `{gcp}.logs.ingestion_manifest_{environment}`
+    WHERE event_schema = '{event_schema}'
+    AND event_category IN {extract_filter_tuple(*category_tuple)}
+    AND event_environment = '{event_environment}'
+    AND event_ds {ds_filter}
+    AND event_time IN {extract_filter_tuple(*time_part_tuple)}
+    {scale_test_logs_filter}
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+def generate_manifest_seed_query(gcp, environment, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple, scale_test_name=''):
+
+    """ This function generates a SQL statement which records the files ingested before the ingestion manifest existed
+    in the manifest, using the same logic as generate_backfill_query(). It scans the native events table once, after
+    which generate_manifest_backfill_query() can be used for the same range.
+    """
+
+    extract_filter_tuple, ds_filter, scale_test_logs_filter, scale_test_events_filter = generate_backfill_filters(ds_start, ds_stop, scale_test_name)
+
+    query = f"""
+    INSERT INTO `{gcp}.logs.ingestion_manifest_{environment}` (job_name, processed_timestamp, batch_id, event_schema, event_environment, event_category, event_ds, event_time, status, gspath)
+    SELECT
+      'manifest-seed',
+      CURRENT_TIMESTAMP(),
+      a.batch_id,
+      a.event_schema,
+      a.event_environment,
+      a.event_category,
+      a.event_ds,
+      a.event_time,
+      IF(b.malformed, 'malformed', 'ingested'),
+      a.gspath
+    FROM
+        (
+        SELECT DISTINCT
+          gspath,
+          batch_id,
+          event_schema,
+          event_environment,
+          event_category,
+          event_ds,
+          event_time
+        FROM `{gcp}.logs.native_events_{environment}`
+        WHERE event_schema = '{event_schema}'
+        AND event_category IN {extract_filter_tuple(*category_tuple)}
+        AND event_environment = '{event_environment}'
+        AND event_ds {ds_filter}
+        AND event_time IN {extract_filter_tuple(*time_part_tuple)}
+        {scale_test_logs_filter}
+        AND event = 'parse_initiated'
+        ) a
+    INNER JOIN
+        (
+        SELECT batch_id, LOGICAL_OR(malformed) AS malformed
+        FROM (
+            SELECT batch_id, FALSE AS malformed
+            FROM `{gcp}.native.events_{event_schema}_{environment}`
+            WHERE event_environment = '{event_environment}'
+            {scale_test_events_filter}
+            UNION ALL
+            SELECT batch_id, TRUE AS malformed
+            FROM `{gcp}.logs.native_events_debug_{environment}`
+            WHERE event_schema = '{event_schema}'
+            AND event_category IN {extract_filter_tuple(*category_tuple)}
+            AND event_environment = '{event_environment}'
+            AND event_ds {ds_filter}
+            AND event_time IN {extract_filter_tuple(*time_part_tuple)}
+            {scale_test_logs_filter}
+            )
+        GROUP BY batch_id
+        ) b
+    ON a.batch_id = b.batch_id
+    WHERE a.batch_id NOT IN (
+        SELECT batch_id
+        FROM `{gcp}.logs.ingestion_manifest_{environment}`
+        WHERE event_ds {ds_filter}
+        )
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+def generate_quarantine_manifest_query(gcp, environment, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple, status_tuple):
+
+    """ This function generates a SQL query returning the quarantined objects of event_schema (see common/quarantine.py)
+    which were already reprocessed, according to the ingestion manifest, with one of the statuses in status_tuple.
+    """
+
+    extract_filter_tuple, ds_filter, _, _ = generate_backfill_filters(ds_start, ds_stop)
+
+    query = f"""
+    SELECT DISTINCT
+      gspath
+    FROM `{gcp}.logs.ingestion_manifest_{environment}`
+    WHERE ((event_schema = '{event_schema}-raw' AND gspath LIKE '%/data_type=jsonl/%')
+        OR (event_schema = '{event_schema}' AND gspath LIKE '%/data_type=unknown/%'))
+    AND event_category IN {extract_filter_tuple(*category_tuple)}
+    AND event_environment = '{event_environment}'
+    AND event_ds {ds_filter}
+    AND event_time IN {extract_filter_tuple(*time_part_tuple)}
+    AND status IN {status_tuple}
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+def generate_quarantine_loaded_events_query(gcp, environment, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple):
+
+    """ This function generates a SQL query returning the (batch_id, event_id) of the events in native BigQuery storage which
+    were recovered from quarantined objects of event_schema, whose reprocessing left some of their events malformed. It scans
+    the batch_id & event_id columns of the whole native table, as events are partitioned by when they happened.
+    """
+
+    extract_filter_tuple, ds_filter, _, _ = generate_backfill_filters(ds_start, ds_stop)
+
+    query = f"""
+    SELECT DISTINCT
+      batch_id,
+      event_id
+    FROM `{gcp}.native.events_{event_schema}_{environment}`
+    WHERE batch_id IN (
+        SELECT batch_id
+        FROM `{gcp}.logs.ingestion_manifest_{environment}`
+        WHERE ((event_schema = '{event_schema}-raw' AND gspath LIKE '%/data_type=jsonl/%')
+            OR (event_schema = '{event_schema}' AND gspath LIKE '%/data_type=unknown/%'))
+        AND event_category IN {extract_filter_tuple(*category_tuple)}
+        AND event_environment = '{event_environment}'
+        AND event_ds {ds_filter}
+        AND event_time IN {extract_filter_tuple(*time_part_tuple)}
+        AND status = 'malformed'
+        )
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+# The columns of the native events the rollups aggregate by, per event_schema (see common/bigquery_schema.py):
+rollup_column_dict = {
+    'improbable': {'event_environment': 'event_environment', 'event_class': 'event_class', 'event_type': 'event_type',
+                   'session_id': 'session_id', 'player_id': 'player_id'},
+    'playfab': {'event_environment': 'playfab_environment', 'event_class': 'event_namespace', 'event_type': 'event_name',
+                'session_id': 'CAST(NULL AS STRING)', 'player_id': "IF(entity_type = 'player', entity_id, NULL)"}
+}
+
+
+def generate_rollup_filters(ts_start, ts_stop, inserted_ts_stop):
+
+    """ This function generates the SQL conditions shared by the rollup statements below, which only read events
+    with an event_timestamp within [ts_start, ts_stop) (ts_stop may be None) that were inserted up to inserted_ts_stop.
+    """
+
+    ts_filter = f"event_timestamp >= TIMESTAMP('{ts_start}')"
+    if ts_stop:
+        ts_filter += f" AND event_timestamp < TIMESTAMP('{ts_stop}')"
+    return ts_filter, f"inserted_timestamp <= TIMESTAMP('{inserted_ts_stop}')"
+
+
+def generate_rollup_hourly_query(gcp, environment, event_schema, ts_start, ts_stop, inserted_ts_stop, inserted_ts_start=None):
+
+    """ This function generates a SQL statement which recomputes the hourly event counts from the native events within
+    [ts_start, ts_stop), which must be whole hours. Whenever inserted_ts_start is passed, only the hours which received events
+    inserted after it are recomputed. Each hour is recomputed as a whole rather than incremented, so running a statement
+    twice (e.g. after a failure) yields the same counts.
+    """
+
+    columns = rollup_column_dict[event_schema]
+    ts_filter, inserted_filter = generate_rollup_filters(ts_start, ts_stop, inserted_ts_stop)
+    touched_filter = f"HAVING MAX(inserted_timestamp) > TIMESTAMP('{inserted_ts_start}')" if inserted_ts_start else ''
+    # Dimensions may be NULL, which never equal each other:
+    dimension_filter = '\n      '.join(f'AND (t.{column} = s.{column} OR (t.{column} IS NULL AND s.{column} IS NULL))' for column in ['event_environment', 'event_class', 'event_type'])
+
+    query = f"""
+    MERGE `{gcp}.rollups.hourly_events_{event_schema}_{environment}` t
+    USING (
+        SELECT
+          TIMESTAMP_TRUNC(event_timestamp, HOUR) AS event_hour,
+          {columns['event_environment']} AS event_environment,
+          {columns['event_class']} AS event_class,
+          {columns['event_type']} AS event_type,
+          COUNT(*) AS event_count,
+          COUNT(DISTINCT {columns['session_id']}) AS session_count,
+          COUNT(DISTINCT {columns['player_id']}) AS player_count,
+          MAX(inserted_timestamp) AS last_inserted_timestamp
+        FROM `{gcp}.native.events_{event_schema}_{environment}`
+        WHERE {ts_filter}
+        AND {inserted_filter}
+        GROUP BY 1, 2, 3, 4
+        {touched_filter}
+        ) s
+    ON t.event_hour >= TIMESTAMP('{ts_start}')
+      AND t.event_hour = s.event_hour
+      {dimension_filter}
+    WHEN MATCHED THEN
+      UPDATE SET event_count = s.event_count, session_count = s.session_count, player_count = s.player_count,
+        last_inserted_timestamp = s.last_inserted_timestamp, updated_timestamp = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN
+      INSERT (event_hour, event_environment, event_class, event_type, event_count, session_count, player_count, last_inserted_timestamp, updated_timestamp)
+      VALUES (s.event_hour, s.event_environment, s.event_class, s.event_type, s.event_count, s.session_count, s.player_count, s.last_inserted_timestamp, CURRENT_TIMESTAMP())
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+def generate_rollup_sessions_query(gcp, environment, ts_start, ts_stop, inserted_ts_stop, inserted_ts_start=None, session_hours=24):
+
+    """ This function generates a SQL statement which recomputes the summaries of the (improbable) sessions with events
+    within [ts_start, ts_stop), or only of those which received events inserted after inserted_ts_start whenever it is passed.
+    Sessions are summarized over their events up to session_hours before ts_start (& after ts_stop), so sessions lasting
+    longer are summarized over part of their events only, while their first & last event timestamps are kept.
+    """
+
+    ts_filter, inserted_filter = generate_rollup_filters(ts_start, ts_stop, inserted_ts_stop)
+    scan_filter = f"event_timestamp >= TIMESTAMP_SUB(TIMESTAMP('{ts_start}'), INTERVAL {session_hours} HOUR)"
+    if ts_stop:
+        scan_filter += f" AND event_timestamp < TIMESTAMP_ADD(TIMESTAMP('{ts_stop}'), INTERVAL {session_hours} HOUR)"
+    touched_filter = f"AND inserted_timestamp > TIMESTAMP('{inserted_ts_start}')" if inserted_ts_start else ''
+
+    query = f"""
+    MERGE `{gcp}.rollups.sessions_improbable_{environment}` t
+    USING (
+        WITH events AS (
+            SELECT *
+            FROM `{gcp}.native.events_improbable_{environment}`
+            WHERE {scan_filter}
+            AND {inserted_filter}
+            AND session_id IS NOT NULL
+            )
+        SELECT
+          session_id,
+          MAX(event_environment) AS event_environment,
+          MAX(event_source) AS event_source,
+          MAX(version_id) AS version_id,
+          MAX(player_id) AS player_id,
+          MIN(event_timestamp) AS first_event_timestamp,
+          MAX(event_timestamp) AS last_event_timestamp,
+          COUNT(*) AS event_count,
+          COUNT(DISTINCT event_type) AS event_type_count,
+          MAX(inserted_timestamp) AS last_inserted_timestamp
+        FROM events
+        WHERE session_id IN (
+            SELECT session_id
+            FROM events
+            WHERE {ts_filter}
+            {touched_filter}
+            )
+        GROUP BY session_id
+        ) s
+    ON t.session_id = s.session_id
+    WHEN MATCHED THEN
+      UPDATE SET event_environment = s.event_environment, event_source = s.event_source, version_id = s.version_id, player_id = s.player_id,
+        first_event_timestamp = LEAST(t.first_event_timestamp, s.first_event_timestamp),
+        last_event_timestamp = GREATEST(t.last_event_timestamp, s.last_event_timestamp),
+        duration_seconds = TIMESTAMP_DIFF(GREATEST(t.last_event_timestamp, s.last_event_timestamp), LEAST(t.first_event_timestamp, s.first_event_timestamp), SECOND),
+        event_count = s.event_count, event_type_count = s.event_type_count,
+        last_inserted_timestamp = s.last_inserted_timestamp, updated_timestamp = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED THEN
+      INSERT (session_id, event_environment, event_source, version_id, player_id, first_event_timestamp, last_event_timestamp, duration_seconds,
+        event_count, event_type_count, last_inserted_timestamp, updated_timestamp)
+      VALUES (s.session_id, s.event_environment, s.event_source, s.version_id, s.player_id, s.first_event_timestamp, s.last_event_timestamp,
+        TIMESTAMP_DIFF(s.last_event_timestamp, s.first_event_timestamp, SECOND), s.event_count, s.event_type_count, s.last_inserted_timestamp, CURRENT_TIMESTAMP())
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+# The prefixes of the bucket which can be queried in place through hive-partitioned external tables, by data_type (see
+# generate_external_table_ddl()). Objects written by the endpoint are gzip-compressed, whereas compacted ones are not:
+external_table_dict = {
+    'jsonl': {'compression': 'GZIP', 'suffix': '*.jsonl'},
+    'jsonl_compacted': {'compression': None, 'suffix': '*.jsonl'},  # Skips the `.index.json` of every compacted object.
+    'unknown': {'compression': None, 'suffix': '*'}
+}
+
+# The hive partition keys of every object location, see ../endpoint/main.py:
+external_partition_column_list = [('event_schema', 'STRING'), ('event_category', 'STRING'), ('event_environment', 'STRING'), ('event_ds', 'DATE'), ('event_time', 'STRING')]
+
+
+def generate_external_table_ddl(gcp, environment, bucket_name, data_type):
+
+    """ This function generates a DDL statement creating a hive-partitioned external table over the data_type= prefix of the
+    bucket, in which every line of every object is a row with a single `line` column (as neither raw nor unknown objects adhere to a
+    schema), next to the partition keys. Queries must filter on the partition keys, so they only list & read the matching prefixes
+    (see generate_external_query()). Lines of JSON objects can be parsed with BigQuery JSON functions, e.g. JSON_EXTRACT_SCALAR(line, '$.eventType').
+
+    The google-cloud-bigquery client pinned in ../requirements predates hive partitioning options, which is why a DDL statement is used.
+    """
+
+    partition_columns = ', '.join(f'{column} {field_type}' for column, field_type in external_partition_column_list)
+    compression = f"compression = '{external_table_dict[data_type]['compression']}',\n" if external_table_dict[data_type]['compression'] else ''
+
+    # Lines are read as CSV with a single column, split on a control character which cannot occur within JSON strings:
+    query = f"""
+    CREATE EXTERNAL TABLE IF NOT EXISTS `{gcp}.external.gcs_{data_type}_{environment}` (line STRING)
+    WITH PARTITION COLUMNS ({partition_columns})
+    OPTIONS (
+      format = 'CSV',
+      field_delimiter = '\\x1f',
+      quote = '',
+      allow_jagged_rows = true,
+      {compression}
+      uris = ['gs://{bucket_name}/data_type={data_type}/{external_table_dict[data_type]['suffix']}'],
+      hive_partition_uri_prefix = 'gs://{bucket_name}/data_type={data_type}/',
+      require_hive_partition_filter = true
+    )
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
+
+
+def generate_external_bigquery_assets(client_bq, gcp, environment, bucket_name, data_type_list):
+
+    """ This function provisions the hive-partitioned external tables over the data_type= prefixes of data_type_list,
+    within the `external` dataset. Existing tables are left as they are.
+    """
+
+    from google.cloud.exceptions import NotFound
+    from google.cloud import bigquery
+
+    dataset_ref = client_bq.dataset('external')
+    try:
+        client_bq.get_dataset(dataset_ref)
+    except NotFound:
+        client_bq.create_dataset(bigquery.Dataset(dataset_ref))
+
+    for data_type in data_type_list:
+        client_bq.query(generate_external_table_ddl(gcp, environment, bucket_name, data_type)).result()
+
+
+def generate_external_query(gcp, environment, data_type, event_schema, event_environment, category_tuple, ds_start, ds_stop, time_part_tuple, condition=''):
+
+    """ This function generates a SQL query reading the lines of the objects below data_type= within the given partitions, alongside
+    the gspath of their object. Only the prefixes of these partitions are read, as all partition keys are filtered on with
+    constants. Pass `{event_schema}-raw` as event_schema to read the events which could not be formatted by the endpoint, and any
+    SQL condition on `line` (or the gspath) to filter them further.
+    """
+
+    extract_filter_tuple, ds_filter, _, _ = generate_backfill_filters(ds_start, ds_stop)
+
+    query = f"""
+    SELECT
+      _FILE_NAME AS gspath,
+      event_schema,
+      event_category,
+      event_environment,
+      event_ds,
+      event_time,
+      line
+    FROM `{gcp}.external.gcs_{data_type}_{environment}`
+    WHERE event_schema = '{event_schema}'
+    AND event_category IN {extract_filter_tuple(*category_tuple)}
+    AND event_environment = '{event_environment}'
+    AND event_ds {ds_filter}
+    AND event_time IN {extract_filter_tuple(*time_part_tuple)}
+    {f'AND ({condition})' if condition else ''}
+    ;
+    """
+
+    return re.sub(r'\n\s*\n', '\n', query, re.MULTILINE)
@@ -1,3 +1,4 @@
+from common.ingest import promoted_attribute_dict
 from google.cloud import bigquery
 
 bigquery_table_schema_dict = {
@@ -17,7 +18,9 @@ bigquery_table_schema_dict = {
         bigquery.SchemaField(name='received_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The UTC timestamp when the event was received.'),
         bigquery.SchemaField(name='inserted_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The UTC timestamp when the event was ingested into BQ.'),
         bigquery.SchemaField(name='job_name', field_type='STRING', mode='NULLABLE', description='The name of the data pipeline or function that ingested the event into BQ.'),
-        bigquery.SchemaField(name='event_attributes', field_type='STRING', mode='NULLABLE', description='Custom data for the event.')
+        bigquery.SchemaField(name='event_attributes', field_type='STRING', mode='NULLABLE', description='Custom data for the event.'),
+        bigquery.SchemaField(name='sampling_rate', field_type='FLOAT', mode='NULLABLE', description='The rate the event was sampled at by the endpoint, NULL if it was not sampled.'),
+        bigquery.SchemaField(name='sampling_rule', field_type='STRING', mode='NULLABLE', description='The name of the sampling rule the event was sampled by, if any.')
     ],
     'playfab': [
         bigquery.SchemaField(name='analytics_environment', field_type='STRING', mode='NULLABLE', description='The environment of the analytics infrastructure.'),
@@ -35,7 +38,9 @@ bigquery_table_schema_dict = {
         bigquery.SchemaField(name='received_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The UTC timestamp when the event was received.'),
         bigquery.SchemaField(name='inserted_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The UTC timestamp when the event was ingested into BQ.'),
         bigquery.SchemaField(name='job_name', field_type='STRING', mode='NULLABLE', description='The name of the data pipeline or function that ingested the event into BQ.'),
-        bigquery.SchemaField(name='event_attributes', field_type='STRING', mode='NULLABLE', description='Custom data for the event.')
+        bigquery.SchemaField(name='event_attributes', field_type='STRING', mode='NULLABLE', description='Custom data for the event.'),
+        bigquery.SchemaField(name='sampling_rate', field_type='FLOAT', mode='NULLABLE', description='The rate the event was sampled at by the endpoint, NULL if it was not sampled.'),
+        bigquery.SchemaField(name='sampling_rule', field_type='STRING', mode='NULLABLE', description='The name of the sampling rule the event was sampled by, if any.')
     ],
     'logs': [
        bigquery.SchemaField(name='job_name', field_type='STRING', mode='NULLABLE', description='Job name.'),
@@ -48,5 +53,67 @@ bigquery_table_schema_dict = {
        bigquery.SchemaField(name='event_time', field_type='STRING', mode='NULLABLE', description='The value of `event_time` in the GCS path.'),
        bigquery.SchemaField(name='event', field_type='STRING', mode='NULLABLE', description='The event type.'),
        bigquery.SchemaField(name='gspath', field_type='STRING', mode='NULLABLE', description='The full GCS path of the event file.')
+   ],
+    'manifest': [
+       bigquery.SchemaField(name='job_name', field_type='STRING', mode='NULLABLE', description='The name of the data pipeline or function that ingested the event batch file.'),
+       bigquery.SchemaField(name='processed_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The UTC timestamp when ingesting the event batch file completed.'),
+       bigquery.SchemaField(name='batch_id', field_type='STRING', mode='NULLABLE', description='MD5 hexdigest of the GCS filepath.'),
+       bigquery.SchemaField(name='event_schema', field_type='STRING', mode='NULLABLE', description='The value of `event_schema` in the GCS path.'),
+       bigquery.SchemaField(name='event_environment', field_type='STRING', mode='NULLABLE', description='The value of `event_environment` in the GCS path.'),
+       bigquery.SchemaField(name='event_category', field_type='STRING', mode='NULLABLE', description='The value of `event_category` in the GCS path.'),
+       bigquery.SchemaField(name='event_ds', field_type='DATE', mode='NULLABLE', description='PARTITION - The value of `event_ds` in the GCS path.'),
+       bigquery.SchemaField(name='event_time', field_type='STRING', mode='NULLABLE', description='The value of `event_time` in the GCS path.'),
+       bigquery.SchemaField(name='status', field_type='STRING', mode='NULLABLE', description='The outcome of ingesting the event batch file, e.g. {ingested, malformed}.'),
+       bigquery.SchemaField(name='gspath', field_type='STRING', mode='NULLABLE', description='The full GCS path of the event file.')
+   ],
+    'rollup_hourly': [
+       bigquery.SchemaField(name='event_hour', field_type='TIMESTAMP', mode='NULLABLE', description='PARTITION - The hour of event_timestamp (truncated).'),
+       bigquery.SchemaField(name='event_environment', field_type='STRING', mode='NULLABLE', description='The event_environment (improbable) or playfab_environment (playfab) of the events.'),
+       bigquery.SchemaField(name='event_class', field_type='STRING', mode='NULLABLE', description='The event_class (improbable) or event_namespace (playfab) of the events.'),
+       bigquery.SchemaField(name='event_type', field_type='STRING', mode='NULLABLE', description='The event_type (improbable) or event_name (playfab) of the events.'),
+       bigquery.SchemaField(name='event_count', field_type='INTEGER', mode='NULLABLE', description='The number of events.'),
+       bigquery.SchemaField(name='session_count', field_type='INTEGER', mode='NULLABLE', description='The number of distinct sessions the events were sent from (improbable only).'),
+       bigquery.SchemaField(name='player_count', field_type='INTEGER', mode='NULLABLE', description='The number of distinct players the events apply to.'),
+       bigquery.SchemaField(name='last_inserted_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The latest inserted_timestamp of the events.'),
+       bigquery.SchemaField(name='updated_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The UTC timestamp when the row was last recomputed.')
+   ],
+    'rollup_sessions': [
+       bigquery.SchemaField(name='session_id', field_type='STRING', mode='NULLABLE', description='The session ID, which is unique per client/server worker session.'),
+       bigquery.SchemaField(name='event_environment', field_type='STRING', mode='NULLABLE', description='The build configuration that the session sent events from.'),
+       bigquery.SchemaField(name='event_source', field_type='STRING', mode='NULLABLE', description='Type of the worker the session ran on.'),
+       bigquery.SchemaField(name='version_id', field_type='STRING', mode='NULLABLE', description="The version of the game's build or online service."),
+       bigquery.SchemaField(name='player_id', field_type='STRING', mode='NULLABLE', description="The player's unique identifier, if available."),
+       bigquery.SchemaField(name='first_event_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='PARTITION - The event_timestamp of the first event of the session.'),
+       bigquery.SchemaField(name='last_event_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The event_timestamp of the last event of the session.'),
+       bigquery.SchemaField(name='duration_seconds', field_type='INTEGER', mode='NULLABLE', description='The seconds between the first & last event of the session.'),
+       bigquery.SchemaField(name='event_count', field_type='INTEGER', mode='NULLABLE', description='The number of events of the session.'),
+       bigquery.SchemaField(name='event_type_count', field_type='INTEGER', mode='NULLABLE', description='The number of distinct event types of the session.'),
+       bigquery.SchemaField(name='last_inserted_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The latest inserted_timestamp of the events.'),
+       bigquery.SchemaField(name='updated_timestamp', field_type='TIMESTAMP', mode='NULLABLE', description='The UTC timestamp when the row was last recomputed.')
    ]
 }
+
+# Extend the native tables with the columns of their promoted attributes (see common/promoted_attributes.json):
+for event_schema, promoted_attribute_list in promoted_attribute_dict.items():
+    bigquery_table_schema_dict[event_schema] = bigquery_table_schema_dict[event_schema] + [
+        bigquery.SchemaField(name=column, field_type=field_type, mode='NULLABLE', description=f'Promoted from `{path}` in event_attributes.')
+        for column, path, field_type in promoted_attribute_list]
+
+# The physical layout of every table, which the asset list tuples (see common.ingest.get_bigquery_asset_list()) refer to:
+# - clustering_fields: at most 4 columns, in order of how often queries filter on them;
+# - require_partition_filter: whether queries must filter on the partition column, which every query on the logs, debug &
+#   manifest tables within this repository does (see common/bigquery.py), so a query forgetting it fails instead of
+#   scanning all partitions.
+# Partitioning itself can only be set when a table is created, whereas the other properties are reconciled on existing tables.
+bigquery_table_layout_dict = {
+    'improbable': {'clustering_fields': ['session_id', 'player_id', 'event_class', 'event_type']},
+    'playfab': {'clustering_fields': ['entity_id', 'event_namespace', 'event_name']},
+    'logs': {'clustering_fields': ['event_schema', 'event_environment', 'event_category', 'event_time'], 'require_partition_filter': True},
+    'debug': {'clustering_fields': ['event_schema', 'event_environment', 'event_category', 'batch_id'], 'require_partition_filter': True},
+    'backfill': {'clustering_fields': ['event_schema', 'event_environment', 'event_category', 'event']},
+    'manifest': {'clustering_fields': ['event_schema', 'event_environment', 'event_category', 'event_time'], 'require_partition_filter': True},
+    'rollup_hourly': {'clustering_fields': ['event_environment', 'event_class', 'event_type']},
+    'rollup_sessions': {'clustering_fields': ['session_id', 'event_environment', 'player_id']}
+}
+
+bigquery_table_layout_defaults = {'clustering_fields': None, 'require_partition_filter': False}
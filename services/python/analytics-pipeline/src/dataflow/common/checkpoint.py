@@ -0,0 +1,135 @@
+import json
+import os
+
+
+class CheckpointStore(object):
+
+    """ Base class for stores that record which chunks of an event batch file were already
+    committed into BigQuery. Chunks are identified by their offset within the file, and
+    offsets are keyed on the batch_id of the file (MD5 hexdigest of its gspath). Whether any
+    committed chunk held malformed lines is recorded as well, as the file is malformed even
+    if the chunks left to commit are not.
+
+    Whenever a file is redelivered (e.g. by Pub/Sub or a backfill), chunks which were
+    already committed can be skipped, instead of being streamed into BigQuery again.
+    """
+
+    def load(self, batch_id, chunk_size):
+
+        """ Returns the set of committed chunk offsets for batch_id & whether any of them held malformed lines.
+        Offsets are only valid for the chunk_size they were recorded with, so (an empty set, False) is returned on a mismatch.
+        """
+
+        record = self.read(batch_id)
+        if record is None or record.get('chunk_size') != chunk_size:
+            return set(), False
+        return set(record.get('committed_chunks', [])), record.get('malformed', False)
+
+    def save(self, batch_id, chunk_size, committed_chunks, gspath=None, malformed=False):
+        self.write(batch_id, {
+            'batch_id': batch_id,
+            'gspath': gspath,
+            'chunk_size': chunk_size,
+            'committed_chunks': sorted(committed_chunks),
+            'malformed': malformed})
+
+    def read(self, batch_id):
+        raise NotImplementedError
+
+    def write(self, batch_id, record):
+        raise NotImplementedError
+
+    def delete(self, batch_id):
+        raise NotImplementedError
+
+
+class GcsCheckpointStore(CheckpointStore):
+
+    """ Stores checkpoints as small JSON objects in a Google Cloud Storage (GCS) bucket of their
+    own, so whoever ingests files needs no rights to modify the event batch files themselves:
+
+    gs://[your Google project id]-analytics-checkpoints-[your environment]/data_type=checkpoint/{batch_id}.json
+
+    This bucket is not covered by any GCS notification, so writing checkpoints does not
+    trigger any further ingestion.
+    """
+
+    def __init__(self, bucket, prefix='data_type=checkpoint'):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_location(self, batch_id):
+        return f'{self.prefix}/{batch_id}.json'
+
+    def read(self, batch_id):
+        blob = self.bucket.get_blob(self.object_location(batch_id))
+        if blob is None:
+            return None
+        return json.loads(blob.download_as_string().decode('utf-8'))
+
+    def write(self, batch_id, record):
+        blob = self.bucket.blob(self.object_location(batch_id))
+        blob.upload_from_string(json.dumps(record), content_type='application/json')
+
+    def delete(self, batch_id):
+        blob = self.bucket.get_blob(self.object_location(batch_id))
+        if blob is not None:
+            blob.delete()
+
+
+class LocalCheckpointStore(CheckpointStore):
+
+    """ A local stand-in for GcsCheckpointStore, used for testing & benchmarking. It keeps
+    checkpoints in memory, or as JSON files within directory whenever one is passed (which
+    allows checkpoints to survive across processes).
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.records = dict()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, batch_id):
+        return os.path.join(self.directory, f'{batch_id}.json')
+
+    def read(self, batch_id):
+        if not self.directory:
+            return self.records.get(batch_id, None)
+        try:
+            with open(self.path(batch_id), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write(self, batch_id, record):
+        if not self.directory:
+            self.records[batch_id] = record
+        else:
+            with open(self.path(batch_id), 'w') as f:
+                json.dump(record, f)
+
+    def delete(self, batch_id):
+        if not self.directory:
+            self.records.pop(batch_id, None)
+        else:
+            try:
+                os.remove(self.path(batch_id))
+            except FileNotFoundError:
+                pass
+
+
+def get_checkpoint_store(client_gcs, store_type=None):
+
+    """ This function returns the checkpoint store to use. The store type is taken from the
+    CHECKPOINT_STORE environment variable unless passed explicitly, and must be one of:
+    {gcs, local}. The GCS store writes to the bucket named CHECKPOINT_BUCKET_NAME, while
+    the local store writes to CHECKPOINT_DIR, which defaults to /tmp/checkpoints.
+    """
+
+    store_type = store_type or os.environ.get('CHECKPOINT_STORE', 'gcs')
+    if store_type == 'gcs':
+        return GcsCheckpointStore(client_gcs.bucket(os.environ['CHECKPOINT_BUCKET_NAME']))
+    elif store_type == 'local':
+        return LocalCheckpointStore(os.environ.get('CHECKPOINT_DIR', '/tmp/checkpoints'))
+    raise ValueError(f'Unknown checkpoint store type: {store_type}!')
@@ -1,68 +1,476 @@
 from __future__ import absolute_import
 from apache_beam.io.gcp import gcsio
-from google.cloud import pubsub_v1
+from apache_beam.metrics import Metrics
+from common.gcs import session_shard_characters, list_gcs_prefix_shard
+from common.functions import format_event_list, generator_split, generator_chunk
+from common.gspath import get_batch_id
+from common.ingest import decode_gcs_file, parse_event_chunk, format_manifest_row
+from common.compaction import is_compacted, is_compaction_index, generate_compaction_chunks, get_compacted_gspath, get_index_gspath, compact_file_contents, \
+    split_compacted_file, format_compaction_row
+from common.quarantine import get_event_digest, get_quarantine_source, parse_received_timestamp, reformat_quarantined_events, format_reprocess_row
+from common.digests import SortedDigestSet
+from common.metrics import beam_histogram_buckets, get_ingestion_lags
+from apache_beam.transforms.window import GlobalWindows
+from apache_beam.transforms.userstate import BagStateSpec, TimerSpec, on_timer
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.coders import VarIntCoder
+from apache_beam.utils.timestamp import Duration
+from collections import deque
+from bisect import bisect_left
 import apache_beam as beam
 import logging
+import json
+import time
+
+
+class BeamHistogram(object):
+
+    """ A histogram with the buckets of common.metrics.beam_histogram_buckets[name], which a Beam step reports through a
+    counter per bucket & a counter of the sum of its values in milliseconds, as Beam distributions do not keep buckets.
+    common.metrics.collect_beam_metrics() reassembles them into a histogram once the pipeline finished.
+    """
+
+    def __init__(self, namespace, name):
+        self.buckets = beam_histogram_buckets[name]
+        self.bucket_counters = [Metrics.counter(namespace, f'{name}_bucket_{index}') for index in range(len(self.buckets) + 1)]
+        self.sum_counter = Metrics.counter(namespace, f'{name}_sum_milliseconds')
+
+    def observe(self, value_list):
+        counts, value_sum = [0] * len(self.bucket_counters), 0.0
+        for value in value_list:
+            counts[bisect_left(self.buckets, value)] += 1
+            value_sum += value
+        for counter, count in zip(self.bucket_counters, counts):
+            if count:
+                counter.inc(count)
+        if value_list:
+            self.sum_counter.inc(int(round(value_sum * 1000)))
 
 
 class GetGcsFileList(beam.DoFn):
 
     """ A custom Beam ParDo to generate a list of files that are present in
-    Google Cloud Storage (GCS). It takes path prefixes as elements (~ arguments).
+    Google Cloud Storage (GCS). It takes (path prefix, shard character) tuples as elements (~ arguments),
+    as generated by common.gcs.generate_gcs_prefix_shards(), so a single busy prefix can be listed
+    by many workers in parallel. Results are paged through & yielded as they come in, instead of
+    first materializing all files matching a prefix in memory.
+
+    Files are listed through gcsio_factory().client, which defaults to gcsio.GcsIO (see common/fakes.py for a local stand-in).
+    Whenever with_size is set, (gspath, size) tuples are yielded instead of gspaths.
+    """
+
+    def __init__(self, shard_characters=session_shard_characters, page_size=1000, gcsio_factory=None, with_size=False):
+        super(GetGcsFileList, self).__init__()
+        self.shard_characters = shard_characters
+        self.page_size = page_size
+        self.gcsio_factory = gcsio_factory or gcsio.GcsIO
+        self.with_size = with_size
+        self.files_listed = Metrics.counter(self.__class__, 'files_listed')
+        self.bytes_listed = Metrics.counter(self.__class__, 'bytes_listed')
+        self.pages_listed = Metrics.counter(self.__class__, 'pages_listed')
+        self.list_milliseconds = Metrics.distribution(self.__class__, 'list_milliseconds')
+
+    def start_bundle(self):
+        self.client = self.gcsio_factory().client
+
+    def process(self, element):
+
+        gspath_prefix, shard_character = element
+        start = time.time()
+        for gspath_size_list in list_gcs_prefix_shard(self.client, gspath_prefix, shard_character, self.shard_characters, self.page_size):
+            self.pages_listed.inc()
+            self.files_listed.inc(len(gspath_size_list))
+            self.bytes_listed.inc(sum(size for _, size in gspath_size_list))
+            for gspath, size in gspath_size_list:
+                yield (gspath, size) if self.with_size else gspath
+        self.list_milliseconds.update(int((time.time() - start) * 1000))
+
+
+class ReadCompactionIndex(beam.DoFn):
+
+    """ A custom Beam ParDo listing the files which were merged into compacted objects (see common/compaction.py). It
+    takes the GCS URI strings of the objects below `data_type=jsonl_compacted` as elements, reads their indexes & yields
+    a (gspath, compacted gspath) tuple per file. Compacted objects themselves are skipped, as an index is only written
+    once its compacted object is complete. Files are read through gcsio_factory(), which defaults to gcsio.GcsIO.
+    """
+
+    def __init__(self, gcsio_factory=None):
+        super(ReadCompactionIndex, self).__init__()
+        self.gcsio_factory = gcsio_factory or gcsio.GcsIO
+        self.objects_listed = Metrics.counter(self.__class__, 'compacted_objects_listed')
+        self.files_listed = Metrics.counter(self.__class__, 'compacted_files_listed')
+
+    def start_bundle(self):
+        self.gcs = self.gcsio_factory()
+
+    def process(self, element):
+
+        index_gspath = element
+        if not is_compaction_index(index_gspath):
+            return
+        with self.gcs.open(index_gspath, mode='rb') as f:
+            index = json.loads(f.read().decode('utf-8'))
+        self.objects_listed.inc()
+        self.files_listed.inc(len(index['files']))
+        for entry in index['files']:
+            yield entry['gspath'], index['compacted_gspath']
+
+
+class ReprocessQuarantinedFile(beam.DoFn):
+
+    """ A custom Beam ParDo reprocessing the objects the endpoint quarantined (see common/quarantine.py), taking their
+    GCS URI strings as elements. The endpoint's current formatter & the usual mapping are applied to their events: rows
+    which can now be ingested are emitted to the main output, with the batch id of the quarantined object. Per object,
+    a `parse_initiated` log is emitted to the `logs` output, its ingestion manifest row to the `manifest` output & a
+    report of how many of its events were recovered (with a sample of what still fails) to the `report` output.
+
+    Whenever the events recovered by an earlier reprocessing are passed as a side input (a set of their digests, see
+    common.quarantine.get_event_digest() & BuildBatchIdSet), only the rows of the other events are emitted, as load jobs
+    do not deduplicate rows by their event ids.
+    """
+
+    def __init__(self, event_schema, analytics_environment, job_name, gcsio_factory=None):
+        super(ReprocessQuarantinedFile, self).__init__()
+        self.event_schema = event_schema
+        self.analytics_environment = analytics_environment
+        self.job_name = job_name
+        self.gcsio_factory = gcsio_factory or gcsio.GcsIO
+        self.files_recovered = Metrics.counter(self.__class__, 'files_recovered')
+        self.files_failed = Metrics.counter(self.__class__, 'files_failed')
+        self.events_recovered = Metrics.counter(self.__class__, 'events_recovered')
+        self.events_failed = Metrics.counter(self.__class__, 'events_failed')
+        self.events_loaded_before = Metrics.counter(self.__class__, 'events_loaded_before')
+
+    def start_bundle(self):
+        self.gcs = self.gcsio_factory()
+
+    def process(self, element, loaded_event_set=None):
+
+        gspath = element
+        batch_id = get_batch_id(gspath)
+        for log in format_event_list(['parse_initiated'], str, self.job_name, gspath):
+            yield beam.pvalue.TaggedOutput('logs', log)
+
+        try:
+            with self.gcs.open(gspath, mode='rb') as f:
+                data = decode_gcs_file(f.read())
+        except Exception as e:
+            # Unknown objects can hold any request body, which is not necessarily text:
+            self.files_failed.inc()
+            yield beam.pvalue.TaggedOutput('report', format_reprocess_row(gspath, self.job_name, 0, [], f'Could not decode the object: {e}'))
+            return
+
+        formatted_list, failed_list = reformat_quarantined_events(
+            data, get_quarantine_source(gspath), self.event_schema, batch_id, self.analytics_environment, parse_received_timestamp(gspath))
+        rows = []
+        if formatted_list:
+            rows, _, malformed_lines, _ = parse_event_chunk([json.dumps(formatted_list)], self.event_schema, self.job_name, batch_id)
+            failed_list.extend(malformed_lines)
+        for row in rows:
+            if loaded_event_set is not None and bytes.fromhex(get_event_digest(batch_id, row['event_id'])) in loaded_event_set:
+                self.events_loaded_before.inc()
+            else:
+                yield row
+
+        self.events_recovered.inc(len(rows))
+        self.events_failed.inc(len(failed_list))
+        (self.files_failed if failed_list else self.files_recovered).inc()
+        yield beam.pvalue.TaggedOutput('manifest', format_manifest_row(gspath, 'malformed' if failed_list else 'ingested', self.job_name))
+        yield beam.pvalue.TaggedOutput('report', format_reprocess_row(gspath, self.job_name, len(rows), failed_list))
+
+
+class BuildBatchIdSet(beam.CombineFn):
+
+    """ A custom Beam CombineFn building an exact set of all batch ids (or other MD5 hexdigests) in a PCollection (see
+    common/digests.py), of 16 bytes per batch id, which can be broadcast to all workers as a side input. Partial
+    results are accumulated as the concatenated digests, so little more than those is shuffled.
+    """
+
+    def create_accumulator(self):
+        return bytearray()
+
+    def add_input(self, accumulator, element):
+        accumulator += bytes.fromhex(element)
+        return accumulator
+
+    def merge_accumulators(self, accumulators):
+        return bytearray(b''.join(accumulators))
+
+    def extract_output(self, accumulator):
+        return SortedDigestSet(bytes(accumulator))
+
+
+class ProbeBatchIdSet(beam.DoFn):
+
+    """ A custom Beam ParDo emitting the (gspath, source) tuples of the files whose batch id is not among the batch ids
+    of the files already ingested, which it takes as a side input (see BuildBatchIdSet). Nothing but the side input
+    is shuffled to subtract the files already ingested.
     """
 
+    def __init__(self):
+        super(ProbeBatchIdSet, self).__init__()
+        self.files_missing = Metrics.counter(self.__class__, 'files_missing')
+        self.files_ingested = Metrics.counter(self.__class__, 'files_ingested')
+
+    def process(self, element, batch_id_set):
+
+        gspath, _ = element
+        if bytes.fromhex(get_batch_id(gspath)) in batch_id_set:
+            self.files_ingested.inc()
+        else:
+            self.files_missing.inc()
+            yield element
+
+
+class ParseGcsFile(beam.DoFn):
+
+    """ A custom Beam ParDo to ingest event batch files within the pipeline, instead of having a Cloud
+    Function ingest each of them. It takes GCS URI strings as elements, reads these files & applies the same
+    mapping to their events as the Cloud Functions do (see common/ingest.py). Rows for native BigQuery storage
+    are emitted to the main output, malformed lines to the `malformed` output, a `parse_initiated` log per
+    file to the `logs` output & its ingestion manifest row to the `manifest` output, all ready to be loaded into BigQuery.
+
+    Compacted objects (see common/compaction.py) are split back into the files they contain, which are parsed as if
+    they were read individually. Elements may also be (GCS URI, [GCS URI of a file to parse, ..]) tuples, of which only
+    the listed files within a compacted object are parsed. Files are read through gcsio_factory(), which defaults to gcsio.GcsIO.
+    """
+
+    def __init__(self, event_schema, job_name, chunk_size=1000, gcsio_factory=None):
+        super(ParseGcsFile, self).__init__()
+        self.event_schema = event_schema
+        self.job_name = job_name
+        self.chunk_size = chunk_size
+        self.gcsio_factory = gcsio_factory or gcsio.GcsIO
+        self.files_parsed = Metrics.counter(self.__class__, 'files_parsed')
+        self.rows_parsed = Metrics.counter(self.__class__, 'rows_parsed')
+        self.lines_malformed = Metrics.counter(self.__class__, 'lines_malformed')
+        # The lag between receiving an event & parsing it here, from right before it is loaded:
+        self.ingestion_lag = BeamHistogram(self.__class__, 'ingestion_lag_seconds')
+
+    def start_bundle(self):
+        self.gcs = self.gcsio_factory()
+
     def process(self, element):
 
-        gspath_prefix = element
-        dict_gspath_size = gcsio.GcsIO().list_prefix(gspath_prefix)
-        gspath_list = dict_gspath_size.keys()
+        gspath, gspath_list = element if isinstance(element, tuple) else (element, None)
+        with self.gcs.open(gspath, mode='rb') as f:
+            data = decode_gcs_file(f.read())
+
+        if is_compacted(gspath):
+            with self.gcs.open(get_index_gspath(gspath), mode='rb') as f:
+                index = json.loads(f.read().decode('utf-8'))
+            gspath_set = set(gspath_list) if gspath_list is not None else None
+            for original_gspath, original_data in split_compacted_file(data, index):
+                if gspath_set is None or original_gspath in gspath_set:
+                    for output in self.parse_file(original_gspath, original_data):
+                        yield output
+        else:
+            for output in self.parse_file(gspath, data):
+                yield output
+
+    def parse_file(self, gspath, data):
+        batch_id = get_batch_id(gspath)
+        for log in format_event_list(['parse_initiated'], str, self.job_name, gspath):
+            yield beam.pvalue.TaggedOutput('logs', log)
+
+        malformed = False
+        for chunk_offset, chunk in enumerate(generator_chunk(generator_split(data, '\n'), self.chunk_size)):
+            rows, _, malformed_lines, _ = parse_event_chunk(chunk, self.event_schema, self.job_name, batch_id, chunk_offset)
+            self.rows_parsed.inc(len(rows))
+            self.ingestion_lag.observe(get_ingestion_lags(rows))
+            self.lines_malformed.inc(len(malformed_lines))
+            malformed = malformed or len(malformed_lines) > 0
+            # Nested event_attributes were already encoded into strings, as load jobs (unlike streaming inserts) do not accept JSON objects for STRING fields:
+            for row in rows:
+                yield row
+            for debug_row in format_event_list(malformed_lines, str, self.job_name, gspath):
+                yield beam.pvalue.TaggedOutput('malformed', debug_row)
+
+        yield beam.pvalue.TaggedOutput('manifest', format_manifest_row(gspath, 'malformed' if malformed else 'ingested', self.job_name))
+        self.files_parsed.inc()
+
+
+class CompactGcsFiles(beam.DoFn):
+
+    """ A custom Beam ParDo merging the small event batch files of a partition into a few large objects (see
+    common/compaction.py). It takes ((bucket, partition path, shard), [(gspath, size), ..]) tuples as elements,
+    writes every chunk of at most max_bytes as a compacted object alongside its index, and emits a compaction
+    manifest row per file merged. Whenever delete_originals is set, files are deleted once their compacted
+    object & index are written, though only those which the ingestion manifest records as ingested: their batch
+    ids are passed as a side input (see BuildBatchIdSet). Every other file is kept, so it can still be backfilled.
+
+    The index is written last, so its existence marks a complete compacted object: a retried element skips
+    chunks which were already compacted (whose files may already be deleted) & only re-emits their rows.
+    """
+
+    def __init__(self, job_name, max_bytes=128 * 1024 * 1024, delete_originals=False, gcsio_factory=None):
+        super(CompactGcsFiles, self).__init__()
+        self.job_name = job_name
+        self.max_bytes = max_bytes
+        self.delete_originals = delete_originals
+        self.gcsio_factory = gcsio_factory or gcsio.GcsIO
+        self.files_compacted = Metrics.counter(self.__class__, 'files_compacted')
+        self.objects_written = Metrics.counter(self.__class__, 'objects_written')
+        self.bytes_written = Metrics.counter(self.__class__, 'bytes_written')
+        self.files_deleted = Metrics.counter(self.__class__, 'files_deleted')
+        self.files_not_ingested = Metrics.counter(self.__class__, 'files_not_ingested')
+
+    def start_bundle(self):
+        self.gcs = self.gcsio_factory()
 
-        for gspath in gspath_list:
-            yield gspath
+    def process(self, element, ingested_batch_id_set=None):
 
+        (bucket, partition, _), gspath_size_list = element
+        for gspath_list in generate_compaction_chunks(gspath_size_list, self.max_bytes):
+            compacted_gspath = get_compacted_gspath(bucket, partition, gspath_list)
+            index_gspath = get_index_gspath(compacted_gspath)
+            if self.gcs.exists(index_gspath):
+                with self.gcs.open(index_gspath, mode='rb') as f:
+                    index = json.loads(f.read().decode('utf-8'))
+            else:
+                gspath_data_list = []
+                for gspath in gspath_list:
+                    with self.gcs.open(gspath, mode='rb') as f:
+                        gspath_data_list.append((gspath, decode_gcs_file(f.read())))
+                data, index = compact_file_contents(gspath_data_list, compacted_gspath, self.job_name)
+                data = data.encode('utf-8')
+                with self.gcs.open(compacted_gspath, mode='wb', mime_type='application/json') as f:
+                    f.write(data)
+                with self.gcs.open(index_gspath, mode='wb', mime_type='application/json') as f:
+                    f.write(json.dumps(index).encode('utf-8'))
+                self.objects_written.inc()
+                self.bytes_written.inc(len(data))
+                self.files_compacted.inc(len(gspath_list))
 
-class WriteToPubSub(beam.DoFn):
+            for entry in index['files']:
+                yield format_compaction_row(entry, compacted_gspath, self.job_name)
+
+            if self.delete_originals:
+                # Files which were never ingested (e.g. as their Cloud Function failed) are only recoverable as long as they exist:
+                delete_list = [gspath for gspath in gspath_list if ingested_batch_id_set is not None and bytes.fromhex(get_batch_id(gspath)) in ingested_batch_id_set]
+                self.files_not_ingested.inc(len(gspath_list) - len(delete_list))
+                # GCS accepts at most 100 deletions per batch request:
+                for offset in range(0, len(delete_list), 100):
+                    for gspath, error in self.gcs.delete_batch(delete_list[offset:offset + 100]):
+                        if error is None:
+                            self.files_deleted.inc()
+                        else:
+                            logging.warning('Could not delete {gspath}: {error}'.format(gspath=gspath, error=error))
+
+
+class DeduplicateFiles(beam.DoFn):
+
+    """ A custom stateful Beam ParDo dropping redelivered notifications of the streaming pipeline. It takes (batch id,
+    GCS URI) tuples as elements & emits a GCS URI only the first time its batch id is seen within ttl_seconds (of
+    element time, which is the publish time of Pub/Sub messages). Every row of a file derives from its contents, so
+    this drops the duplicate events (& their duplicate event ids) a file parsed twice would insert, while keeping a
+    single state cell per file rather than per event. State is cleared by a timer once ttl_seconds passed.
+    """
+
+    SEEN_STATE = BagStateSpec('seen', VarIntCoder())
+    EXPIRY_TIMER = TimerSpec('expiry', TimeDomain.WATERMARK)
+
+    def __init__(self, ttl_seconds=24 * 3600):
+        super(DeduplicateFiles, self).__init__()
+        self.ttl_seconds = ttl_seconds
+        self.files_duplicate = Metrics.counter(self.__class__, 'files_duplicate')
+
+    def process(self, element, timestamp=beam.DoFn.TimestampParam, seen=beam.DoFn.StateParam(SEEN_STATE), expiry=beam.DoFn.TimerParam(EXPIRY_TIMER)):
+
+        _, gspath = element
+        if any(seen.read()):
+            self.files_duplicate.inc()
+            return
+        seen.add(1)
+        expiry.set(timestamp + Duration(seconds=self.ttl_seconds))
+        yield gspath
+
+    @on_timer(EXPIRY_TIMER)
+    def expire(self, seen=beam.DoFn.StateParam(SEEN_STATE)):
+        seen.clear()
+
+
+class PublishToPubSub(beam.DoFn):
 
     """ A custom Beam ParDo to notify a Pub/Sub Topic about the existence of files
-    in Google Cloud Storage (GCS).
+    in Google Cloud Storage (GCS). It takes GCS URI strings as elements, which it parses
+    by extracting the file name & bucket name, which it subsequently uses as the payload
+    for a Pub/Sub message to a particular Pub/Sub Topic.
+
+    Messages are batched by the publisher client (max_messages, max_bytes & max_latency), while at
+    most max_outstanding messages are in flight at once. All publish results are awaited before a
+    bundle finishes, so no failure is lost silently. Transient errors are retried by the publisher
+    client itself, but bundles are not: GCS URIs which still failed to publish are emitted to the
+    `failed` output (which the backfill logs as `publish_failed`), every other element is not
+    emitted at all.
 
-    It first reads GCS URI strings from a fileList stored in GCS, which should have happened in a
-    prior step. It then parses these GCS URIs by extracting the file name & bucket name, which it subsequently
-    uses as the payload for a Pub/Sub message to a particular Pub/Sub Topic.
+    Whenever a publisher_factory is passed, the publisher client it returns is used instead of
+    pubsub_v1.PublisherClient (see common/fakes.py for an in-memory stand-in).
     """
 
-    def process(self, element, job_name, topic, gcp, gcs_bucket):
+    def __init__(self, gcp, topic, max_messages=1000, max_bytes=1024 * 1024, max_latency=0.05, max_outstanding=10000, publisher_factory=None):
+        super(PublishToPubSub, self).__init__()
+        self.gcp = gcp
+        self.topic = topic
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.max_outstanding = max_outstanding
+        self.publisher_factory = publisher_factory
+        self.files_published = Metrics.counter(self.__class__, 'files_published')
+        self.files_failed = Metrics.counter(self.__class__, 'files_failed')
+        self.outstanding_waits = Metrics.counter(self.__class__, 'outstanding_waits')
 
-        gcs = gcsio.GcsIO()
-        prefix = 'gs://{gcs_bucket}/data_type=dataflow/batch/output/{job_name}/parselist'.format(gcs_bucket=gcs_bucket, job_name=job_name)
-        dict_file_path_size = gcs.list_prefix(prefix)
-        gspath_lists = dict_file_path_size.keys()
+    def setup(self):
+        if self.publisher_factory is not None:
+            self.client_ps = self.publisher_factory()
+        else:
+            from google.cloud import pubsub_v1
 
-        # https://cloud.google.com/pubsub/docs/publisher#pubsub-publish-message-python
-        client_ps = pubsub_v1.PublisherClient(
-          batch_settings = pubsub_v1.types.BatchSettings(max_messages=1000, max_bytes=5120)
-          )
-        topic = client_ps.topic_path(gcp, topic)
+            # https://cloud.google.com/pubsub/docs/publisher#pubsub-publish-message-python
+            self.client_ps = pubsub_v1.PublisherClient(
+                batch_settings=pubsub_v1.types.BatchSettings(max_messages=self.max_messages, max_bytes=self.max_bytes, max_latency=self.max_latency))
+        self.topic_path = self.client_ps.topic_path(self.gcp, self.topic)
 
-        for gspath_list in gspath_lists:
+    def start_bundle(self):
+        self.futures = deque()
 
-            try:
-                gspath_list_open = gcs.open(filename=gspath_list, mode='r').read().decode('utf-8').split('\n')
-                # With each **file** written into GCS by beam.io.WriteToText(), a PDone is returned & WriteToPubSub() is triggered,
-                # so we first remove this file from GCS to avoid duplicative results:
-                gcs.delete(path=gspath_list)
-
-                # Example GCS URI:
-                # gs://your-project-name-analytics/data_type=json/analytics_environment=function/event_category=scale-test/event_ds=2019-06-26/event_time=8-16/f58179a375290599dde17f7c6d546d78/2019-06-26T14:28:32Z-107087
-
-                for gspath in gspath_list_open:
-                    gspath_formatted = gspath.split("gs://", 1).pop().split('/')
-                    bucket_name, object_location = gspath_formatted[0], '/'.join(gspath_formatted[1:])
-                    if bucket_name and object_location:
-                        data = '{"bucket":"%s","name":"%s"}' % (bucket_name, object_location)
-                        future = client_ps.publish(topic, data=data.encode('utf-8'))
-                        yield (topic, data)
+    def resolve_futures(self, max_outstanding):
 
+        """ Waits for the oldest publish results until at most max_outstanding are left, yielding the GCS URIs which failed.
+        """
+
+        if len(self.futures) > max_outstanding:
+            self.outstanding_waits.inc()
+        while len(self.futures) > max_outstanding:
+            gspath, future = self.futures.popleft()
+            try:
+                future.result()
+                self.files_published.inc()
             except Exception as e:
-                logging.warning('Could not parse {gspath_list}: {e}'.format(gspath_list=gspath_list, e=e))
-                continue
+                self.files_failed.inc()
+                logging.warning('Could not publish {gspath}: {e}'.format(gspath=gspath, e=e))
+                yield gspath
+
+    def process(self, element):
+
+        # Example GCS URI:
+        # gs://your-project-name-analytics/data_type=json/analytics_environment=function/event_category=scale-test/event_ds=2019-06-26/event_time=8-16/f58179a375290599dde17f7c6d546d78/2019-06-26T14:28:32Z-107087
+
+        gspath = element
+        gspath_formatted = gspath.split("gs://", 1).pop().split('/')
+        bucket_name, object_location = gspath_formatted[0], '/'.join(gspath_formatted[1:])
+        if bucket_name and object_location:
+            data = json.dumps({'bucket': bucket_name, 'name': object_location})
+            self.futures.append((gspath, self.client_ps.publish(self.topic_path, data=data.encode('utf-8'))))
+        else:
+            logging.warning('Could not parse {gspath}'.format(gspath=gspath))
+            self.files_failed.inc()
+            yield beam.pvalue.TaggedOutput('failed', gspath)
+
+        for failed_gspath in self.resolve_futures(self.max_outstanding):
+            yield beam.pvalue.TaggedOutput('failed', failed_gspath)
+
+    def finish_bundle(self):
+        for failed_gspath in self.resolve_futures(0):
+            yield beam.pvalue.TaggedOutput('failed', GlobalWindows.windowed_value(failed_gspath))
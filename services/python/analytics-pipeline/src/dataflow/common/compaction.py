@@ -0,0 +1,122 @@
+from common.functions import format_event_list
+from common.gspath import decode_gspath, get_batch_id
+
+import hashlib
+
+# Compacted objects are written below their own data_type, so GCS notifications do not pick them up as new files, while
+# the backfill only reads them whenever it is asked to (see --read-compacted of p1_gcs_to_bq_backfill.py):
+compacted_data_type = 'jsonl_compacted'
+
+
+def get_partition(gspath):
+
+    """ This function returns the (bucket, partition path) of a gspath, or None if it does not contain an `event_time=` partition.
+    """
+
+    path = decode_gspath(gspath)
+    if path.event_time is None or path.data_type is None:
+        return None
+    return path.bucket, path.partition
+
+
+def is_compacted(gspath):
+    return decode_gspath(gspath).data_type == compacted_data_type and gspath.endswith('.jsonl')
+
+
+def is_compaction_index(gspath):
+    return decode_gspath(gspath).data_type == compacted_data_type and gspath.endswith('.index.json')
+
+
+def select_file_source(source_list):
+
+    """ This function returns the compacted object a file is read from, given the sources (compacted gspaths, or None
+    for the file itself) it was listed with. Files left over next to the compacted object they were merged into are
+    read from the latter, which is read once for all of its files.
+    """
+
+    return next((source for source in source_list if source is not None), None)
+
+
+def generate_compaction_chunks(gspath_size_list, max_bytes):
+
+    """ This function splits the (gspath, size) tuples of a partition into lists of gspaths which are compacted into
+    a single object each, of at most max_bytes (unless a single file is larger). Files are sorted first, so the same
+    files always result in the same chunks.
+    """
+
+    chunk, chunk_bytes = [], 0
+    for gspath, size in sorted(gspath_size_list):
+        if chunk and chunk_bytes + size > max_bytes:
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(gspath)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def get_compacted_gspath(bucket, partition, gspath_list):
+
+    """ This function returns the gspath of the object gspath_list is compacted into, which is derived from
+    the files it contains. A retried compaction of the same files thereby finds the object it wrote before.
+    """
+
+    digest = hashlib.md5('\n'.join(gspath_list).encode('utf-8')).hexdigest()
+    return str(decode_gspath(f'gs://{bucket}/{partition}').replace(data_type=compacted_data_type, suffix=f'{digest}.jsonl'))
+
+
+def get_index_gspath(compacted_gspath):
+
+    """ This function returns the gspath of the index of a compacted object (see compact_file_contents()).
+    """
+
+    return compacted_gspath[:-len('.jsonl')] + '.index.json'
+
+
+def compact_file_contents(gspath_data_list, compacted_gspath, job_name):
+
+    """ This function concatenates the decoded contents of event batch files, given as a list of (gspath, data)
+    tuples, into the contents of a single compacted object. The lines of every file are kept verbatim, so each
+    file can be restored from the compacted object exactly (see split_compacted_file()). Trailing newlines are
+    dropped, as they do not contain events & do not shift the offsets of the lines before them.
+
+    It returns (data, index), of which the index maps every file (& its batch id) to the lines it occupies.
+    """
+
+    segments, files, line_offset = [], [], 0
+    for gspath, data in gspath_data_list:
+        data = data.rstrip('\n')
+        line_count = data.count('\n') + 1
+        segments.append(data)
+        files.append({
+            'gspath': gspath,
+            'batch_id': get_batch_id(gspath),
+            'line_offset': line_offset,
+            'line_count': line_count})
+        line_offset += line_count
+    return '\n'.join(segments), {'compacted_gspath': compacted_gspath, 'job_name': job_name, 'files': files}
+
+
+def split_compacted_file(data, index):
+
+    """ This function restores the files a compacted object contains, yielding a (gspath, data) tuple per file.
+    Parsing these yields the same batch ids & row ids as parsing the original files did.
+    """
+
+    lines = data.split('\n')
+    for entry in index['files']:
+        yield entry['gspath'], '\n'.join(lines[entry['line_offset']:entry['line_offset'] + entry['line_count']])
+
+
+def format_compaction_row(entry, compacted_gspath, job_name):
+
+    """ This function formats the compaction manifest row of a file (an entry of a compacted object's index),
+    which maps the original file & its batch id to the compacted object it was merged into.
+    """
+
+    row = format_event_list(['compacted'], str, job_name, entry['gspath'])[0]
+    row.pop('event')
+    row['compacted_gspath'] = compacted_gspath
+    row['line_offset'] = entry['line_offset']
+    row['line_count'] = entry['line_count']
+    return row
@@ -0,0 +1,39 @@
+from array import array
+
+
+class SortedDigestSet(object):
+
+    """ An exact, compact set of fixed-width digests (such as the 16 bytes of a batch id), which are stored
+    back to back in a single sorted bytes object. The offset at which every 2-byte prefix starts is indexed,
+    so membership tests only binary search the few digests sharing the prefix of the one looked up.
+    """
+
+    def __init__(self, data=b'', width=16):
+        self.width = width
+        digest_list = sorted(set(data[offset:offset + width] for offset in range(0, len(data) - len(data) % width, width)))
+        self.data = b''.join(digest_list)
+        self.count = len(digest_list)
+        offsets = array('L', [0]) * (2 ** 16 + 1)
+        for digest in digest_list:
+            offsets[(digest[0] << 8 | digest[1]) + 1] += 1
+        for prefix in range(2 ** 16):
+            offsets[prefix + 1] += offsets[prefix]
+        self.offsets = offsets
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        data, width = self.data, self.width
+        prefix = digest[0] << 8 | digest[1]
+        low, high = self.offsets[prefix], self.offsets[prefix + 1]
+        while low < high:
+            middle = (low + high) // 2
+            value = data[middle * width:(middle + 1) * width]
+            if value < digest:
+                low = middle + 1
+            elif value > digest:
+                high = middle
+            else:
+                return True
+        return False
@@ -0,0 +1,421 @@
+from concurrent.futures import Future
+from collections import deque
+
+import itertools
+import gzip
+import random
+import time
+import os
+
+
+class FakeBlob(object):
+
+    """ An in-memory stand-in for google.cloud.storage.Blob.
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_encoding = None
+        self.content_type = None
+
+    def exists(self):
+        self.bucket.client.wait()
+        return self.name in self.bucket.objects
+
+    def download_as_string(self):
+        self.bucket.client.wait()
+        try:
+            data = self.bucket.objects[self.name]
+        except KeyError:
+            raise FileNotFoundError(f'gs://{self.bucket.name}/{self.name}')
+        # Objects uploaded with `Content-Encoding: gzip` are served decompressed (decompressive transcoding):
+        if self.bucket.content_encodings.get(self.name, None) == 'gzip':
+            return gzip.decompress(data)
+        return data
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.client.wait()
+        self.content_type = content_type
+        self.bucket.objects[self.name] = data.encode('utf-8') if isinstance(data, str) else data
+        self.bucket.content_encodings[self.name] = self.content_encoding
+        # Mimics an OBJECT_FINALIZE notification of the bucket:
+        if self.bucket.client.notify is not None:
+            self.bucket.client.notify(self.bucket.name, self.name)
+
+    def delete(self):
+        self.bucket.client.wait()
+        self.bucket.objects.pop(self.name, None)
+        self.bucket.content_encodings.pop(self.name, None)
+
+
+class FakeBucket(object):
+
+    """ An in-memory stand-in for google.cloud.storage.Bucket. Objects are kept as a
+    dictionary of {object_location: bytes}.
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.objects = dict()
+        self.content_encodings = dict()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        self.client.wait()
+        if name in self.objects:
+            return FakeBlob(self, name)
+        return None
+
+    def list_blobs(self, prefix=''):
+        self.client.wait()
+        return [FakeBlob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+class FakeStorageClient(object):
+
+    """ An in-memory stand-in for google.cloud.storage.Client. Every call which would
+    result in an API request sleeps for latency seconds, to mimic network round-trips.
+    Whenever notify is passed, it is called with (bucket_name, object_location) after every upload.
+    """
+
+    def __init__(self, latency=0.0, notify=None):
+        self.latency = latency
+        self.notify = notify
+        self.buckets = dict()
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def bucket(self, bucket_name):
+        if bucket_name not in self.buckets:
+            self.buckets[bucket_name] = FakeBucket(self, bucket_name)
+        return self.buckets[bucket_name]
+
+    def get_bucket(self, bucket_name):
+        self.wait()
+        return self.bucket(bucket_name)
+
+
+class FakeTableReference(object):
+
+    """ A stand-in for google.cloud.bigquery.TableReference.
+    """
+
+    def __init__(self, dataset_id, table_id):
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.clustering_fields = None
+        self.time_partitioning = None
+        self.schema = []
+
+    def __repr__(self):
+        return f'{self.dataset_id}.{self.table_id}'
+
+
+class FakeDatasetReference(object):
+
+    """ A stand-in for google.cloud.bigquery.DatasetReference.
+    """
+
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return FakeTableReference(self.dataset_id, table_id)
+
+
+class FakeBigQueryClient(object):
+
+    """ An in-memory stand-in for google.cloud.bigquery.Client. Tables are created on first
+    access and rows inserted into them are kept as {'dataset.table': [row, ..]}.
+
+    Row ids passed to insert_rows() are deduplicated the way BigQuery does on a best-effort
+    basis, which allows verifying redelivery behaviour. Whenever fail_tables contains a table id,
+    inserts into that table return errors instead.
+    """
+
+    def __init__(self, latency=0.0, fail_tables=None):
+        self.latency = latency
+        self.fail_tables = set(fail_tables or [])
+        self.rows = dict()
+        self.row_ids = dict()
+        self.tables = dict()
+        self.updated_fields = []
+        self.insert_requests = 0
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def dataset(self, dataset_id):
+        return FakeDatasetReference(dataset_id)
+
+    def get_dataset(self, dataset_ref):
+        self.wait()
+        return dataset_ref
+
+    def get_table(self, table_ref):
+        self.wait()
+        self.rows.setdefault(repr(table_ref), [])
+        self.row_ids.setdefault(repr(table_ref), set())
+        return self.tables.setdefault(repr(table_ref), table_ref)
+
+    def update_table(self, table, fields):
+        self.wait()
+        self.updated_fields.extend(fields)
+        return table
+
+    def insert_rows(self, table, rows, row_ids=None):
+        self.wait()
+        self.insert_requests += 1
+        table_id = repr(table)
+        if table_id in self.fail_tables or table.table_id in self.fail_tables:
+            return [{'index': index, 'errors': ['Fake insertion failure.']} for index in range(len(rows))]
+        table_rows, table_row_ids = self.rows.setdefault(table_id, []), self.row_ids.setdefault(table_id, set())
+        for index, row in enumerate(rows):
+            row_id = row_ids[index] if row_ids else None
+            if row_id is not None:
+                if row_id in table_row_ids:
+                    continue
+                table_row_ids.add(row_id)
+            table_rows.append(row)
+        return []
+
+
+class FakePubsubMessage(object):
+
+    """ A stand-in for google.cloud.pubsub_v1.types.PubsubMessage.
+    """
+
+    def __init__(self, data, message_id, attributes=None):
+        self.data = data
+        self.message_id = message_id
+        self.attributes = attributes or dict()
+
+
+class FakeReceivedMessage(object):
+
+    """ A stand-in for google.cloud.pubsub_v1.types.ReceivedMessage.
+    """
+
+    def __init__(self, ack_id, message):
+        self.ack_id = ack_id
+        self.message = message
+
+
+class FakePullResponse(object):
+
+    """ A stand-in for google.cloud.pubsub_v1.types.PullResponse.
+    """
+
+    def __init__(self, received_messages):
+        self.received_messages = received_messages
+
+
+class FakeSubscriberClient(object):
+
+    """ An in-memory stand-in for google.cloud.pubsub_v1.SubscriberClient, supporting synchronous
+    pull. Messages are added with enqueue(); messages which are nack'ed (i.e. their ack deadline
+    is modified to 0) are redelivered on a subsequent pull.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.queue = deque()
+        self.outstanding = dict()
+        self.acknowledged = []
+        self.delivery_count = dict()
+        self.ids = itertools.count()
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def subscription_path(self, project, subscription):
+        return f'projects/{project}/subscriptions/{subscription}'
+
+    def enqueue(self, data, attributes=None):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.queue.append(FakePubsubMessage(data, str(next(self.ids)), attributes))
+
+    def pull(self, subscription, max_messages, return_immediately=None):
+        self.wait()
+        received_messages = []
+        while self.queue and len(received_messages) < max_messages:
+            message = self.queue.popleft()
+            ack_id = f'ack-{next(self.ids)}'
+            self.outstanding[ack_id] = message
+            self.delivery_count[message.message_id] = self.delivery_count.get(message.message_id, 0) + 1
+            received_messages.append(FakeReceivedMessage(ack_id, message))
+        return FakePullResponse(received_messages)
+
+    def acknowledge(self, subscription, ack_ids):
+        self.wait()
+        for ack_id in ack_ids:
+            message = self.outstanding.pop(ack_id, None)
+            if message is not None:
+                self.acknowledged.append(message)
+
+    def modify_ack_deadline(self, subscription, ack_ids, ack_deadline_seconds):
+        self.wait()
+        if ack_deadline_seconds == 0:
+            for ack_id in ack_ids:
+                message = self.outstanding.pop(ack_id, None)
+                if message is not None:
+                    self.queue.append(message)
+
+
+class FakeStorageObject(object):
+
+    """ A stand-in for the apitools storage Object, as returned when listing objects.
+    """
+
+    def __init__(self, bucket, name, size):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+
+
+class FakeStorageObjectsListResponse(object):
+
+    """ A stand-in for the apitools storage Objects list response.
+    """
+
+    def __init__(self, items, prefixes, nextPageToken=None):
+        self.items = items
+        self.prefixes = prefixes
+        self.nextPageToken = nextPageToken
+
+
+class FakeStorageObjects(object):
+
+    """ A stand-in for the `objects` service of the apitools storage client (gcsio.GcsIO().client), which
+    lists a local directory laid out as {root}/{bucket}/{object location}. Only List() is supported; the
+    listing of a request is cached, so subsequent pages of it do not walk the directory again.
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+        self.listings = dict()
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def walk(self, bucket, prefix, delimiter):
+        bucket_root = os.path.join(self.root, bucket)
+        # Only walk the deepest directory the prefix is fully within:
+        names = []
+        for directory, _, file_names in os.walk(os.path.join(bucket_root, os.path.dirname(prefix))):
+            for file_name in file_names:
+                name = os.path.relpath(os.path.join(directory, file_name), bucket_root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append((name, os.path.getsize(os.path.join(directory, file_name))))
+
+        # Objects nested below the delimiter are rolled up into a single prefix, which GCS returns alongside objects:
+        entries, prefixes = [], set()
+        for name, size in sorted(names):
+            if delimiter and delimiter in name[len(prefix):]:
+                nested_prefix = name[:name.index(delimiter, len(prefix)) + len(delimiter)]
+                if nested_prefix not in prefixes:
+                    prefixes.add(nested_prefix)
+                    entries.append((nested_prefix, None))
+            else:
+                entries.append((name, size))
+        return entries
+
+    def List(self, request):
+        self.wait()
+        key = (request.bucket, request.prefix or '', request.delimiter)
+        if key not in self.listings:
+            self.listings[key] = self.walk(*key)
+        entries = self.listings[key]
+
+        offset = int(request.pageToken or 0)
+        page = entries[offset:offset + (request.maxResults or 1000)]
+        next_offset = offset + len(page)
+        return FakeStorageObjectsListResponse(
+            [FakeStorageObject(request.bucket, name, size) for name, size in page if size is not None],
+            [name for name, size in page if size is None],
+            str(next_offset) if next_offset < len(entries) else None)
+
+
+class FakeStorageApiClient(object):
+
+    """ A local stand-in for the apitools storage client, see FakeStorageObjects.
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.objects = FakeStorageObjects(root, latency)
+
+
+class FakeGcsIO(object):
+
+    """ A local stand-in for apache_beam.io.gcp.gcsio.GcsIO, backed by a directory laid out
+    as {root}/{bucket}/{object location}, which allows running pipelines that list & read
+    files in GCS without a project.
+    """
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.client = FakeStorageApiClient(root, latency)
+
+    def local_path(self, gspath):
+        return os.path.join(self.root, *gspath.split('gs://', 1).pop().split('/'))
+
+    def open(self, gspath, mode='rb', mime_type=None):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.local_path(gspath)), exist_ok=True)
+        return open(self.local_path(gspath), mode)
+
+    def exists(self, gspath):
+        return os.path.isfile(self.local_path(gspath))
+
+    def delete_batch(self, gspath_list):
+        result = []
+        for gspath in gspath_list:
+            # Like GcsIO, objects which do not exist (anymore) count as deleted:
+            try:
+                if os.path.exists(self.local_path(gspath)):
+                    os.remove(self.local_path(gspath))
+                result.append((gspath, None))
+            except OSError as e:
+                result.append((gspath, e))
+        return result
+
+    def write(self, gspath, data):
+        path = self.local_path(gspath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+
+class FakePublisherClient(object):
+
+    """ An in-memory stand-in for google.cloud.pubsub_v1.PublisherClient. publish() returns an already
+    resolved future, which raises instead for roughly fail_rate of all messages.
+    """
+
+    def __init__(self, fail_rate=0.0):
+        self.fail_rate = fail_rate
+        self.messages = []
+        self.ids = itertools.count()
+
+    def topic_path(self, project, topic):
+        return f'projects/{project}/topics/{topic}'
+
+    def publish(self, topic, data, **attributes):
+        future = Future()
+        if self.fail_rate and random.random() < self.fail_rate:
+            future.set_exception(Exception('Fake publish failure.'))
+        else:
+            self.messages.append((topic, data))
+            future.set_result(str(next(self.ids)))
+        return future
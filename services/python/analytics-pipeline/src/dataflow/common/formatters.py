@@ -0,0 +1 @@
+../../endpoint/common/functions.py
\ No newline at end of file
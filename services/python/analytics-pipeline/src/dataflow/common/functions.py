@@ -1,7 +1,9 @@
+from common.gspath import gspath_partition_keys, decode_gspath, encode_gspath, get_batch_id
 from itertools import chain, islice
+from functools import lru_cache
 
 import datetime
-import hashlib
+import calendar
 import json
 import time
 import gzip
@@ -53,7 +55,7 @@ def generate_date_range(ds_start, ds_stop):
             raise ValueError('No valid date(s) passed to generate_date_range()!')
 
 
-def generate_gcs_file_list(bucket_name, event_schema, event_environment, category_list, ds_start, ds_stop, time_part_list, scale_test_name=''):
+def generate_gcs_file_list(bucket_name, event_schema, event_environment, category_list, ds_start, ds_stop, time_part_list, scale_test_name='', data_type='jsonl'):
 
     """ This function generates a list of gspath prefixes, which we can subsequently use to retrieve all files matching them.
     Note that None values are parsed as empty strings ('').
@@ -62,7 +64,37 @@ def generate_gcs_file_list(bucket_name, event_schema, event_environment, categor
     for category in category_list:
         for ds in generate_date_range(ds_start, ds_stop):
             for time_part in time_part_list:
-                yield f"gs://{bucket_name}/data_type=jsonl/event_schema={event_schema}/event_category={category or ''}/event_environment={event_environment or ''}/event_ds={ds or ''}/event_time={time_part or ''}/{scale_test_name or ''}"
+                yield encode_gspath(bucket_name, data_type, event_schema, category, event_environment, ds, time_part, scale_test_name)
+
+
+def read_watermark(path, key):
+
+    """ This function reads the watermark stored under key from a local JSON file, which is the last
+    event_ds a previous (incremental) backfill completed. It returns None if there is no watermark yet.
+    """
+
+    try:
+        with open(path) as f:
+            return json.load(f).get(key, None)
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(path, key, event_ds):
+
+    """ This function stores event_ds as the watermark under key in a local JSON file, unless a later
+    watermark is already stored. Watermarks of other keys within the file are left untouched.
+    """
+
+    try:
+        with open(path) as f:
+            watermark_dict = json.load(f)
+    except FileNotFoundError:
+        watermark_dict = dict()
+    if watermark_dict.get(key, '') < event_ds:
+        watermark_dict[key] = event_ds
+        with open(path, 'w') as f:
+            json.dump(watermark_dict, f, indent=2, sort_keys=True)
 
 
 def parse_gspath(path, key):
@@ -75,6 +107,9 @@ def parse_gspath(path, key):
     When for instance passing the above path & 'data_type=' as the key it will return its value 'json'.
     """
 
+    # Partitions of the bucket's layout are decoded (once per path) by the codec in common/gspath.py:
+    if key.rstrip('=') in gspath_partition_keys:
+        return decode_gspath(path).to_dict([key.rstrip('=')])[key.rstrip('=')]
     try:
         # Try to split the path by key (indexing to 1 will fail if key not present in path):
         value = path.split(key)[1].split('/')[0]
@@ -178,36 +213,132 @@ def get_dict_value(event_dict, *argv):
     return None
 
 
-def cast_to_unix_timestamp(timestamp, timestamp_format_list):
+# Timestamp formats with a fixed layout, which we parse by slicing instead of with strptime():
+# {format: (separator between date & time, whether it has a fraction, accepted suffixes)}
+fixed_layout_timestamp_formats = {
+    '%Y-%m-%dT%H:%M:%SZ': ('T', False, ('Z',)),
+    '%Y-%m-%d %H:%M:%S %Z': (' ', False, (' UTC', ' GMT')),
+    '%Y-%m-%dT%H:%M:%S.%f': ('T', True, ('',)),
+    '%Y-%m-%dT%H:%M:%S.%fZ': ('T', True, ('Z',)),
+}
 
-    """ This function takes a timestamp and ensures a unix timestamp is returned,
-    or None otherwise.
 
-    An integer or float is returned as-is, whereas a timestamp in human readable
-    string format is parsed using the provided timestamp format(s), verified to
-    be valid & finally converted into a unix timestamp & returned.
+@lru_cache(maxsize=4096)
+def days_since_epoch(date):
+
+    """ This function converts a date string (yyyy-mm-dd) into the number of days since
+    1970-01-01, or None if it is not a valid date. Events within a batch mostly share
+    the same date, which is why its results are cached.
     """
 
-    # Check whether string timestamp is actually float/int:
     try:
-        timestamp = float(timestamp)
-    except (ValueError, TypeError):
-        pass
-
-    # If timestamp is already in unix time, return as-is:
-    if isinstance(timestamp, (int, float)):
-        return timestamp
-
-    # If timestamp is in human readable string format, try to parse using the given
-    # formats, extract the unix timestamp if the timestamp is valid & return it:
-    timestamp_list = []
-    if isinstance(timestamp, str):
-        for format in timestamp_format_list:
-            try:
-                return datetime.datetime.strptime(timestamp, format)
-            except ValueError:
-                continue
-    return None
+        return (datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10])) - datetime.date(1970, 1, 1)).days
+    except ValueError:
+        return None
+
+
+def parse_fixed_layout_timestamp(timestamp, layout):
+
+    """ This function parses a timestamp string with a fixed layout (see fixed_layout_timestamp_formats)
+    into a unix timestamp, without using strptime() or raising exceptions on a mismatch, in which case
+    it returns None. Fractions beyond microseconds (e.g. PlayFab's 7 digits) are truncated.
+    """
+
+    separator, fraction, suffixes = layout
+    if len(timestamp) < 19 or timestamp[4] != '-' or timestamp[7] != '-' or timestamp[10] != separator \
+            or timestamp[13] != ':' or timestamp[16] != ':':
+        return None
+
+    rest, microseconds = timestamp[19:], 0
+    if fraction:
+        if not rest.startswith('.'):
+            return None
+        digits = rest[1:]
+        for suffix in suffixes:
+            if suffix and digits.endswith(suffix):
+                digits = digits[:-len(suffix)]
+                break
+        else:
+            if '' not in suffixes:
+                return None
+        if not digits.isdigit():
+            return None
+        microseconds = int(digits[:6].ljust(6, '0'))
+    elif rest not in suffixes:
+        return None
+
+    time_part = timestamp[11:13] + timestamp[14:16] + timestamp[17:19]
+    if not time_part.isdigit() or not timestamp[0:4].isdigit():
+        return None
+    hour, minute, second = int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])
+    if hour > 23 or minute > 59 or second > 59:
+        return None
+    days = days_since_epoch(timestamp[0:10])
+    if days is None:
+        return None
+    return days * 86400 + hour * 3600 + minute * 60 + second + microseconds / 1000000
+
+
+@lru_cache(maxsize=32)
+def get_timestamp_parser(timestamp_format):
+
+    """ This function returns a parser for timestamp_format, which returns a unix timestamp or None.
+    Fixed-layout formats are parsed by slicing, all others fall back to strptime().
+    """
+
+    if timestamp_format in fixed_layout_timestamp_formats:
+        layout = fixed_layout_timestamp_formats[timestamp_format]
+        return lambda timestamp: parse_fixed_layout_timestamp(timestamp, layout)
+
+    def parse_with_strptime(timestamp):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(timestamp, timestamp_format).utctimetuple())
+        except ValueError:
+            return None
+    return parse_with_strptime
+
+
+def cast_to_unix_timestamps(timestamp_list, timestamp_format_list):
+
+    """ This function takes a list of timestamps and returns a list of unix timestamps (floats),
+    with None for every timestamp that could not be parsed.
+
+    An integer or float (or a string thereof) is returned as a float, whereas a timestamp in human
+    readable string format is parsed using the provided timestamp format(s). The format is only
+    detected once per batch: the first format that matches is tried first for all subsequent timestamps,
+    and the others are only tried whenever it does not match.
+    """
+
+    parser_list = [get_timestamp_parser(timestamp_format) for timestamp_format in timestamp_format_list]
+    matched_parser, unix_timestamp_list = None, []
+    for timestamp in timestamp_list:
+        if isinstance(timestamp, str):
+            unix_timestamp = matched_parser(timestamp) if matched_parser else None
+            if unix_timestamp is None:
+                try:
+                    unix_timestamp = float(timestamp)
+                except ValueError:
+                    for parser in parser_list:
+                        unix_timestamp = parser(timestamp)
+                        if unix_timestamp is not None:
+                            matched_parser = parser
+                            break
+            unix_timestamp_list.append(unix_timestamp)
+        elif isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+            unix_timestamp_list.append(float(timestamp))
+        else:
+            unix_timestamp_list.append(None)
+    return unix_timestamp_list
+
+
+def cast_to_unix_timestamp(timestamp, timestamp_format_list):
+
+    """ This function takes a timestamp and ensures a unix timestamp is returned,
+    or None otherwise. See cast_to_unix_timestamps(), which should be preferred when
+    casting many timestamps at once.
+    """
+
+    return cast_to_unix_timestamps([timestamp], timestamp_format_list)[0]
 
 
 def cast_object_to_string(object, object_type):
@@ -229,15 +360,13 @@ def format_event_list(event_list, element_type, job_name, gspath):
     proper JSON string, if it was either a list or dictionary.
     """
 
+    # The gspath is decoded & hashed once for all events (see common/gspath.py):
+    partition_dict, batch_id, processed_timestamp = decode_gspath(gspath).to_dict(), get_batch_id(gspath), time.time()
     new_list = [
       {'job_name': job_name,
-       'processed_timestamp': time.time(),
-       'batch_id': hashlib.md5(gspath.encode('utf-8')).hexdigest(),
-       'event_schema': parse_gspath(gspath, 'event_schema='),
-       'event_environment': parse_gspath(gspath, 'event_environment='),
-       'event_category': parse_gspath(gspath, 'event_category='),
-       'event_ds': parse_gspath(gspath, 'event_ds='),
-       'event_time': parse_gspath(gspath, 'event_time='),
+       'processed_timestamp': processed_timestamp,
+       'batch_id': batch_id,
+       **partition_dict,
        'event': cast_object_to_string(event, element_type),
        'gspath': gspath} for event in event_list]
     return new_list
@@ -0,0 +1,166 @@
+import string
+import json
+import time
+import re
+
+# Characters session ids (the first path element below `event_time=`) commonly start with, which we fan listings out by:
+session_shard_characters = string.digits + string.ascii_letters + '-_'
+# Splits a gspath prefix into the partition we discover days within, its day & its time part:
+partition_regex = re.compile(r'^(?P<root>gs://.*/event_environment=[^/]*/)event_ds=(?P<event_ds>[^/]*)/event_time=(?P<event_time>[^/]*)/')
+
+
+def generate_gcs_prefix_shards(gspath_prefix, shard_characters=session_shard_characters):
+
+    """ This function splits a gspath prefix into shards which can be listed independently (& thereby in parallel):
+    one shard per character the next path element may start with, plus a remainder shard (None) which picks up
+    objects whose next path element starts with any other character.
+    """
+
+    for shard_character in shard_characters:
+        yield gspath_prefix, shard_character
+    yield gspath_prefix, None
+
+
+def list_gcs_pages(client, gspath_prefix, delimiter=None, page_size=1000):
+
+    """ This function lazily pages through the objects in GCS matching a gspath prefix, yielding one
+    page at a time as a tuple ([(gspath, size), ..], [gspath prefix, ..]). Prefixes are only returned
+    when a delimiter is passed, in which case objects nested below the delimiter are rolled up into them.
+
+    The client is the apitools storage client, which for instance gcsio.GcsIO().client returns.
+    """
+
+    from apache_beam.io.gcp.internal.clients import storage
+    from apache_beam.io.gcp.gcsio import parse_gcs_path
+    from apache_beam.utils import retry
+
+    bucket_name, prefix = parse_gcs_path(gspath_prefix, object_optional=True)
+    request = storage.StorageObjectsListRequest(bucket=bucket_name, prefix=prefix, delimiter=delimiter, maxResults=page_size)
+
+    @retry.with_exponential_backoff(retry_filter=retry.retry_on_server_errors_and_timeout_filter)
+    def list_page(request):
+        return client.objects.List(request)
+
+    while True:
+        response = list_page(request)
+        yield [(f'gs://{item.bucket}/{item.name}', item.size) for item in response.items], \
+            [f'gs://{bucket_name}/{prefix}' for prefix in (response.prefixes or [])]
+        if not response.nextPageToken:
+            break
+        request.pageToken = response.nextPageToken
+
+
+def list_gcs_prefix_shard(client, gspath_prefix, shard_character, shard_characters=session_shard_characters, page_size=1000):
+
+    """ This function lazily lists the objects of a single shard of a gspath prefix (see generate_gcs_prefix_shards()),
+    yielding pages of [(gspath, size), ..].
+
+    The remainder shard (shard_character None) lists the prefix with a '/' delimiter, which only returns a single
+    entry per session instead of all of its files, & subsequently only lists the sessions not covered by other shards.
+    """
+
+    if shard_character is not None:
+        for objects, _ in list_gcs_pages(client, gspath_prefix + shard_character, page_size=page_size):
+            yield objects
+        return
+
+    def is_remainder(gspath):
+        return gspath[len(gspath_prefix):len(gspath_prefix) + 1] not in shard_characters or gspath == gspath_prefix
+
+    for objects, prefixes in list_gcs_pages(client, gspath_prefix, delimiter='/', page_size=page_size):
+        yield [(gspath, size) for gspath, size in objects if is_remainder(gspath)]
+        for nested_prefix in prefixes:
+            if is_remainder(nested_prefix):
+                for nested_objects, _ in list_gcs_pages(client, nested_prefix, page_size=page_size):
+                    yield nested_objects
+
+
+def list_gcs_partition_values(client, gspath_prefix, key, page_size=1000):
+
+    """ This function lists the values of the `key=value/` partitions directly below a gspath prefix, using a '/'
+    delimiter so only a single entry is returned per partition instead of all files within it.
+    """
+
+    for _, prefixes in list_gcs_pages(client, gspath_prefix, delimiter='/', page_size=page_size):
+        for prefix in prefixes:
+            partition = prefix[len(gspath_prefix):].rstrip('/')
+            if partition.startswith(key):
+                yield partition[len(key):]
+
+
+def load_partition_cache(path):
+
+    """ This function loads a partition cache (see prune_gcs_prefix_list()) from a local path or
+    a gspath, returning an empty cache if it does not exist yet.
+    """
+
+    from apache_beam.io.filesystems import FileSystems
+
+    if not path or not FileSystems.exists(path):
+        return dict()
+    with FileSystems.open(path) as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def save_partition_cache(path, partition_cache):
+    from apache_beam.io.filesystems import FileSystems
+
+    with FileSystems.create(path, mime_type='application/json') as f:
+        f.write(json.dumps(partition_cache, sort_keys=True).encode('utf-8'))
+
+
+def prune_gcs_prefix_list(client, gspath_prefix_list, partition_cache=None, page_size=1000):
+
+    """ This function removes the gspath prefixes (as generated by common.functions.generate_gcs_file_list())
+    whose `event_ds=` & `event_time=` partitions do not exist in GCS. Instead of listing every prefix, partitions
+    are discovered hierarchically: a single delimiter listing per `event_environment=` partition returns the days
+    that exist, after which only the days we are interested in are listed for the time parts that exist.
+
+    Whenever a partition_cache dictionary is passed, discovered partitions are recorded in it. Days which had
+    already passed when they were discovered are not listed again, as the endpoint no longer writes into them
+    (unless a client explicitly overrides `event_ds`, in which case the cache should be discarded).
+    """
+
+    partition_cache = partition_cache if partition_cache is not None else dict()
+    now, pruned_list, prefix_dict = time.time(), [], dict()
+
+    for gspath_prefix in gspath_prefix_list:
+        match = partition_regex.match(gspath_prefix)
+        if match is None:
+            pruned_list.append(gspath_prefix)
+        else:
+            prefix_dict.setdefault(match.group('root'), []).append((gspath_prefix, match.group('event_ds'), match.group('event_time')))
+
+    for root, prefix_list in prefix_dict.items():
+        cached = partition_cache.get(root, {'discovered_at': 0, 'event_ds': {}})
+        # Days before the day preceding the previous discovery were already complete back then:
+        closed_ds = time.strftime('%Y-%m-%d', time.gmtime(cached['discovered_at'] - 24 * 3600))
+        wanted_ds_set = set(event_ds for _, event_ds, _ in prefix_list)
+        if all(event_ds < closed_ds for event_ds in wanted_ds_set):
+            event_ds_dict = cached['event_ds']
+        else:
+            event_ds_dict = {event_ds: cached['event_ds'].get(event_ds) for event_ds in list_gcs_partition_values(client, root, 'event_ds=', page_size)}
+            cached = {'discovered_at': now, 'event_ds': event_ds_dict}
+
+        for event_ds in sorted(wanted_ds_set & set(event_ds_dict)):
+            if event_ds_dict[event_ds] is None or event_ds >= closed_ds:
+                event_ds_dict[event_ds] = sorted(list_gcs_partition_values(client, f'{root}event_ds={event_ds}/', 'event_time=', page_size))
+        partition_cache[root] = cached
+
+        pruned_list.extend(gspath_prefix for gspath_prefix, event_ds, event_time in prefix_list if event_time in (event_ds_dict.get(event_ds) or []))
+
+    return pruned_list
+
+
+def count_gcs_prefix_objects(client, gspath_prefix, max_pages=None, page_size=1000):
+
+    """ This function counts the objects matching a gspath prefix, listing at most max_pages pages. It returns a
+    tuple (count, exact), of which exact is False whenever the listing stopped early & count is a lower bound.
+    """
+
+    count = 0
+    for page_count, (objects, _) in enumerate(list_gcs_pages(client, gspath_prefix, page_size=page_size), 1):
+        count += len(objects)
+        if max_pages is not None and page_count >= max_pages and len(objects) == page_size:
+            return count, False
+    return count, True
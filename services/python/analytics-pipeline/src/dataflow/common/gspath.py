@@ -0,0 +1,118 @@
+from functools import lru_cache
+
+import datetime
+import hashlib
+
+# The layout of the objects within the analytics bucket, of which the endpoint (see ../endpoint/main.py) writes events into:
+#
+# gs://{bucket}/data_type={data_type}/event_schema={event_schema}/event_category={event_category}/event_environment={event_environment}/event_ds={event_ds}/event_time={event_time}/{suffix}
+#
+# The suffix is e.g. `{session_id}/{timestamp}-{random}.jsonl`. Paths are built with encode_gspath() & parsed with decode_gspath()
+# everywhere, so this is the only place which knows the layout. Decoded paths & batch ids are cached, as the same gspath is
+# typically parsed several times in a row (once per log, debug or manifest row of the same file).
+gspath_partition_keys = ('data_type', 'event_schema', 'event_category', 'event_environment', 'event_ds', 'event_time')
+
+
+class GcsPath(object):
+
+    """ A decoded gspath, of which partitions which are not present are None. Decoded paths are shared by the cache
+    of decode_gspath(), so they are not modified in place (see replace()).
+    """
+
+    __slots__ = ('bucket',) + gspath_partition_keys + ('suffix',)
+
+    def __init__(self, bucket, data_type=None, event_schema=None, event_category=None, event_environment=None,
+                 event_ds=None, event_time=None, suffix=''):
+        self.bucket = bucket
+        self.data_type = data_type
+        self.event_schema = event_schema
+        self.event_category = event_category
+        self.event_environment = event_environment
+        self.event_ds = event_ds
+        self.event_time = event_time
+        self.suffix = suffix
+
+    def __repr__(self):
+        return f'GcsPath({str(self)!r})'
+
+    def __str__(self):
+        return encode_gspath(self.bucket, self.data_type, self.event_schema, self.event_category, self.event_environment,
+                             self.event_ds, self.event_time, self.suffix)
+
+    def __eq__(self, other):
+        return isinstance(other, GcsPath) and all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, key) for key in self.__slots__))
+
+    @property
+    def partition(self):
+
+        """ The partition path below data_type, up to (& including) its `event_time=` partition.
+        """
+
+        return encode_object_location(None, self.event_schema, self.event_category, self.event_environment, self.event_ds, self.event_time)
+
+    def replace(self, **kwargs):
+
+        """ Returns a copy of the path of which the passed attributes are replaced, e.g. path.replace(data_type='jsonl_compacted').
+        """
+
+        return GcsPath(**dict({key: getattr(self, key) for key in self.__slots__}, **kwargs))
+
+    def to_dict(self, keys=gspath_partition_keys[1:]):
+
+        """ Returns the partitions which are recorded alongside the rows of a file (see common.functions.format_event_list()),
+        of which an invalid event_ds is None, as it is written into a DATE column.
+        """
+
+        return {key: validate_event_ds(self.event_ds) if key == 'event_ds' else getattr(self, key) for key in keys}
+
+
+def encode_object_location(data_type, event_schema, event_category, event_environment, event_ds, event_time, suffix=''):
+
+    """ This function returns the location of an object within the bucket. None values are encoded as empty strings, which
+    yields prefixes such as `data_type=jsonl/event_schema=improbable/event_category=native/event_environment=/..`. Whenever
+    data_type is None, it is left out.
+    """
+
+    location = f"event_schema={event_schema or ''}/event_category={event_category or ''}/event_environment={event_environment or ''}/" \
+               f"event_ds={event_ds or ''}/event_time={event_time or ''}/{suffix or ''}"
+    return location if data_type is None else f'data_type={data_type}/{location}'
+
+
+def encode_gspath(bucket, data_type, event_schema, event_category, event_environment, event_ds, event_time, suffix=''):
+    return f'gs://{bucket}/{encode_object_location(data_type, event_schema, event_category, event_environment, event_ds, event_time, suffix)}'
+
+
+def validate_event_ds(value):
+    try:
+        datetime.datetime.strptime(value, '%Y-%m-%d')
+        return value
+    except (TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=4096)
+def decode_gspath(gspath):
+
+    """ This function parses a gspath (or an object location without `gs://{bucket}/`) in a single pass. Partitions may be
+    in any order, everything following the last one is its suffix.
+    """
+
+    segments = gspath[len('gs://'):].split('/') if gspath.startswith('gs://') else [None] + gspath.split('/')
+    values, suffix_offset = dict(), 1
+    for offset, segment in enumerate(segments[1:], 1):
+        key, separator, value = segment.partition('=')
+        if separator and key in gspath_partition_keys and key not in values:
+            values[key], suffix_offset = value, offset + 1
+    return GcsPath(segments[0], suffix='/'.join(segments[suffix_offset:]), **values)
+
+
+@lru_cache(maxsize=4096)
+def get_batch_id(gspath):
+
+    """ This function returns the batch id of a file: the MD5 hexdigest of its gspath.
+    """
+
+    return hashlib.md5(gspath.encode('utf-8')).hexdigest()
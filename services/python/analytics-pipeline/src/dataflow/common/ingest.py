@@ -0,0 +1,286 @@
+from common.functions import format_event_list, get_dict_value, cast_to_unix_timestamps, gunzip_bytes_obj, generator_load_json
+
+from contextlib import nullcontext
+
+import json
+import time
+import os
+
+# Timestamp formats we try whenever an event timestamp is not already in unixtime:
+improbable_timestamp_formats = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S %Z']
+# The PlayFab `Timestamp` has 7 fractional digits instead of 6, which are truncated to microseconds while parsing:
+playfab_timestamp_formats = ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%S.%f']
+
+
+def get_bigquery_asset_list(environment, event_schema):
+
+    """ This function returns the BigQuery assets required to ingest events of event_schema,
+    in the order in which the ingestion code unpacks them: (logs, debug, backfill, native, manifest).
+    """
+
+    return [
+        # (dataset, table_name, table_schema, table_partition_column, table_layout), see common/bigquery_schema.py
+        ('logs', f'native_events_{environment}', 'logs', 'event_ds', 'logs'),
+        ('logs', f'native_events_debug_{environment}', 'logs', 'event_ds', 'debug'),
+        ('logs', f'dataflow_backfill_{environment}', 'logs', 'event_ds', 'backfill'),
+        ('native', f'events_{event_schema}_{environment}', event_schema, 'event_timestamp', event_schema),
+        ('logs', f'ingestion_manifest_{environment}', 'manifest', 'event_ds', 'manifest')]
+
+
+def get_rollup_asset_list(environment, event_schema):
+
+    """ This function returns the BigQuery assets of the rollups maintained from the native events of event_schema
+    (see dataflow/p4_bq_rollups.py): hourly counts, and per-session summaries whenever events carry a session_id.
+    """
+
+    asset_list = [('rollups', f'hourly_events_{event_schema}_{environment}', 'rollup_hourly', 'event_hour', 'rollup_hourly')]
+    if event_schema == 'improbable':
+        asset_list.append(('rollups', f'sessions_{event_schema}_{environment}', 'rollup_sessions', 'first_event_timestamp', 'rollup_sessions'))
+    return asset_list
+
+
+def format_manifest_row(gspath, status, job_name):
+
+    """ This function formats the ingestion manifest row of an event batch file, which records that all
+    of its events were committed to BigQuery. Status is either `ingested` or `malformed` (whenever some
+    of its lines were written to the debug table instead).
+    """
+
+    row = format_event_list([status], str, job_name, gspath)[0]
+    row['status'] = row.pop('event')
+    return row
+
+
+def parse_gcs_notification(payload):
+
+    """ This function parses the payload of a GCS (or backfill) Pub/Sub notification, which
+    is a JSON object containing at least `bucket` & `name`, and returns both.
+    """
+
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    payload = json.loads(payload)
+    return payload['bucket'], payload['name']
+
+
+def download_gcs_file(bucket, object_location):
+
+    """ This function downloads a file from GCS & returns its contents as a string. The
+    bucket() & blob() calls do not make any API requests, so this is a single round-trip.
+    """
+
+    return decode_gcs_file(bucket.blob(object_location).download_as_string())
+
+
+def decode_gcs_file(data_bytes):
+
+    """ This function decodes the contents of a file downloaded from GCS, which are gzipped
+    whenever automatic decompressive transcoding did not take place.
+    """
+
+    try:
+        return data_bytes.decode('utf8')
+    except UnicodeDecodeError:
+        print('Automatic decompressive transcoding failed, unzipping content..')
+        return gunzip_bytes_obj(data_bytes)
+
+
+def map_improbable_event(event, job_name):
+
+    """ This function sanitizes & augments an event adhering to the improbable schema into
+    a row for native BigQuery storage. Its event_timestamp is not yet cast to unixtime.
+    """
+
+    d = dict()
+    # Sanitize:
+    d['analytics_environment'] = get_dict_value(event, 'analyticsEnvironment', 'analytics_environment')
+    d['event_environment'] = get_dict_value(event, 'eventEnvironment', 'event_environment')
+    d['event_source'] = get_dict_value(event, 'eventSource', 'event_source')
+    d['session_id'] = get_dict_value(event, 'sessionId', 'session_id')
+    d['version_id'] = get_dict_value(event, 'versionId', 'version_id')
+    d['batch_id'] = get_dict_value(event, 'batchId', 'batch_id')
+    d['event_id'] = get_dict_value(event, 'eventId', 'event_id')
+    d['event_index'] = get_dict_value(event, 'eventIndex', 'event_index')
+    d['event_class'] = get_dict_value(event, 'eventClass', 'event_class')
+    d['event_type'] = get_dict_value(event, 'eventType', 'event_type')
+    d['player_id'] = get_dict_value(event, 'playerId', 'player_id')
+    d['event_timestamp'] = get_dict_value(event, 'eventTimestamp', 'event_timestamp')
+    d['received_timestamp'] = get_dict_value(event, 'receivedTimestamp', 'received_timestamp')  # This value was set by our endpoint, so we already know it is in unixtime
+    # Augment:
+    d['inserted_timestamp'] = time.time()
+    d['job_name'] = job_name
+    # Sanitize:
+    d['event_attributes'] = get_dict_value(event, 'eventAttributes', 'event_attributes')
+    # Set by the endpoint on events it sampled (see endpoint/common/sampling.py):
+    d['sampling_rate'] = cast_promoted_attribute(get_dict_value(event, 'samplingRate', 'sampling_rate'), 'FLOAT')
+    d['sampling_rule'] = get_dict_value(event, 'samplingRule', 'sampling_rule')
+    return d
+
+
+def map_playfab_event(event, job_name):
+
+    """ This function sanitizes & augments an event adhering to the playfab schema into
+    a row for native BigQuery storage. Its event_timestamp is not yet cast to unixtime.
+    """
+
+    d = dict()
+    # Sanitize:
+    d['analytics_environment'] = event.get('AnalyticsEnvironment', None)
+    d['playfab_environment'] = event.get('PlayFabEnvironment', None)
+    d['source_type'] = event.get('SourceType', None)
+    d['source'] = event.get('Source', None)
+    d['event_namespace'] = event.get('EventNamespace', None)
+    d['title_id'] = event.get('TitleId', None)
+    d['batch_id'] = event.get('BatchId', None)
+    d['event_id'] = event.get('EventId', None)
+    d['event_name'] = event.get('EventName', None)
+    d['entity_type'] = event.get('EntityType', None)
+    d['entity_id'] = event.get('EntityId', None)
+    d['event_timestamp'] = event.get('Timestamp', None)
+    d['received_timestamp'] = event.get('ReceivedTimestamp', None)  # This value was set by our endpoint, so we already know it is in unixtime
+    # Augment:
+    d['inserted_timestamp'] = time.time()
+    d['job_name'] = job_name
+    # Sanitize:
+    d['event_attributes'] = event.get('EventAttributes', None)
+    # Set by the endpoint on events it sampled (see endpoint/common/sampling.py):
+    d['sampling_rate'] = cast_promoted_attribute(event.get('SamplingRate', None), 'FLOAT')
+    d['sampling_rule'] = event.get('SamplingRule', None)
+    return d
+
+
+# {event_schema: (function mapping an event into a row, timestamp formats of its event_timestamp)}
+event_mapper_dict = {
+    'improbable': (map_improbable_event, improbable_timestamp_formats),
+    'playfab': (map_playfab_event, playfab_timestamp_formats)
+}
+
+
+def load_promoted_attribute_dict(path=None):
+
+    """ This function loads the attributes which are promoted from event_attributes into typed columns of native BigQuery
+    storage at ingestion time, so queries filtering on them do not have to scan & parse the whole JSON string. They are
+    configured per deployment in common/promoted_attributes.json (or the file PROMOTED_ATTRIBUTES_FILE points to), which
+    holds per event_schema a list of {"column", "path", "type"} objects: the column name, the dot-separated path within
+    event_attributes & its type (one of STRING, INTEGER, FLOAT or BOOLEAN), for instance:
+    {"column": "attribute_level", "path": "eventData.level", "type": "INTEGER"}.
+
+    It returns {event_schema: [(column, path, type), ..]}. The columns are added to the native tables whenever they are
+    provisioned (see common/bigquery_schema.py), while the attributes are kept in event_attributes as well. Values which
+    cannot be cast to their type are written as NULL.
+    """
+
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'promoted_attributes.json')
+    with open(path) as f:
+        config = json.load(f)
+
+    promoted_dict = dict()
+    for event_schema in event_mapper_dict:
+        promoted_dict[event_schema] = [(attribute['column'], attribute['path'], attribute['type']) for attribute in config.get(event_schema, [])]
+        for column, _, field_type in promoted_dict[event_schema]:
+            if field_type not in ('STRING', 'INTEGER', 'FLOAT', 'BOOLEAN'):
+                raise ValueError(f'Unsupported type of promoted attribute {column} in {path}: {field_type}')
+    return promoted_dict
+
+
+promoted_attribute_dict = load_promoted_attribute_dict(os.environ.get('PROMOTED_ATTRIBUTES_FILE'))
+
+
+def cast_promoted_attribute(value, field_type):
+
+    """ This function casts an attribute value into the BigQuery type of its promoted column, returning None if it cannot.
+    """
+
+    if value is None:
+        return None
+    try:
+        if field_type == 'STRING':
+            return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+        if isinstance(value, (dict, list)):
+            return None
+        if field_type == 'BOOLEAN':
+            return value if isinstance(value, bool) else str(value).lower() in ('true', '1')
+        if field_type == 'INTEGER':
+            return int(value)
+        if field_type == 'FLOAT':
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    raise ValueError(f'Unsupported type of promoted attribute: {field_type}')
+
+
+def promote_event_attributes(rows, promoted_attribute_list):
+
+    """ This function extracts the promoted attributes (see promoted_attribute_dict) of every row's event_attributes
+    into their columns. The event_attributes of each row are parsed (at most) once, regardless of how many are promoted.
+    """
+
+    if not promoted_attribute_list:
+        return rows
+
+    for d in rows:
+        attributes = d['event_attributes']
+        if isinstance(attributes, str):
+            try:
+                attributes = json.loads(attributes)
+            except ValueError:
+                attributes = None
+        for column, path, field_type in promoted_attribute_list:
+            value = attributes
+            for key in path.split('.'):
+                value = value.get(key, None) if isinstance(value, dict) else None
+            d[column] = cast_promoted_attribute(value, field_type)
+    return rows
+
+
+def time_phase(metrics, phase, **labels):
+
+    """ This function returns a context manager timing a processing phase into metrics (see common/metrics.py),
+    or one that does nothing if no metrics are passed.
+    """
+
+    if metrics is None:
+        return nullcontext()
+    return metrics.time_phase(phase, **labels)
+
+
+def parse_event_chunk(chunk, event_schema, job_name, batch_id, chunk_offset=0, metrics=None):
+
+    """ This function parses a chunk of lines of an event batch file into rows for native
+    BigQuery storage. It returns a tuple of four lists: (rows, row_ids, malformed_lines, malformed_row_ids).
+
+    Row ids are deterministic, which allows BigQuery to (best-effort) deduplicate redelivered
+    events: an event's own id where available, otherwise its offset within the file.
+
+    Whenever metrics are passed, the time spent parsing JSON & mapping events into rows is recorded.
+    """
+
+    map_event, timestamp_format_list = event_mapper_dict[event_schema]
+    rows, row_ids, malformed_lines, malformed_row_ids = [], [], [], []
+
+    with time_phase(metrics, 'parse', event_schema=event_schema):
+        event_tuple_list = list(generator_load_json(chunk))
+
+    with time_phase(metrics, 'map', event_schema=event_schema):
+        for line_offset, event_tuple in enumerate(event_tuple_list):
+            if event_tuple[0]:
+                for event_offset, event in enumerate(event_tuple[1]):
+                    d = map_event(event, job_name)
+                    rows.append(d)
+                    row_ids.append(d['event_id'] or f'{batch_id}/{chunk_offset}/{line_offset}/{event_offset}')
+            else:
+                malformed_lines.append(event_tuple[1])
+                malformed_row_ids.append(f'{batch_id}/{chunk_offset}/{line_offset}')
+
+        # Cast event timestamps of the whole chunk at once, so their format is only detected once:
+        event_timestamps = cast_to_unix_timestamps([d['event_timestamp'] for d in rows], timestamp_format_list)
+        for d, event_timestamp in zip(rows, event_timestamps):
+            d['event_timestamp'] = event_timestamp
+        promote_event_attributes(rows, promoted_attribute_dict[event_schema])
+        # Events written with EVENT_ATTRIBUTES_ENCODING=nested (see endpoint/main.py) carry their attributes as JSON documents,
+        # which are encoded exactly once here, whereas attributes written as strings are kept as they are:
+        for d in rows:
+            if isinstance(d['event_attributes'], (dict, list)):
+                d['event_attributes'] = json.dumps(d['event_attributes'])
+
+    return rows, row_ids, malformed_lines, malformed_row_ids
@@ -0,0 +1,248 @@
+from contextlib import contextmanager
+from bisect import bisect_left
+
+import threading
+import json
+import time
+import re
+
+# Histogram buckets (upper bounds in seconds) for the duration of processing phases:
+phase_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Histogram buckets (upper bounds in seconds) for the lag between receiving & inserting an event:
+lag_buckets = [1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400]
+# Histograms which Beam steps report through counters (see common.classes.BeamHistogram), as Beam distributions only keep
+# their sum, count, min & max. collect_beam_metrics() reassembles them from `{name}_bucket_{index}` & `{name}_sum_milliseconds`:
+beam_histogram_buckets = {'ingestion_lag_seconds': lag_buckets}
+beam_histogram_counter_regex = re.compile(r'^(?P<name>.+)_(?:bucket_(?P<index>[0-9]+)|sum_milliseconds)$')
+
+
+def get_ingestion_lags(rows):
+
+    """ This function returns the lag between received_timestamp (set by the endpoint) & inserted_timestamp of rows.
+    """
+
+    return [row['inserted_timestamp'] - row['received_timestamp'] for row in rows
+            if isinstance(row.get('received_timestamp', None), (int, float)) and isinstance(row.get('inserted_timestamp', None), (int, float))]
+
+
+class Metrics(object):
+
+    """ A small, thread-safe registry of counters & histograms describing ingestion: files processed,
+    rows inserted & rejected, bytes downloaded, per-phase timings & the lag between `received_timestamp`
+    (set by the endpoint) and `inserted_timestamp` (set during ingestion).
+
+    Metrics can be rendered in the Prometheus text exposition format (render_prometheus()), which is
+    scrapeable as-is, or emitted as a single structured JSON log line (emit_log()) by short-lived processes
+    such as Cloud Functions. As logs-based metrics extract a single value per log line, these also emit a
+    line per label set of a histogram (emit_histogram_log()), from which logs-based distributions are derived
+    (see ../../../../terraform/module-analytics/logging.tf).
+    """
+
+    def __init__(self, namespace='analytics_ingest'):
+        self.namespace = namespace
+        self.counters = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def total(self, name):
+
+        """ Returns the sum of a counter across all of its labels.
+        """
+
+        with self.lock:
+            return sum(value for (key_name, _), value in self.counters.items() if key_name == name)
+
+    def observe(self, name, value_list, buckets, **labels):
+
+        """ Records one or more values (pass a list to record many at once) into a histogram.
+        """
+
+        if not isinstance(value_list, list):
+            value_list = [value_list]
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram = self.histograms[key]
+            for value in value_list:
+                if value is None:
+                    continue
+                histogram['counts'][bisect_left(histogram['buckets'], value)] += 1
+                histogram['sum'] += value
+                histogram['count'] += 1
+
+    @contextmanager
+    def time_phase(self, phase, **labels):
+
+        """ Times the enclosed block & records its duration in the phase_seconds histogram.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('phase_seconds', time.perf_counter() - start, phase_buckets, phase=phase, **labels)
+
+    def observe_lag(self, rows, **labels):
+
+        """ Records the lag between received_timestamp & inserted_timestamp of rows that were inserted.
+        """
+
+        self.observe('ingestion_lag_seconds', get_ingestion_lags(rows), lag_buckets, **labels)
+
+    def add_histogram(self, name, buckets, counts, value_sum, **labels):
+
+        """ Adds the bucket counts (one more than there are buckets, the last one being +Inf) & sum of values which were
+        recorded elsewhere to a histogram, e.g. those reported by a Beam step (see collect_beam_metrics()).
+        """
+
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram = self.histograms[key]
+            histogram['counts'] = [a + b for a, b in zip(histogram['counts'], counts)]
+            histogram['sum'] += value_sum
+            histogram['count'] += sum(counts)
+
+    def merge(self, other):
+        with self.lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in other.histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = {'buckets': list(histogram['buckets']), 'counts': [0] * len(histogram['counts']), 'sum': 0.0, 'count': 0}
+                target = self.histograms[key]
+                target['counts'] = [a + b for a, b in zip(target['counts'], histogram['counts'])]
+                target['sum'] += histogram['sum']
+                target['count'] += histogram['count']
+
+    @staticmethod
+    def format_labels(labels, extra=None):
+        labels = list(labels) + (extra or [])
+        if not labels:
+            return ''
+        return '{' + ','.join('{k}="{v}"'.format(k=k, v=v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render_prometheus(self):
+
+        """ Renders all metrics in the Prometheus text exposition format.
+        """
+
+        lines = []
+        with self.lock:
+            for name in sorted(set(key[0] for key in self.counters)):
+                lines.append(f'# TYPE {self.namespace}_{name} counter')
+                for (key_name, labels), value in sorted(self.counters.items()):
+                    if key_name == name:
+                        lines.append(f'{self.namespace}_{name}{self.format_labels(labels)} {value}')
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append(f'# TYPE {self.namespace}_{name} histogram')
+                for (key_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                        cumulative += count
+                        lines.append(f'{self.namespace}_{name}_bucket{self.format_labels(labels, [("le", str(bound))])} {cumulative}')
+                    lines.append(f"{self.namespace}_{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{self.namespace}_{name}_count{self.format_labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()],
+                'histograms': [{'name': name, 'labels': dict(labels), 'buckets': histogram['buckets'], 'counts': histogram['counts'],
+                                'sum': histogram['sum'], 'count': histogram['count']} for (name, labels), histogram in self.histograms.items()]}
+
+    def emit_log(self):
+
+        """ Prints all metrics as a single structured JSON log line.
+        """
+
+        print(json.dumps({'severity': 'INFO', 'message': f'{self.namespace}_metrics', 'metrics': self.to_dict()}))
+
+    def emit_histogram_log(self, name):
+
+        """ Prints a structured JSON log line per label set of a histogram, holding its labels, the mean of its values
+        under the histogram's name & their count. Cloud Functions ingest a single file per invocation, whose rows share
+        (about) the same lag, so the logs-based distribution of these lines is the distribution of the lag per file.
+        """
+
+        with self.lock:
+            line_list = [dict(labels, severity='INFO', message=f'{self.namespace}_{name}', count=histogram['count'], **{name: histogram['sum'] / histogram['count']})
+                         for (key_name, labels), histogram in self.histograms.items() if key_name == name and histogram['count']]
+        for line in line_list:
+            print(json.dumps(line))
+
+
+def collect_beam_metrics(pipeline_result, metrics):
+
+    """ This function copies the counters & distributions reported by the steps of a finished Beam pipeline
+    into metrics, so they can be exported alongside our own. Distributions are exported as `_sum` & `_count` counters,
+    while the histograms of beam_histogram_buckets are reassembled from their counters, bucket counts included.
+    """
+
+    query_result, histogram_dict = pipeline_result.metrics().query(), dict()
+    for counter in query_result['counters']:
+        value = counter.committed if counter.committed is not None else counter.attempted
+        name, step = counter.key.metric.name, counter.key.step
+        match = beam_histogram_counter_regex.match(name)
+        if match and match.group('name') in beam_histogram_buckets:
+            buckets = beam_histogram_buckets[match.group('name')]
+            counts, value_sum = histogram_dict.setdefault((match.group('name'), step), ([0] * (len(buckets) + 1), [0]))
+            if match.group('index') is not None:
+                counts[int(match.group('index'))] += value or 0
+            else:
+                value_sum[0] += value or 0
+            continue
+        metrics.inc(name, value or 0, step=step)
+    for distribution in query_result['distributions']:
+        value = distribution.committed if distribution.committed is not None else distribution.attempted
+        if value is not None:
+            metrics.inc(f'{distribution.key.metric.name}_sum', value.sum, step=distribution.key.step)
+            metrics.inc(f'{distribution.key.metric.name}_count', value.count, step=distribution.key.step)
+    for (histogram_name, step), (counts, value_sum) in histogram_dict.items():
+        metrics.add_histogram(histogram_name, beam_histogram_buckets[histogram_name], counts, value_sum[0] / 1000, step=step)
+    return metrics
+
+
+def serve_metrics(metrics, port):
+
+    """ This function serves metrics in the Prometheus text exposition format on http://0.0.0.0:{port}/metrics
+    from a daemon thread, which allows long-running processes to be scraped.
+    """
+
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = metrics.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('0.0.0.0', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,128 @@
+from common.formatters import try_format_improbable_event, try_format_playfab_event
+from common.functions import format_event_list
+
+import calendar
+import hashlib
+import time
+import json
+import re
+
+# The endpoint (see ../endpoint/main.py) quarantines events it could not format into `event_schema={event_schema}-raw`
+# objects, one event per line, and payloads it could not parse at all into `data_type=unknown` objects. Both are named
+# after the time they were received at:
+received_timestamp_regex = re.compile(r'/(?P<received>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)-[^/]*$')
+
+# {event_schema: (the endpoint's formatter of its events, the key holding the time an event was received)}
+formatter_dict = {
+    'improbable': (try_format_improbable_event, 'receivedTimestamp'),
+    'playfab': (try_format_playfab_event, 'ReceivedTimestamp')
+}
+
+
+def get_quarantine_source(gspath):
+    return 'unknown' if '/data_type=unknown/' in gspath else 'raw'
+
+
+def get_event_digest(batch_id, event_id):
+
+    """ This function returns the MD5 hexdigest identifying an event within the quarantined object of batch_id, by which
+    the events recovered by an earlier reprocessing are told apart (see common.classes.ReprocessQuarantinedFile).
+    """
+
+    return hashlib.md5(f'{batch_id}/{event_id}'.encode('utf-8')).hexdigest()
+
+
+def parse_received_timestamp(gspath):
+
+    """ This function returns the unixtime a quarantined object was received at according to its name, or None.
+    """
+
+    match = received_timestamp_regex.search(gspath)
+    if match is None:
+        return None
+    return float(calendar.timegm(time.strptime(match.group('received'), '%Y-%m-%dT%H:%M:%SZ')))
+
+
+def load_quarantined_json(value):
+
+    """ This function returns the events within a JSON document as a list, or None if it does not contain any. Events
+    which were encoded as JSON strings themselves (by misbehaving SDKs) are decoded once more.
+    """
+
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+        if isinstance(value, str):
+            return load_quarantined_json(value)
+    if isinstance(value, dict):
+        return [value]
+    if isinstance(value, list):
+        events = []
+        for element in value:
+            decoded = load_quarantined_json(element) if isinstance(element, str) else None
+            events.extend(decoded if decoded is not None else [element])
+        return events
+    return None
+
+
+def extract_quarantined_events(data, source):
+
+    """ This function splits the decoded contents of a quarantined object into events, yielding an (events, line)
+    tuple per JSON document, of which events is None whenever the line contains none. Unknown objects hold a whole
+    request body, which is tried as a single document before it is split into lines.
+    """
+
+    if source == 'unknown':
+        events = load_quarantined_json(data)
+        if events is not None:
+            yield events, data
+            return
+    for line in data.split('\n'):
+        if line.strip():
+            yield load_quarantined_json(line), line
+
+
+def reformat_quarantined_events(data, source, event_schema, batch_id, analytics_environment, received_timestamp=None):
+
+    """ This function applies the endpoint's current formatter of event_schema to every event within a quarantined
+    object, returning the list of formatted events & a list of whatever still fails (as strings). Formatted events keep
+    the time they were originally received at, while their batch & event ids derive from the quarantined object.
+    """
+
+    try_format_event, received_key = formatter_dict[event_schema]
+    formatted_list, failed_list, index = [], [], 0
+    for events, line in extract_quarantined_events(data, source):
+        if events is None:
+            failed_list.append(line)
+            continue
+        for event in events:
+            received = event.get(received_key, received_timestamp) if isinstance(event, dict) else None
+            success, formatted = try_format_event(index, event, batch_id, analytics_environment) if isinstance(event, dict) else (False, event)
+            if success:
+                if received is not None:
+                    formatted[received_key] = received
+                formatted_list.append(formatted)
+            else:
+                failed_list.append(json.dumps(event))
+            index += 1
+    return formatted_list, failed_list
+
+
+def format_reprocess_row(gspath, job_name, recovered_events, failed_list, error=None):
+
+    """ This function formats the report row of a reprocessed object, with a sample of what still fails.
+    """
+
+    if error or (failed_list and not recovered_events):
+        status = 'failed'
+    else:
+        status = 'partially_recovered' if failed_list else 'recovered'
+    row = format_event_list([status], str, job_name, gspath)[0]
+    row['status'] = row.pop('event')
+    row['source'] = get_quarantine_source(gspath)
+    row['recovered_events'] = recovered_events
+    row['failed_events'] = len(failed_list)
+    row['failure_sample'] = (error or (failed_list[0] if failed_list else None) or '')[:1024] or None
+    return row
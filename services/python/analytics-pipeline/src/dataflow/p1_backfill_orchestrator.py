@@ -0,0 +1,239 @@
+# Python 3.7.1
+
+# python p1_backfill_orchestrator.py \
+#   --state-file=backfill-state.json \
+#   --max-concurrent-jobs=4 \
+#   --max-objects-per-shard=1000000 \
+#   -- \
+#   --gcp-region=europe-west1 \
+#   --environment={{your_environment}} \
+#   --location=EU \
+#   --gcp={{your_google_project_id}} \
+#   --topic=cloud-function-improbable-schema-topic-{{your_environment}} \
+#   --bucket-name={{your_google_project_id}}-analytics-{{your_environment}} \
+#   --event-schema=improbable \
+#   --event-environment=release \
+#   --event-ds-start=2019-01-01 \
+#   --event-ds-stop=2019-06-30
+
+# Splits the range of a p1_gcs_to_bq_backfill.py run (all arguments after `--`) into shards of at most --max-objects-per-shard
+# objects (where possible), and runs a backfill job per shard with at most --max-concurrent-jobs at once. Objects are counted per
+# `event_ds`/`event_time` partition: consecutive days are combined into a shard (of the --event-time of the backfill) until it
+# would grow too large, while days with more objects than that are split into a shard per time part of that --event-time.
+
+# The shard plan & the status of every shard are recorded in --state-file, so rerunning the same command after a failure
+# only runs the shards which did not succeed yet (pass --replan to discard the plan). Shards run as subprocesses of
+# --command, so `--execution-environment=DirectRunner` (forwarded to every job) runs them as local pipelines.
+
+from common.functions import generate_gcs_file_list, write_watermark
+from common.gcs import prune_gcs_prefix_list, count_gcs_prefix_objects, partition_regex
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from threading import Lock
+
+import p1_gcs_to_bq_backfill as backfill
+
+import subprocess
+import argparse
+import datetime
+import shlex
+import json
+import time
+import sys
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--state-file', dest='state_file', required=True)
+parser.add_argument('--max-concurrent-jobs', dest='max_concurrent_jobs', type=int, default=4)
+parser.add_argument('--max-objects-per-shard', dest='max_objects_per_shard', type=int, default=1000000)
+parser.add_argument('--max-attempts', dest='max_attempts', type=int, default=2)  # Attempts per shard within a single run.
+parser.add_argument('--max-listing-workers', dest='max_listing_workers', type=int, default=16)
+parser.add_argument('--command', default=f'{shlex.quote(sys.executable)} {shlex.quote(os.path.join(os.path.dirname(os.path.abspath(__file__)), "p1_gcs_to_bq_backfill.py"))}')
+parser.add_argument('--replan', action='store_true')
+parser.add_argument('--dry-run', dest='dry_run', action='store_true')  # Only print the shard plan.
+parser.add_argument('backfill_argv', nargs=argparse.REMAINDER)
+
+
+def estimate_partition_objects(client, gspath_prefix_list, max_objects, max_workers=16, page_size=1000):
+
+    """ This function counts the objects of every (existing) partition prefix in parallel, returning
+    {(event_ds, event_time): count}, summed over the prefixes of the same partition (e.g. of several categories).
+    Counting stops once a prefix has more than max_objects objects, as its partition will be backfilled by a
+    shard of its own regardless, which bounds the listing cost of busy partitions.
+    """
+
+    max_pages = max_objects // page_size + 1
+
+    def count(gspath_prefix):
+        match = partition_regex.match(gspath_prefix)
+        return (match.group('event_ds'), match.group('event_time')), count_gcs_prefix_objects(client, gspath_prefix, max_pages, page_size)[0]
+
+    partition_objects = Counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for partition, objects in executor.map(count, gspath_prefix_list):
+            partition_objects[partition] += objects
+    return dict(partition_objects)
+
+
+def generate_backfill_shards(partition_objects, event_ds_start, event_ds_stop, max_objects, event_time='all', time_part_list=('00-08', '08-16', '16-24')):
+
+    """ This function plans the shards of a backfill from the object count of its partitions, returning a list of
+    {'event_ds_start', 'event_ds_stop', 'event_time', 'estimated_objects'} dictionaries. Consecutive days are combined
+    until a shard would exceed max_objects, which backfill the event_time of the backfill itself; days exceeding it by
+    themselves get a shard per time part of time_part_list instead (the time parts event_time stands for).
+    Days without any objects are added to the preceding shard, so the shards always cover the whole range.
+    """
+
+    day_objects = dict()
+    for (event_ds, _), count in partition_objects.items():
+        day_objects[event_ds] = day_objects.get(event_ds, 0) + count
+
+    shards, current = [], None
+    event_ds, stop = datetime.datetime.strptime(event_ds_start, '%Y-%m-%d').date(), datetime.datetime.strptime(event_ds_stop, '%Y-%m-%d').date()
+    while event_ds <= stop:
+        ds, count = str(event_ds), day_objects.get(str(event_ds), 0)
+        if count > max_objects:
+            current = None
+            for (partition_ds, partition_time), partition_count in sorted(partition_objects.items()):
+                if partition_ds == ds and partition_time in time_part_list and partition_count > 0:
+                    shards.append({'event_ds_start': ds, 'event_ds_stop': ds, 'event_time': partition_time, 'estimated_objects': partition_count})
+        elif current is None or current['estimated_objects'] + count > max_objects:
+            current = {'event_ds_start': ds, 'event_ds_stop': ds, 'event_time': event_time, 'estimated_objects': count}
+            shards.append(current)
+        else:
+            current['event_ds_stop'] = ds
+            current['estimated_objects'] += count
+        event_ds += datetime.timedelta(days=1)
+    return shards
+
+
+def get_shard_key(shard):
+    return f"{shard['event_ds_start']}/{shard['event_ds_stop']}/{shard['event_time']}"
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+def save_state(path, state):
+
+    """ This function stores the orchestration state in a local JSON file, replacing it atomically so an
+    interrupted orchestrator never leaves a truncated file behind.
+    """
+
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def run_shards(shards, run_shard, shard_state, persist, max_concurrent_jobs=4, max_attempts=2):
+
+    """ This function runs run_shard(shard) for every shard whose status in shard_state (a dictionary of
+    {shard key: {'status': .., ..}}) is not `succeeded` yet, with at most max_concurrent_jobs at once. run_shard
+    returns whether the shard succeeded; failed shards are retried up to max_attempts times. After every
+    status change persist() is called, so progress is recorded even if the orchestrator itself is interrupted.
+    It returns the keys of the shards which did not succeed.
+    """
+
+    lock = Lock()
+
+    def update(shard_key, **kwargs):
+        with lock:
+            shard_state.setdefault(shard_key, {}).update(kwargs)
+            persist()
+
+    def run(shard):
+        shard_key = get_shard_key(shard)
+        for _ in range(max_attempts):
+            attempts = shard_state.get(shard_key, {}).get('attempts', 0) + 1
+            update(shard_key, status='running', attempts=attempts, started_at=time.time())
+            try:
+                succeeded = run_shard(shard)
+            except Exception as e:
+                print(f'Shard {shard_key} raised: {e}')
+                succeeded = False
+            update(shard_key, status='succeeded' if succeeded else 'failed', finished_at=time.time())
+            if succeeded:
+                return None
+        return shard_key
+
+    pending = [shard for shard in shards if shard_state.get(get_shard_key(shard), {}).get('status') != 'succeeded']
+    print(f'{len(shards) - len(pending)} of {len(shards)} shards already succeeded, running {len(pending)}..')
+    with ThreadPoolExecutor(max_workers=max_concurrent_jobs) as executor:
+        return [shard_key for shard_key in executor.map(run, pending) if shard_key is not None]
+
+
+def run_backfill_job(command, backfill_argv, shard):
+
+    """ This function runs a single p1_gcs_to_bq_backfill.py job over the range of shard, returning whether it succeeded.
+    Watermarks are disabled for the job, as the orchestrator advances the watermark once all shards succeeded.
+    """
+
+    argv = shlex.split(command) + backfill_argv + [
+        '--event-ds-start', shard['event_ds_start'],
+        '--event-ds-stop', shard['event_ds_stop'],
+        '--event-time', shard['event_time'],
+        '--watermark-file', 'None']
+    process = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.decode('utf-8', errors='replace')
+    print(f"Shard {get_shard_key(shard)} {'succeeded' if process.returncode == 0 else 'failed'}:\n{output[-2000:]}")
+    return process.returncode == 0
+
+
+def run(args):
+    from apache_beam.io.gcp import gcsio
+
+    backfill_argv = [argument for argument in args.backfill_argv if argument != '--']
+    backfill_args = backfill.parse_arguments(backfill_argv)
+    if None in [backfill_args.event_ds_start, backfill_args.event_ds_stop]:
+        raise Exception('Error: the orchestrator requires both --event-ds-start & --event-ds-stop!')
+    if backfill_args.event_ds_start > backfill_args.event_ds_stop:
+        print(f'Nothing to backfill, the watermark in {backfill_args.watermark_file} is already at {backfill_args.event_ds_stop}.')
+        return []
+
+    # A single state file can hold several backfills, which are told apart by the same key as their watermarks:
+    state = load_state(args.state_file)
+    run_state = state.setdefault(backfill_args.watermark_key, {})
+    plan_range = [backfill_args.event_ds_start, backfill_args.event_ds_stop]
+    # Plans of earlier versions combined days into shards of all time parts, regardless of --event-time:
+    time_part_set = set(backfill_args.time_part_list) | {backfill_args.event_time}
+    if args.replan or run_state.get('range') != plan_range or any(shard['event_time'] not in time_part_set for shard in run_state.get('shards', [])):
+        gcs_prefix_list = prune_gcs_prefix_list(gcsio.GcsIO().client, generate_gcs_file_list(
+            backfill_args.bucket_name, backfill_args.event_schema, backfill_args.event_environment, backfill_args.category_list,
+            backfill_args.event_ds_start, backfill_args.event_ds_stop, backfill_args.time_part_list, backfill_args.scale_test_name))
+        partition_objects = estimate_partition_objects(gcsio.GcsIO().client, gcs_prefix_list, args.max_objects_per_shard, args.max_listing_workers)
+        run_state.update({
+            'range': plan_range,
+            'shards': generate_backfill_shards(partition_objects, backfill_args.event_ds_start, backfill_args.event_ds_stop, args.max_objects_per_shard,
+                                               backfill_args.event_time, backfill_args.time_part_list),
+            'status': {}})
+
+    for shard in run_state['shards']:
+        print(f"Shard {get_shard_key(shard)}: ~{shard['estimated_objects']:,} objects, {run_state['status'].get(get_shard_key(shard), {}).get('status', 'pending')}")
+    if args.dry_run:
+        return []
+    save_state(args.state_file, state)
+
+    failed_shards = run_shards(run_state['shards'], lambda shard: run_backfill_job(args.command, backfill_argv, shard), run_state['status'],
+                               lambda: save_state(args.state_file, state), args.max_concurrent_jobs, args.max_attempts)
+
+    if not failed_shards and backfill_args.watermark_file:
+        # Only days which have passed are complete, as the endpoint keeps writing into the current one:
+        closed_ds = str(datetime.datetime.utcnow().date() - datetime.timedelta(days=2))
+        write_watermark(backfill_args.watermark_file, backfill_args.watermark_key, min(backfill_args.event_ds_stop, closed_ds))
+    return failed_shards
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    failed_shards = run(args)
+    if args.dry_run:
+        sys.exit(0)
+    if failed_shards:
+        print(f"Failed shards (rerun to resume): {', '.join(failed_shards)}")
+        sys.exit(1)
+    print('All backfill shards succeeded.')
@@ -7,13 +7,20 @@ from apache_beam.options.pipeline_options import StandardOptions
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.options.pipeline_options import SetupOptions
 
-from common.bigquery import source_bigquery_assets, generate_bigquery_assets, generate_backfill_query
-from common.functions import parse_none_or_string, generate_gcs_file_list, safe_convert_list_to_sql_tuple, parse_gspath, parse_argument
-from common.classes import GetGcsFileList, WriteToPubSub
+from common.bigquery import source_bigquery_assets, generate_bigquery_assets, generate_backfill_query, generate_manifest_backfill_query, generate_manifest_seed_query, \
+    generate_manifest_count_query
+from common.functions import parse_none_or_string, generate_gcs_file_list, safe_convert_list_to_sql_tuple, parse_argument, read_watermark, write_watermark
+from common.gspath import decode_gspath, get_batch_id
+from common.ingest import get_bigquery_asset_list
+from common.classes import GetGcsFileList, ReadCompactionIndex, ParseGcsFile, PublishToPubSub, BuildBatchIdSet, ProbeBatchIdSet
+from common.compaction import compacted_data_type, select_file_source
+from common.gcs import generate_gcs_prefix_shards, prune_gcs_prefix_list, load_partition_cache, save_partition_cache
+from apache_beam.io.gcp import gcsio
+from common.metrics import Metrics, collect_beam_metrics
 from google.cloud import bigquery
 
 import argparse
-import hashlib
+import datetime
 import time
 import sys
 import os
@@ -25,8 +32,11 @@ parser.add_argument('--setup-file', dest='setup_file', default='src/setup.py')
 parser.add_argument('--gcp-region', dest='gcp_region', required=True)
 parser.add_argument('--environment', required=True)
 parser.add_argument('--location', required=True)  # {EU|US}
-parser.add_argument('--topic', required=True)
+parser.add_argument('--topic', default=None)  # Required when --backfill-mode=pubsub
 parser.add_argument('--gcp', required=True)
+# Either notify the Cloud Functions about missing files through Pub/Sub (pubsub), or parse & load them within the pipeline (dataflow):
+parser.add_argument('--backfill-mode', dest='backfill_mode', default='pubsub', choices=['pubsub', 'dataflow'])
+parser.add_argument('--metrics-file', dest='metrics_file', type=parse_none_or_string, default=None)  # Write metrics in the Prometheus text format to this file, instead of printing them
 
 # The following arguments follow along with the gspath:
 # gs://{{bucket-name}}/data_type={{jsonl|unknown}}/event_schema={{improbable|playfab}}/event_category={{!native}}/event_environment={{debug|profile|release}}/event_ds={{yyyy-mm-dd}}/event_time={{00-08|08-16|16-24}}/{{scale-test-name}}
@@ -40,36 +50,202 @@ parser.add_argument('--event-ds-stop', dest='event_ds_stop', type=parse_none_or_
 parser.add_argument('--event-time', dest='event_time', type=parse_none_or_string, default='all')  # {{0-8|8-16|16-24}}
 parser.add_argument('--scale-test-name', dest='scale_test_name', type=parse_none_or_string, default=None)
 
-args = parser.parse_args()
+# Partitions that exist in GCS are discovered before the pipeline is launched, which can be cached between runs in a local file or gspath:
+parser.add_argument('--partition-cache', dest='partition_cache', type=parse_none_or_string, default=None)
+# Partitions compacted by p3_gcs_compaction.py are read from their compacted objects (data_type=jsonl_compacted), alongside the files
+# left over in data_type=jsonl. Requires --backfill-mode=dataflow, as the Cloud Functions only ingest the individual files:
+parser.add_argument('--read-compacted', dest='read_compacted', action='store_true')
 
-if None not in [args.event_ds_start, args.event_ds_stop]:
-    if args.event_ds_start > args.event_ds_stop:
-        raise Exception('Error: ds_start cannot be later than ds_stop!')
+# Files already ingested are sourced by scanning all ingested events (events), or from the ingestion manifest (manifest). The manifest
+# only knows about files ingested since it exists, so a range should be seeded once with --seed-manifest (which scans all events once)
+# before it is diffed against the manifest. Ranges of which the manifest holds no files at all are diffed against the events instead:
+parser.add_argument('--diff-source', dest='diff_source', default='events', choices=['events', 'manifest'])
+parser.add_argument('--seed-manifest', dest='seed_manifest', action='store_true')
+# Incremental runs start the day after the last event_ds a previous run with the same arguments completed, stored in a local file.
+# With --backfill-mode=pubsub, the watermark moves past days once their missing files were published, not once they were ingested:
+# files whose Cloud Function failed are not picked up by later incremental runs, but by a run over their days without a watermark:
+parser.add_argument('--watermark-file', dest='watermark_file', type=parse_none_or_string, default=None)
+# Files already ingested are subtracted from the files in GCS by shuffling both (cogroup), or by broadcasting the exact set of the
+# batch ids of the former to all workers (broadcast), which shuffles nothing but costs 16 bytes of worker memory per file already
+# ingested. The set is assembled on a single worker before it is broadcast, so it suits up to tens of millions of files:
+parser.add_argument('--diff-strategy', dest='diff_strategy', default='cogroup', choices=['cogroup', 'broadcast'])
 
-supported_schemas = ['improbable', 'playfab']
-if args.event_schema not in supported_schemas:
-    raise Exception(f"""Unknown schema passed {args.event_schema}. Currently only {f"`{'` and `'.join(supported_schemas)}`"} are supported.""")
 
-time_part_list, time_part_name = parse_argument(args.event_time, ['00-08', '08-16', '16-24'], 'time-parts')
-category_list, category_name = parse_argument(args.event_category, ['external', 'native'], 'categories')
+def parse_arguments(argv=None):
 
-def run():
+    """ This function parses & validates the arguments of the backfill (sys.argv unless argv is passed),
+    and derives the time parts, categories & watermark key from them. Whenever a watermark file is
+    passed, event_ds_start is moved past the last day a previous run completed.
+    """
+
+    args = parser.parse_args(argv)
+
+    if None not in [args.event_ds_start, args.event_ds_stop]:
+        if args.event_ds_start > args.event_ds_stop:
+            raise Exception('Error: ds_start cannot be later than ds_stop!')
+
+    if args.backfill_mode == 'pubsub' and not args.topic:
+        raise Exception('Error: --topic is required when --backfill-mode=pubsub!')
+    if args.backfill_mode == 'pubsub' and args.read_compacted:
+        raise Exception('Error: --read-compacted requires --backfill-mode=dataflow!')
+
+    supported_schemas = ['improbable', 'playfab']
+    if args.event_schema not in supported_schemas:
+        raise Exception(f"""Unknown schema passed {args.event_schema}. Currently only {f"`{'` and `'.join(supported_schemas)}`"} are supported.""")
+
+    args.time_part_list, args.time_part_name = parse_argument(args.event_time, ['00-08', '08-16', '16-24'], 'time-parts')
+    args.category_list, args.category_name = parse_argument(args.event_category, ['external', 'native'], 'categories')
+
+    args.watermark_key = f"{args.environment}/{args.event_schema}/{args.event_environment}/{args.category_name}/{args.time_part_name}/{args.scale_test_name or ''}"
+    if args.watermark_file and None not in [args.event_ds_start, args.event_ds_stop]:
+        watermark = read_watermark(args.watermark_file, args.watermark_key)
+        if watermark and watermark >= args.event_ds_start:
+            args.event_ds_start = str(datetime.datetime.strptime(watermark, '%Y-%m-%d').date() + datetime.timedelta(days=1))
+
+    return args
+
+
+def write_bigquery_table(project, dataset, table, **kwargs):
+
+    """ This function returns the PTransform the backfill loads rows into a BigQuery table with.
+    """
+
+    return beam.io.WriteToBigQuery(
+        table=table,
+        dataset=dataset,
+        project=project,
+        method='FILE_LOADS',
+        write_disposition=beam.io.gcp.bigquery.BigQueryDisposition.WRITE_APPEND,
+        **kwargs)
+
+
+def build_pipeline(p1, args, job_name, gcs_prefix_list, read_ingested_files, write_table=write_bigquery_table, gcsio_factory=None, publisher_factory=None,
+                   compacted_prefix_list=None):
+
+    """ This function adds the backfill steps to pipeline p1: the files below gcs_prefix_list are listed, the files
+    already ingested are subtracted from them, and the remainder is either published to Pub/Sub or parsed & loaded.
+    Whenever compacted_prefix_list is passed, the files merged into the compacted objects below it are listed as well,
+    which are parsed from their compacted objects. It returns the main PCollections by name, so their element counts can be measured.
+
+    GCP is only accessed through the following arguments, which allows running the pipeline offline (see ../benchmarks/backfill_pipeline.py):
+    - read_ingested_files: a PTransform reading {'gspath': ..} dictionaries of the files already ingested;
+    - write_table: a function (project, dataset, table, **kwargs) returning a PTransform loading rows into BigQuery;
+    - gcsio_factory: a function returning a gcsio.GcsIO-like object to list & read files with (defaults to gcsio.GcsIO);
+    - publisher_factory: a function returning a pubsub_v1.PublisherClient-like object (defaults to pubsub_v1.PublisherClient).
+    """
+
+    fileListGcs = (p1 | 'CreateGcsIterators' >> beam.Create(gcs_prefix_list)
+                   # Fan every prefix out into shards & redistribute them, so listing runs in parallel across workers:
+                   | 'ShardGcsPrefixes' >> beam.FlatMap(generate_gcs_prefix_shards)
+                   | 'ReshuffleGcsPrefixes' >> beam.Reshuffle()
+                   | 'GetGcsFileList' >> beam.ParDo(GetGcsFileList(gcsio_factory=gcsio_factory))
+                   # Files are paired with the compacted object they are read from, which is None for files read as they are:
+                   | 'PairWithSource' >> beam.Map(lambda x: (x, None)))
+
+    if compacted_prefix_list:
+        compactedListGcs = (p1 | 'CreateCompactedIterators' >> beam.Create(compacted_prefix_list)
+                            | 'ShardCompactedPrefixes' >> beam.FlatMap(generate_gcs_prefix_shards)
+                            | 'ReshuffleCompactedPrefixes' >> beam.Reshuffle()
+                            | 'GetCompactedFileList' >> beam.ParDo(GetGcsFileList(gcsio_factory=gcsio_factory))
+                            | 'ReadCompactionIndex' >> beam.ParDo(ReadCompactionIndex(gcsio_factory=gcsio_factory)))
+        fileListGcs = ((fileListGcs, compactedListGcs) | 'FlattenGcsFileLists' >> beam.Flatten())
+
+    fileListBq = (p1 | 'ParseBqFileList' >> read_ingested_files)
+
+    if args.diff_strategy == 'broadcast':
+        # Files are identified by their batch id (the MD5 hexdigest of their gspath), of which the files already ingested are
+        # broadcast as an exact set of their digests, rather than shuffled alongside the files in GCS:
+        batchIdSetBq = (fileListBq | 'ExtractBqBatchIds' >> beam.Map(lambda x: get_batch_id(x['gspath']))
+                        | 'BuildBatchIdSet' >> beam.CombineGlobally(BuildBatchIdSet()))
+        parseList = (fileListGcs | 'ProbeBatchIdSet' >> beam.ParDo(ProbeBatchIdSet(), beam.pvalue.AsSingleton(batchIdSetBq)))
+        if compacted_prefix_list:
+            # Files left over next to the compacted object they were merged into are listed twice:
+            parseList = (parseList | 'SelectSources' >> beam.CombinePerKey(select_file_source))
+    else:
+        parseList = ({'fileListGcs': fileListGcs,
+                      'fileListBq': fileListBq | 'BqListPairWithOne' >> beam.Map(lambda x: (x['gspath'], 1))}
+                     | 'CoGroupByKey' >> beam.CoGroupByKey()
+                     | 'UnionMinusIntersect' >> beam.Filter(lambda x: (len(x[1]['fileListGcs']) >= 1 and len(x[1]['fileListBq']) == 0))
+                     | 'SelectSources' >> beam.Map(lambda x: (x[0], select_file_source(x[1]['fileListGcs']))))
+
+    def generate_backfill_log(gspath, event):
+        # Decoded once per gspath (see common/gspath.py), rather than once per partition:
+        return {
+            'job_name': job_name,
+            'processed_timestamp': time.time(),
+            'batch_id': get_batch_id(gspath),
+            **decode_gspath(gspath).to_dict(),
+            'event': event,
+            'gspath': gspath
+            }
+
+    pcollections = {'gcs_files': fileListGcs, 'ingested_files': fileListBq, 'parse_list': parseList}
+    backfillLogList = [parseList | 'AddParseInitiatedInfo' >> beam.Map(lambda x: generate_backfill_log(x[0], 'parse_initiated'))]
+    if args.backfill_mode == 'dataflow':
+        if compacted_prefix_list:
+            # Files are grouped by the compacted object they are read from, so every compacted object is only read once:
+            sourceList = (parseList | 'KeyBySource' >> beam.Map(lambda x: (x[1] or x[0], x[0])) | 'GroupBySource' >> beam.GroupByKey())
+        else:
+            sourceList = (parseList | 'ExtractGspaths' >> beam.Map(lambda x: x[0]))
+        # Parse & load files within the pipeline, mirroring what the Cloud Functions write:
+        parsedList = (sourceList | 'ParseGcsFile' >> beam.ParDo(ParseGcsFile(args.event_schema, job_name, gcsio_factory=gcsio_factory)).with_outputs('malformed', 'logs', 'manifest', main='rows'))
+        for name, pcollection, dataset, table in [
+                ('Native', parsedList.rows, 'native', f'events_{args.event_schema}_{args.environment}'),
+                ('Debug', parsedList.malformed, 'logs', f'native_events_debug_{args.environment}'),
+                ('Logs', parsedList.logs, 'logs', f'native_events_{args.environment}'),
+                ('Manifest', parsedList.manifest, 'logs', f'ingestion_manifest_{args.environment}')]:
+            pcollection | f'Write{name}Events' >> write_table(args.gcp, dataset, table, create_disposition=beam.io.gcp.bigquery.BigQueryDisposition.CREATE_NEVER)
+            pcollections[f'{name.lower()}_rows'] = pcollection
+    else:
+        # Write to Pub/Sub, files which could not be published are emitted to the `failed` output:
+        failedList = (parseList | 'ExtractGspaths' >> beam.Map(lambda x: x[0]) | 'PublishToPubSub' >> beam.ParDo(PublishToPubSub(args.gcp, args.topic, publisher_factory=publisher_factory)).with_outputs('failed', main='published')).failed
+        backfillLogList.append(failedList | 'AddPublishFailedInfo' >> beam.Map(generate_backfill_log, 'publish_failed'))
+        pcollections['publish_failed'] = failedList
+
+    # Write to BigQuery:
+    logsList = (tuple(backfillLogList) | 'FlattenBackfillLogs' >> beam.Flatten())
+    logsList | 'WriteBackfillLogs' >> write_table(
+        args.gcp,
+        'logs',
+        f'dataflow_backfill_{args.environment}',
+        create_disposition=beam.io.gcp.bigquery.BigQueryDisposition.CREATE_IF_NEEDED,
+        insert_retry_strategy=beam.io.gcp.bigquery_tools.RetryStrategy.RETRY_ON_TRANSIENT_ERROR,
+        schema='job_name:STRING,processed_timestamp:TIMESTAMP,batch_id:STRING,event_schema:STRING,event_environment:STRING,event_category:STRING,event_ds:DATE,event_time:STRING,event:STRING,gspath:STRING')
+    pcollections['backfill_logs'] = logsList
+
+    return pcollections
+
+
+def run(args):
 
     client_bq = bigquery.Client.from_service_account_json(os.environ['GOOGLE_APPLICATION_CREDENTIALS'], location=args.location)
-    bigquery_asset_list = [
-        # (dataset, table_name, table_schema, table_partition_column)
-        ('logs', f'native_events_{args.environment}', 'logs', 'event_ds'),
-        ('logs', f'native_events_debug_{args.environment}', 'logs', 'event_ds'),
-        ('logs', f'dataflow_backfill_{args.environment}', 'logs', 'event_ds'),
-        ('native', f'events_{args.event_schema}_{args.environment}', args.event_schema, 'event_timestamp')]
+    bigquery_asset_list = get_bigquery_asset_list(args.environment, args.event_schema)
     try:
         source_bigquery_assets(client_bq, bigquery_asset_list)
     except Exception:
         generate_bigquery_assets(client_bq, bigquery_asset_list)
 
+    backfill_query_args = (
+        args.gcp,
+        args.environment,
+        args.event_schema,
+        args.event_environment,
+        (safe_convert_list_to_sql_tuple(args.category_list), args.category_name),
+        args.event_ds_start,
+        args.event_ds_stop,
+        (safe_convert_list_to_sql_tuple(args.time_part_list), args.time_part_name),
+        args.scale_test_name)
+
+    if args.seed_manifest:
+        client_bq.query(generate_manifest_seed_query(*backfill_query_args)).result()
+    elif args.diff_source == 'manifest' and not next(iter(client_bq.query(generate_manifest_count_query(*backfill_query_args)).result())).files:
+        # Diffing an unseeded range against the manifest would backfill every file in it a second time:
+        print(f'Warning: logs.ingestion_manifest_{args.environment} holds no files within the requested range, diffing against the events instead.')
+        args.diff_source = 'events'
+
     # https://github.com/apache/beam/blob/master/sdks/python/apache_beam/options/pipeline_options.py
     po, event_category = PipelineOptions(), args.event_category.replace('_', '-')
-    job_name = f'p1-gcs-to-bq-backfill-{args.event_schema}-{event_category}-{args.event_ds_start}-to-{args.event_ds_stop}-{time_part_name}-{int(time.time())}'
+    job_name = f'p1-gcs-to-bq-backfill-{args.event_schema}-{event_category}-{args.event_ds_start}-to-{args.event_ds_stop}-{args.time_part_name}-{int(time.time())}'
     # https://cloud.google.com/dataflow/docs/guides/specifying-exec-params
     pipeline_options = po.from_dictionary({
         'project': args.gcp,
@@ -84,65 +260,46 @@ def run():
     pipeline_options.view_as(SetupOptions).save_main_session = True
 
     p1 = beam.Pipeline(options=pipeline_options)
-    fileListGcs = (p1 | 'CreateGcsIterators' >> beam.Create(list(generate_gcs_file_list(args.bucket_name, args.event_schema, args.event_environment, category_list, args.event_ds_start, args.event_ds_stop, time_part_list, args.scale_test_name)))
-                   | 'GetGcsFileList' >> beam.ParDo(GetGcsFileList())
-                   | 'GcsListPairWithOne' >> beam.Map(lambda x: (x, 1)))
+    # Only list the prefixes whose partitions exist:
+    partition_cache = load_partition_cache(args.partition_cache)
+    gcs_prefix_list = prune_gcs_prefix_list(gcsio.GcsIO().client, generate_gcs_file_list(args.bucket_name, args.event_schema, args.event_environment, args.category_list, args.event_ds_start, args.event_ds_stop, args.time_part_list, args.scale_test_name), partition_cache)
+    compacted_prefix_list = None
+    if args.read_compacted:
+        compacted_prefix_list = prune_gcs_prefix_list(gcsio.GcsIO().client, generate_gcs_file_list(args.bucket_name, args.event_schema, args.event_environment, args.category_list, args.event_ds_start, args.event_ds_stop, args.time_part_list, args.scale_test_name, data_type=compacted_data_type), partition_cache)
+    if args.partition_cache:
+        save_partition_cache(args.partition_cache, partition_cache)
 
-    fileListBq = (p1 | 'ParseBqFileList' >> beam.io.Read(beam.io.BigQuerySource(
+    build_pipeline(p1, args, job_name, gcs_prefix_list, beam.io.Read(beam.io.BigQuerySource(
         # "What is already in BQ?"
-        query=generate_backfill_query(
-            args.gcp,
-            args.environment,
-            args.event_schema,
-            args.event_environment,
-            (safe_convert_list_to_sql_tuple(category_list), category_name),
-            args.event_ds_start,
-            args.event_ds_stop,
-            (safe_convert_list_to_sql_tuple(time_part_list), time_part_name),
-            args.scale_test_name),
-        use_standard_sql=True))
-                  | 'BqListPairWithOne' >> beam.Map(lambda x: (x['gspath'], 1)))
-
-
-    parseList = ({'fileListGcs': fileListGcs, 'fileListBq': fileListBq}
-                 | 'CoGroupByKey' >> beam.CoGroupByKey()
-                 | 'UnionMinusIntersect' >> beam.Filter(lambda x: (len(x[1]['fileListGcs']) == 1 and len(x[1]['fileListBq']) == 0))
-                 | 'ExtractKeysParseList' >> beam.Map(lambda x: x[0]))
+        query=(generate_manifest_backfill_query if args.diff_source == 'manifest' else generate_backfill_query)(*backfill_query_args),
+        use_standard_sql=True)), compacted_prefix_list=compacted_prefix_list)
+
+    result = p1.run()
+    result.wait_until_finish()
+
+    # Export the metrics reported by our steps (see common/classes.py):
+    metrics = collect_beam_metrics(result, Metrics(namespace='analytics_backfill'))
+    if args.metrics_file:
+        with open(args.metrics_file, 'w') as metrics_file:
+            metrics_file.write(metrics.render_prometheus())
+    else:
+        print(metrics.render_prometheus())
+
+    files_failed = metrics.total('files_failed')
+    if files_failed:
+        print(f'Warning: {files_failed} files could not be published, see `publish_failed` events in logs.dataflow_backfill_{args.environment}')
+    elif args.watermark_file and None not in [args.event_ds_start, args.event_ds_stop]:
+        # Only days which have passed are complete, as the endpoint keeps writing into the current one:
+        closed_ds = str(datetime.datetime.utcnow().date() - datetime.timedelta(days=2))
+        write_watermark(args.watermark_file, args.watermark_key, min(args.event_ds_stop, closed_ds))
 
-    # Write to BigQuery:
-    logsList = (parseList | 'AddParseInitiatedInfo' >> beam.Map(
-                lambda gspath: {
-                    'job_name': job_name,
-                    'processed_timestamp': time.time(),
-                    'batch_id': hashlib.md5(gspath.encode('utf-8')).hexdigest(),
-                    'event_schema': parse_gspath(gspath, 'event_schema='),
-                    'event_category': parse_gspath(gspath, 'event_category='),
-                    'event_environment': parse_gspath(gspath, 'event_environment='),
-                    'event_ds': parse_gspath(gspath, 'event_ds='),
-                    'event_time': parse_gspath(gspath, 'event_time='),
-                    'event': 'parse_initiated',
-                    'gspath': gspath
-                    })
-                | 'WriteParseInitiated' >> beam.io.WriteToBigQuery(
-                    table=f'dataflow_backfill_{args.environment}',
-                    dataset='logs',
-                    project=args.gcp,
-                    method='FILE_LOADS',
-                    create_disposition=beam.io.gcp.bigquery.BigQueryDisposition.CREATE_IF_NEEDED,
-                    write_disposition=beam.io.gcp.bigquery.BigQueryDisposition.WRITE_APPEND,
-                    insert_retry_strategy=beam.io.gcp.bigquery_tools.RetryStrategy.RETRY_ON_TRANSIENT_ERROR,
-                    schema='job_name:STRING,processed_timestamp:TIMESTAMP,batch_id:STRING,event_schema:STRING,event_environment:STRING,event_category:STRING,event_ds:DATE,event_time:STRING,event:STRING,gspath:STRING'
-                    )
-                )
-
-    # Write to Pub/Sub:
-    PDone = (parseList | 'DumpParseListPubSub' >> beam.io.WriteToText(f'gs://{args.bucket_name}/data_type=dataflow/batch/output/{job_name}/parselist')
-            | 'WriteToPubSub' >> beam.ParDo(WriteToPubSub(), job_name, args.topic, args.gcp, args.bucket_name))
-
-    p1.run().wait_until_finish()
     return job_name
 
 
 if __name__ == '__main__':
-    job_name = run()
+    args = parse_arguments()
+    if None not in [args.event_ds_start, args.event_ds_stop] and args.event_ds_start > args.event_ds_stop:
+        print(f'Nothing to backfill, the watermark in {args.watermark_file} is already at {args.event_ds_stop}.')
+        sys.exit(0)
+    job_name = run(args)
     print(f'Stream backfill job finished: {job_name}')
@@ -0,0 +1,203 @@
+# Python 3.7.1
+
+# python p2_gcs_to_bq_streaming.py \
+#   --gcp={{your_google_project_id}} \
+#   --gcp-region=europe-west1 \
+#   --environment={{your_environment}} \
+#   --location=EU \
+#   --bucket-name={{your_google_project_id}}-analytics-{{your_environment}} \
+#   --event-schema=improbable \
+#   --subscription=dataflow-streaming-improbable-schema-subscription-{{your_environment}} \
+#   --dedupe-seconds=86400
+
+# A streaming alternative to the Cloud Functions in ../functions/*/main.py. It consumes the same `{"bucket", "name"}`
+# notifications (sent by GCS or published by p1_gcs_to_bq_backfill.py) from a Pub/Sub subscription on the topic of
+# --event-schema, reads & parses the files they point to in parallel across workers, and streams their rows into native
+# BigQuery storage in batches of at most --batch-size rows.
+
+# Streaming inserts of Beam 2.16 use random insert ids, so BigQuery cannot deduplicate rows of a file parsed twice. Pub/Sub
+# delivers at least once (& the backfill may publish a file GCS notified about as well), so notifications are deduplicated
+# by the batch id of their file first, which drops any notification of a file seen within the last --dedupe-seconds.
+
+# Note that you must not run this pipeline next to the Cloud Function of the same schema, as both would ingest every file.
+
+# Passing --local-notifications (a file with one notification per line) & --local-root (a directory laid out as
+# {root}/{bucket}/{object location}) runs the pipeline on the DirectRunner without a project, in which case rows are
+# written as JSON lines into --local-output instead of into BigQuery.
+
+from __future__ import absolute_import
+import apache_beam as beam
+
+from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.options.pipeline_options import SetupOptions
+
+from common.bigquery import source_bigquery_assets, generate_bigquery_assets
+from common.functions import parse_none_or_string
+from common.gspath import get_batch_id
+from common.ingest import get_bigquery_asset_list, parse_gcs_notification
+from common.classes import ParseGcsFile, DeduplicateFiles
+from common.metrics import Metrics, collect_beam_metrics
+
+import functools
+import argparse
+import json
+import time
+import os
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--execution-environment', dest='execution_environment', default='DataflowRunner')
+parser.add_argument('--setup-file', dest='setup_file', default='src/setup.py')
+parser.add_argument('--gcp-region', dest='gcp_region', required=True)
+parser.add_argument('--environment', required=True)
+parser.add_argument('--location', required=True)  # {EU|US}
+parser.add_argument('--gcp', required=True)
+parser.add_argument('--bucket-name', dest='bucket_name', required=True)
+parser.add_argument('--event-schema', dest='event_schema', required=True)  # {improbable|playfab}
+parser.add_argument('--subscription', type=parse_none_or_string, default=None)  # Required unless --local-notifications is passed
+parser.add_argument('--dedupe-seconds', dest='dedupe_seconds', type=int, default=24 * 3600)
+parser.add_argument('--batch-size', dest='batch_size', type=int, default=500)
+# Run on the DirectRunner against local files instead (see above):
+parser.add_argument('--local-notifications', dest='local_notifications', type=parse_none_or_string, default=None)
+parser.add_argument('--local-root', dest='local_root', type=parse_none_or_string, default=None)
+parser.add_argument('--local-output', dest='local_output', type=parse_none_or_string, default=None)
+
+
+def parse_arguments(argv=None):
+
+    """ This function parses & validates the arguments of the streaming pipeline (sys.argv unless argv is passed).
+    """
+
+    args = parser.parse_args(argv)
+
+    supported_schemas = ['improbable', 'playfab']
+    if args.event_schema not in supported_schemas:
+        raise Exception(f"""Unknown schema passed {args.event_schema}. Currently only {f"`{'` and `'.join(supported_schemas)}`"} are supported.""")
+
+    if args.local_notifications:
+        if not args.local_root or not args.local_output:
+            raise Exception('Error: --local-root & --local-output are required when --local-notifications is passed!')
+    elif not args.subscription:
+        raise Exception('Error: --subscription is required unless --local-notifications is passed!')
+
+    return args
+
+
+def parse_notification(payload):
+
+    """ This function returns the gspath of the file a GCS (or backfill) Pub/Sub notification points to.
+    """
+
+    bucket_name, object_location = parse_gcs_notification(payload)
+    return f'gs://{bucket_name}/{object_location}'
+
+
+def write_bigquery_table(project, dataset, table, **kwargs):
+
+    """ This function returns the PTransform the streaming pipeline inserts rows into a BigQuery table with.
+    """
+
+    return beam.io.WriteToBigQuery(
+        table=table,
+        dataset=dataset,
+        project=project,
+        method='STREAMING_INSERTS',
+        create_disposition=beam.io.gcp.bigquery.BigQueryDisposition.CREATE_NEVER,
+        write_disposition=beam.io.gcp.bigquery.BigQueryDisposition.WRITE_APPEND,
+        insert_retry_strategy=beam.io.gcp.bigquery_tools.RetryStrategy.RETRY_ON_TRANSIENT_ERROR,
+        **kwargs)
+
+
+def write_local_table(output, project, dataset, table, **kwargs):
+
+    """ This function returns a PTransform writing rows as JSON lines into {output}/{dataset}.{table}-*.jsonl,
+    which stands in for write_bigquery_table() when running locally.
+    """
+
+    return beam.Map(json.dumps) | beam.io.WriteToText(os.path.join(output, f'{dataset}.{table}'), file_name_suffix='.jsonl')
+
+
+def build_pipeline(p2, args, job_name, read_notifications, write_table=write_bigquery_table, gcsio_factory=None):
+
+    """ This function adds the ingestion steps to pipeline p2: notifications are read with the read_notifications
+    PTransform & deduplicated, the files they point to are read through gcsio_factory() (defaults to gcsio.GcsIO) & parsed,
+    and their rows are written with write_table (see write_bigquery_table()).
+    It returns the main PCollections by name, so their element counts can be measured.
+    """
+
+    fileList = (p2 | 'ReadNotifications' >> read_notifications
+                | 'ParseNotifications' >> beam.Map(parse_notification)
+                # The stateful deduplication groups notifications by batch id, which also redistributes the bursts in
+                # which they are pulled across workers before files are read:
+                | 'KeyByBatchId' >> beam.Map(lambda gspath: (get_batch_id(gspath), gspath))
+                | 'DeduplicateFiles' >> beam.ParDo(DeduplicateFiles(args.dedupe_seconds)))
+
+    # Parse files with the same mapping as the Cloud Functions (see common/ingest.py):
+    parsedList = (fileList | 'ParseGcsFile' >> beam.ParDo(ParseGcsFile(args.event_schema, job_name, gcsio_factory=gcsio_factory)).with_outputs('malformed', 'logs', 'manifest', main='rows'))
+
+    pcollections = {'files': fileList}
+    for name, pcollection, dataset, table in [
+            ('Native', parsedList.rows, 'native', f'events_{args.event_schema}_{args.environment}'),
+            ('Debug', parsedList.malformed, 'logs', f'native_events_debug_{args.environment}'),
+            ('Logs', parsedList.logs, 'logs', f'native_events_{args.environment}'),
+            ('Manifest', parsedList.manifest, 'logs', f'ingestion_manifest_{args.environment}')]:
+        pcollection | f'Write{name}Events' >> write_table(args.gcp, dataset, table, batch_size=args.batch_size)
+        pcollections[f'{name.lower()}_rows'] = pcollection
+
+    return pcollections
+
+
+def run(args):
+
+    job_name = f'p2-gcs-to-bq-streaming-{args.event_schema}-{args.environment}-{int(time.time())}'
+
+    if args.local_notifications:
+        from common.fakes import FakeGcsIO
+
+        pipeline_options = PipelineOptions.from_dictionary({'runner': 'DirectRunner'})
+        p2 = beam.Pipeline(options=pipeline_options)
+        build_pipeline(p2, args, job_name, beam.io.ReadFromText(args.local_notifications),
+                       write_table=functools.partial(write_local_table, args.local_output),
+                       gcsio_factory=functools.partial(FakeGcsIO, args.local_root))
+
+        result = p2.run()
+        result.wait_until_finish()
+        print(collect_beam_metrics(result, Metrics(namespace='analytics_streaming')).render_prometheus())
+        return job_name
+
+    from google.cloud import bigquery
+
+    client_bq = bigquery.Client.from_service_account_json(os.environ['GOOGLE_APPLICATION_CREDENTIALS'], location=args.location)
+    bigquery_asset_list = get_bigquery_asset_list(args.environment, args.event_schema)
+    try:
+        source_bigquery_assets(client_bq, bigquery_asset_list)
+    except Exception:
+        generate_bigquery_assets(client_bq, bigquery_asset_list)
+
+    # https://github.com/apache/beam/blob/master/sdks/python/apache_beam/options/pipeline_options.py
+    # https://cloud.google.com/dataflow/docs/guides/specifying-exec-params
+    pipeline_options = PipelineOptions.from_dictionary({
+        'project': args.gcp,
+        'staging_location': f'gs://{args.bucket_name}/data_type=dataflow/streaming/staging/{job_name}/',
+        'temp_location': f'gs://{args.bucket_name}/data_type=dataflow/streaming/temp/{job_name}/',
+        'runner': args.execution_environment,  # {DirectRunner, DataflowRunner}
+        'setup_file': args.setup_file,
+        'service_account_email': f'dataflow-batch-{args.environment}@{args.gcp}.iam.gserviceaccount.com',
+        'job_name': job_name,
+        'region': args.gcp_region,
+        'streaming': True,
+        'autoscaling_algorithm': 'THROUGHPUT_BASED'
+        })
+    pipeline_options.view_as(SetupOptions).save_main_session = True
+
+    p2 = beam.Pipeline(options=pipeline_options)
+    build_pipeline(p2, args, job_name, beam.io.ReadFromPubSub(subscription=f'projects/{args.gcp}/subscriptions/{args.subscription}'))
+    p2.run()
+
+    return job_name
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    job_name = run(args)
+    print(f'Streaming ingest job started: {job_name}')
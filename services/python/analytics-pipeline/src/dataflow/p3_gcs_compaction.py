@@ -0,0 +1,177 @@
+# Python 3.7.1
+
+# python p3_gcs_compaction.py \
+#   --gcp={{your_google_project_id}} \
+#   --gcp-region=europe-west1 \
+#   --environment={{your_environment}} \
+#   --location=EU \
+#   --bucket-name={{your_google_project_id}}-analytics-{{your_environment}} \
+#   --event-schema=improbable \
+#   --event-environment=release \
+#   --event-ds-start=2019-01-01 \
+#   --event-ds-stop=2019-01-31 \
+#   --delete-originals
+
+# The endpoint writes one object per POST, which leaves every `event_ds`/`event_time` partition with a huge number of
+# small files. This pipeline merges the files of closed partitions into a few objects of at most --max-object-bytes
+# below `data_type=jsonl_compacted/` (see common/compaction.py), each alongside an index of the files it contains.
+# Every file merged is recorded in logs.compaction_manifest_{{your_environment}}, mapping it (& its batch id) to its
+# compacted object. Whenever --delete-originals is passed, files are deleted once their compacted object is written, but
+# only those which logs.ingestion_manifest_{{your_environment}} records as ingested (or malformed): files which were never
+# ingested are kept, so the Cloud Functions can still be notified about them. Partitions ingested before the manifest
+# existed should be seeded first (see --seed-manifest of the backfill), otherwise nothing is deleted.
+
+# Compacted partitions are reprocessed with --read-compacted of the backfill (p1_gcs_to_bq_backfill.py), which lists the files
+# within compacted objects from their indexes & parses them from the compacted objects (see common.classes.ParseGcsFile), so
+# the batch ids & row ids of their events are the same as when the files were ingested individually. Only event batch files
+# of the supported schemas are compacted, as the quarantine reprocessing (p6_gcs_quarantine_reprocess.py) reads objects as they are.
+
+from __future__ import absolute_import
+import apache_beam as beam
+
+from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.options.pipeline_options import SetupOptions
+
+from common.bigquery import generate_manifest_backfill_query
+from common.functions import parse_none_or_string, generate_gcs_file_list, parse_argument, safe_convert_list_to_sql_tuple
+from common.classes import GetGcsFileList, CompactGcsFiles, BuildBatchIdSet
+from common.gspath import get_batch_id
+from common.compaction import get_partition
+from common.gcs import generate_gcs_prefix_shards, prune_gcs_prefix_list
+from common.metrics import Metrics, collect_beam_metrics
+from apache_beam.io.gcp import gcsio
+
+import argparse
+import datetime
+import hashlib
+import time
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--execution-environment', dest='execution_environment', default='DataflowRunner')
+parser.add_argument('--setup-file', dest='setup_file', default='src/setup.py')
+parser.add_argument('--gcp-region', dest='gcp_region', required=True)
+parser.add_argument('--environment', required=True)
+parser.add_argument('--location', required=True)  # {EU|US}
+parser.add_argument('--gcp', required=True)
+parser.add_argument('--bucket-name', dest='bucket_name', required=True)
+parser.add_argument('--event-schema', dest='event_schema', required=True)  # {{improbable|playfab}}
+parser.add_argument('--event-environment', dest='event_environment', required=True)
+parser.add_argument('--event-category', dest='event_category', type=parse_none_or_string, default='all')
+parser.add_argument('--event-ds-start', dest='event_ds_start', required=True)
+parser.add_argument('--event-ds-stop', dest='event_ds_stop', required=True)
+parser.add_argument('--event-time', dest='event_time', type=parse_none_or_string, default='all')  # {{00-08|08-16|16-24}}
+parser.add_argument('--scale-test-name', dest='scale_test_name', type=parse_none_or_string, default=None)
+# The files of a partition are spread over --shards-per-partition workers, each writing objects of at most --max-object-bytes:
+parser.add_argument('--max-object-bytes', dest='max_object_bytes', type=int, default=128 * 1024 * 1024)
+parser.add_argument('--shards-per-partition', dest='shards_per_partition', type=int, default=4)
+parser.add_argument('--delete-originals', dest='delete_originals', action='store_true')
+parser.add_argument('--metrics-file', dest='metrics_file', type=parse_none_or_string, default=None)
+
+
+def parse_arguments(argv=None):
+
+    """ This function parses & validates the arguments of the compaction (sys.argv unless argv is passed). Only closed
+    partitions are compacted, as the endpoint keeps writing into the current day: event_ds_stop is capped accordingly.
+    """
+
+    args = parser.parse_args(argv)
+
+    supported_schemas = ['improbable', 'playfab']
+    if args.event_schema not in supported_schemas:
+        raise Exception(f"""Unknown schema passed {args.event_schema}. Currently only {f"`{'` and `'.join(supported_schemas)}`"} are supported.""")
+
+    closed_ds = str(datetime.datetime.utcnow().date() - datetime.timedelta(days=2))
+    args.event_ds_stop = min(args.event_ds_stop, closed_ds)
+    if args.event_ds_start > args.event_ds_stop:
+        raise Exception(f'Error: ds_start cannot be later than ds_stop, and only partitions up to {closed_ds} are closed!')
+
+    args.time_part_list, args.time_part_name = parse_argument(args.event_time, ['00-08', '08-16', '16-24'], 'time-parts')
+    args.category_list, args.category_name = parse_argument(args.event_category, ['external', 'native'], 'categories')
+    return args
+
+
+def key_by_partition(gspath_size, shards_per_partition):
+
+    """ This function keys a (gspath, size) tuple by its (bucket, partition path, shard), spreading the
+    files of a partition over shards_per_partition groups by their batch id.
+    """
+
+    gspath, _ = gspath_size
+    bucket, partition = get_partition(gspath)
+    shard = int(hashlib.md5(gspath.encode('utf-8')).hexdigest(), 16) % shards_per_partition
+    return (bucket, partition, shard), gspath_size
+
+
+def run(args):
+
+    po, event_category = PipelineOptions(), args.event_category.replace('_', '-')
+    job_name = f'p3-gcs-compaction-{args.event_schema}-{event_category}-{args.event_ds_start}-to-{args.event_ds_stop}-{args.time_part_name}-{int(time.time())}'
+    # https://cloud.google.com/dataflow/docs/guides/specifying-exec-params
+    pipeline_options = po.from_dictionary({
+        'project': args.gcp,
+        'staging_location': f'gs://{args.bucket_name}/data_type=dataflow/batch/staging/{job_name}/',
+        'temp_location': f'gs://{args.bucket_name}/data_type=dataflow/batch/temp/{job_name}/',
+        'runner': args.execution_environment,  # {DirectRunner, DataflowRunner}
+        'setup_file': args.setup_file,
+        'service_account_email': f'dataflow-batch-{args.environment}@{args.gcp}.iam.gserviceaccount.com',
+        'job_name': job_name,
+        'region': args.gcp_region
+        })
+    pipeline_options.view_as(SetupOptions).save_main_session = True
+
+    p3 = beam.Pipeline(options=pipeline_options)
+    # Only list the prefixes whose partitions exist:
+    gcs_prefix_list = prune_gcs_prefix_list(gcsio.GcsIO().client, generate_gcs_file_list(args.bucket_name, args.event_schema, args.event_environment, args.category_list, args.event_ds_start, args.event_ds_stop, args.time_part_list, args.scale_test_name))
+
+    side_inputs = []
+    if args.delete_originals:
+        # Only files the ingestion manifest records are deleted, whose batch ids are broadcast to all workers:
+        ingestedBatchIdSet = (p3 | 'ParseBqFileList' >> beam.io.Read(beam.io.BigQuerySource(
+                                  query=generate_manifest_backfill_query(
+                                      args.gcp, args.environment, args.event_schema, args.event_environment,
+                                      (safe_convert_list_to_sql_tuple(args.category_list), args.category_name), args.event_ds_start, args.event_ds_stop,
+                                      (safe_convert_list_to_sql_tuple(args.time_part_list), args.time_part_name), args.scale_test_name),
+                                  use_standard_sql=True))
+                              | 'ExtractBqBatchIds' >> beam.Map(lambda x: get_batch_id(x['gspath']))
+                              | 'BuildBatchIdSet' >> beam.CombineGlobally(BuildBatchIdSet()))
+        side_inputs.append(beam.pvalue.AsSingleton(ingestedBatchIdSet))
+
+    compactionList = (p3 | 'CreateGcsIterators' >> beam.Create(gcs_prefix_list)
+                      | 'ShardGcsPrefixes' >> beam.FlatMap(generate_gcs_prefix_shards)
+                      | 'ReshuffleGcsPrefixes' >> beam.Reshuffle()
+                      | 'GetGcsFileList' >> beam.ParDo(GetGcsFileList(with_size=True))
+                      | 'KeyByPartition' >> beam.Map(key_by_partition, args.shards_per_partition)
+                      | 'GroupByPartition' >> beam.GroupByKey()
+                      | 'CompactGcsFiles' >> beam.ParDo(CompactGcsFiles(job_name, args.max_object_bytes, args.delete_originals), *side_inputs))
+
+    # Write to BigQuery:
+    compactionList | 'WriteCompactionManifest' >> beam.io.WriteToBigQuery(
+        table=f'compaction_manifest_{args.environment}',
+        dataset='logs',
+        project=args.gcp,
+        method='FILE_LOADS',
+        create_disposition=beam.io.gcp.bigquery.BigQueryDisposition.CREATE_IF_NEEDED,
+        write_disposition=beam.io.gcp.bigquery.BigQueryDisposition.WRITE_APPEND,
+        schema='job_name:STRING,processed_timestamp:TIMESTAMP,batch_id:STRING,event_schema:STRING,event_environment:STRING,event_category:STRING,event_ds:DATE,'
+               'event_time:STRING,gspath:STRING,compacted_gspath:STRING,line_offset:INTEGER,line_count:INTEGER'
+        )
+
+    result = p3.run()
+    result.wait_until_finish()
+
+    # Export the metrics reported by our steps (see common/classes.py):
+    metrics = collect_beam_metrics(result, Metrics(namespace='analytics_compaction'))
+    if args.metrics_file:
+        with open(args.metrics_file, 'w') as metrics_file:
+            metrics_file.write(metrics.render_prometheus())
+    else:
+        print(metrics.render_prometheus())
+
+    return job_name
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    job_name = run(args)
+    print(f'Compaction job finished: {job_name}')
@@ -0,0 +1,127 @@
+# Python 3.7.1
+
+# python p4_bq_rollups.py \
+#   --gcp={{your_google_project_id}} \
+#   --environment={{your_environment}} \
+#   --location=EU \
+#   --event-schema=improbable \
+#   --watermark-file=rollups-watermarks.json
+
+# Maintains rollup tables of the native events of --event-schema in the `rollups` dataset, so dashboards can read
+# (kilobytes of) pre-aggregated rows instead of scanning the raw events on every refresh:
+# - hourly_events_{{event_schema}}_{{your_environment}}: event, session & player counts per hour, environment, class & type;
+# - sessions_improbable_{{your_environment}}: a summary per session (first & last event, duration, event counts).
+
+# Meant to be scheduled (e.g. every 15 minutes): each run recomputes the hours & sessions which received events since
+# the previous run, as recorded by the `inserted_timestamp` watermark in --watermark-file. Only events inserted at least
+# --insert-lag-minutes ago are read, so rows still being inserted are picked up by the next run instead. Events whose
+# event_timestamp lies over --lateness-hours before the watermark (e.g. of backfills) are not picked up: pass
+# --event-ds-start & --event-ds-stop to recompute all hours & sessions of that range instead, after the backfill.
+
+# Rows are recomputed as a whole rather than incremented, so a run which failed halfway can simply be rerun.
+
+from common.bigquery import source_bigquery_assets, generate_bigquery_assets, generate_rollup_hourly_query, generate_rollup_sessions_query
+from common.functions import parse_none_or_string, validate_date, read_watermark, write_watermark
+from common.ingest import get_rollup_asset_list
+
+import argparse
+import datetime
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--environment', required=True)
+parser.add_argument('--location', required=True)  # {EU|US}
+parser.add_argument('--gcp', required=True)
+parser.add_argument('--event-schema', dest='event_schema', required=True)  # {improbable|playfab}
+parser.add_argument('--watermark-file', dest='watermark_file', required=True)
+parser.add_argument('--insert-lag-minutes', dest='insert_lag_minutes', type=int, default=15)
+parser.add_argument('--lateness-hours', dest='lateness_hours', type=int, default=72)
+parser.add_argument('--session-hours', dest='session_hours', type=int, default=24)  # Sessions are summarized over at most this long.
+# Recompute the rollups of a range of days instead:
+parser.add_argument('--event-ds-start', dest='event_ds_start', type=parse_none_or_string, default=None)
+parser.add_argument('--event-ds-stop', dest='event_ds_stop', type=parse_none_or_string, default=None)
+parser.add_argument('--dry-run', dest='dry_run', action='store_true')  # Only print the SQL statements.
+
+timestamp_format = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_arguments(argv=None):
+
+    """ This function parses & validates the arguments of the rollup job (sys.argv unless argv is passed).
+    """
+
+    args = parser.parse_args(argv)
+
+    supported_schemas = ['improbable', 'playfab']
+    if args.event_schema not in supported_schemas:
+        raise Exception(f"""Unknown schema passed {args.event_schema}. Currently only {f"`{'` and `'.join(supported_schemas)}`"} are supported.""")
+
+    if (args.event_ds_start is None) != (args.event_ds_stop is None):
+        raise Exception('Error: pass either both --event-ds-start & --event-ds-stop, or neither!')
+    if args.event_ds_start is not None:
+        validate_date(args.event_ds_start)
+        validate_date(args.event_ds_stop)
+        if args.event_ds_start > args.event_ds_stop:
+            raise Exception('Error: ds_start cannot be later than ds_stop!')
+
+    args.watermark_key = f'rollups/{args.event_schema}/{args.environment}'
+    return args
+
+
+def plan_rollup_run(args, watermark, now):
+
+    """ This function returns the (ts_start, ts_stop, inserted_ts_start, inserted_ts_stop) of a run, in which rollups are
+    recomputed from the events within [ts_start, ts_stop) inserted up to inserted_ts_stop, limited to the hours & sessions
+    which received events inserted after inserted_ts_start (unless None).
+    """
+
+    inserted_ts_stop = now - datetime.timedelta(minutes=args.insert_lag_minutes)
+    if args.event_ds_start is not None:
+        ts_stop = datetime.datetime.strptime(args.event_ds_stop, '%Y-%m-%d') + datetime.timedelta(days=1)
+        return f'{args.event_ds_start} 00:00:00', ts_stop.strftime(timestamp_format), None, inserted_ts_stop.strftime(timestamp_format)
+
+    since = datetime.datetime.strptime(watermark, timestamp_format) if watermark else inserted_ts_stop
+    ts_start = (since - datetime.timedelta(hours=args.lateness_hours)).replace(minute=0, second=0, microsecond=0)
+    return ts_start.strftime(timestamp_format), None, watermark, inserted_ts_stop.strftime(timestamp_format)
+
+
+def run(args):
+
+    watermark = read_watermark(args.watermark_file, args.watermark_key)
+    ts_start, ts_stop, inserted_ts_start, inserted_ts_stop = plan_rollup_run(args, watermark, datetime.datetime.utcnow())
+    print(f"Recomputing rollups of events within [{ts_start}, {ts_stop or '..'}) inserted up to {inserted_ts_stop}"
+          f"{f' (touched after {inserted_ts_start})' if inserted_ts_start else ''}..")
+
+    query_list = [generate_rollup_hourly_query(args.gcp, args.environment, args.event_schema, ts_start, ts_stop, inserted_ts_stop, inserted_ts_start)]
+    if args.event_schema == 'improbable':
+        query_list.append(generate_rollup_sessions_query(args.gcp, args.environment, ts_start, ts_stop, inserted_ts_stop, inserted_ts_start, args.session_hours))
+    if args.dry_run:
+        for query in query_list:
+            print(query)
+        return None
+
+    from google.cloud import bigquery
+
+    client_bq = bigquery.Client.from_service_account_json(os.environ['GOOGLE_APPLICATION_CREDENTIALS'], location=args.location)
+    bigquery_asset_list = get_rollup_asset_list(args.environment, args.event_schema)
+    try:
+        source_bigquery_assets(client_bq, bigquery_asset_list)
+    except Exception:
+        generate_bigquery_assets(client_bq, bigquery_asset_list)
+
+    for query in query_list:
+        job = client_bq.query(query)
+        job.result()
+        print(f'{job.num_dml_affected_rows} rows recomputed, {job.total_bytes_processed or 0:,} bytes processed.')
+
+    # Recomputing a range does not advance the watermark, as events outside of it inserted since are still to be picked up:
+    if args.event_ds_start is None:
+        write_watermark(args.watermark_file, args.watermark_key, inserted_ts_stop)
+    return inserted_ts_stop
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    watermark = run(args)
+    if watermark:
+        print(f'Rollups are up to date with events inserted up to {watermark}.')
@@ -0,0 +1,98 @@
+# Python 3.7.1
+
+# python p5_bq_external_query.py \
+#   --gcp={{your_google_project_id}} \
+#   --environment={{your_environment}} \
+#   --location=EU \
+#   --bucket-name={{your_google_project_id}}-analytics-{{your_environment}} \
+#   --data-type=jsonl \
+#   --event-schema=improbable \
+#   --event-environment=release \
+#   --event-ds-start=2019-01-01 \
+#   --event-ds-stop=2019-01-01 \
+#   --event-time=08-16 \
+#   --condition="JSON_EXTRACT_SCALAR(line, '$.eventType') = 'crash'" \
+#   --output=crashes.jsonl
+
+# Queries the raw objects of the bucket in place, without ingesting them first: the hive-partitioned external tables over
+# the data_type= prefixes (see common.bigquery.generate_external_table_ddl()) are provisioned whenever they do not exist yet,
+# after which the lines of the objects within the requested partitions are written into --output as JSON lines. Only the
+# prefixes of these partitions are read, so investigating a few hours of raw events does not require a backfill.
+
+# Pass `--event-schema={{event_schema}}-raw` to read the events the endpoint could not format, or `--data-type=unknown` to
+# read the payloads which could not be parsed as JSON.
+
+from common.bigquery import external_table_dict, generate_external_bigquery_assets, generate_external_query
+from common.functions import parse_none_or_string, safe_convert_list_to_sql_tuple, parse_argument, validate_date
+
+import argparse
+import json
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--environment', required=True)
+parser.add_argument('--location', required=True)  # {EU|US}
+parser.add_argument('--gcp', required=True)
+parser.add_argument('--bucket-name', dest='bucket_name', required=True)
+parser.add_argument('--data-type', dest='data_type', default='jsonl', choices=sorted(external_table_dict))
+parser.add_argument('--event-schema', dest='event_schema', required=True)  # {improbable|playfab}[-raw]
+parser.add_argument('--event-environment', dest='event_environment', required=True)
+parser.add_argument('--event-category', dest='event_category', type=parse_none_or_string, default='all')
+parser.add_argument('--event-ds-start', dest='event_ds_start', required=True)
+parser.add_argument('--event-ds-stop', dest='event_ds_stop', required=True)
+parser.add_argument('--event-time', dest='event_time', type=parse_none_or_string, default='all')  # {00-08|08-16|16-24}
+parser.add_argument('--condition', default='')  # A SQL condition on `line` or `gspath`.
+parser.add_argument('--output', default='external-query.jsonl')
+parser.add_argument('--dry-run', dest='dry_run', action='store_true')  # Only print the SQL statements.
+
+
+def parse_arguments(argv=None):
+
+    """ This function parses & validates the arguments of the query (sys.argv unless argv is passed).
+    """
+
+    args = parser.parse_args(argv)
+
+    validate_date(args.event_ds_start)
+    validate_date(args.event_ds_stop)
+    if args.event_ds_start > args.event_ds_stop:
+        raise Exception('Error: ds_start cannot be later than ds_stop!')
+
+    args.time_part_list, args.time_part_name = parse_argument(args.event_time, ['00-08', '08-16', '16-24'], 'time-parts')
+    args.category_list, args.category_name = parse_argument(args.event_category, ['external', 'native'], 'categories')
+    return args
+
+
+def run(args):
+
+    query = generate_external_query(
+        args.gcp,
+        args.environment,
+        args.data_type,
+        args.event_schema,
+        args.event_environment,
+        (safe_convert_list_to_sql_tuple(args.category_list), args.category_name),
+        args.event_ds_start,
+        args.event_ds_stop,
+        (safe_convert_list_to_sql_tuple(args.time_part_list), args.time_part_name),
+        args.condition)
+    if args.dry_run:
+        print(query)
+        return 0
+
+    from google.cloud import bigquery
+
+    client_bq = bigquery.Client.from_service_account_json(os.environ['GOOGLE_APPLICATION_CREDENTIALS'], location=args.location)
+    generate_external_bigquery_assets(client_bq, args.gcp, args.environment, args.bucket_name, [args.data_type])
+
+    job, rows = client_bq.query(query), 0
+    with open(args.output, 'w') as f:
+        for row in job.result():
+            f.write(json.dumps(dict(row.items()), default=str) + '\n')
+            rows += 1
+    print(f'Wrote {rows:,} lines into {args.output}, {job.total_bytes_processed or 0:,} bytes processed.')
+    return rows
+
+
+if __name__ == '__main__':
+    run(parse_arguments())
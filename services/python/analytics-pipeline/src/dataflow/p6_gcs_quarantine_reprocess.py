@@ -0,0 +1,229 @@
+# Python 3.7.1
+
+# python p6_gcs_quarantine_reprocess.py \
+#   --gcp={{your_google_project_id}} \
+#   --gcp-region=europe-west1 \
+#   --environment={{your_environment}} \
+#   --location=EU \
+#   --bucket-name={{your_google_project_id}}-analytics-{{your_environment}} \
+#   --event-schema=improbable \
+#   --event-environment=release \
+#   --event-ds-start=2019-01-01 \
+#   --event-ds-stop=2019-01-31
+
+# The endpoint quarantines events it could not format into `event_schema={{event_schema}}-raw` objects, and request bodies
+# it could not parse into `data_type=unknown` objects (see common/quarantine.py). This pipeline lists the quarantined objects
+# of --event-schema within the requested partitions, applies the endpoint's current formatter & the usual mapping to their
+# events in parallel, and loads the events which can now be ingested into native BigQuery storage. Their batch ids are the
+# MD5 hexdigests of the quarantined objects, which are recorded in the ingestion manifest like any other ingested file.
+
+# What still fails is reported per object in logs.quarantine_reprocess_{{your_environment}}, with a sample of it. Objects
+# already in the manifest are skipped; pass --retry-malformed to reprocess those of which some events still failed before,
+# in which case only their events which were not recovered before are loaded (their event ids are the same on every run).
+
+# Malformed lines in logs.native_events_debug_{{your_environment}} are not a source: they belong to event batch files the
+# functions already recorded in the manifest under their own batch id, whose event ids the recovered events would share.
+
+from __future__ import absolute_import
+import apache_beam as beam
+
+from apache_beam.options.pipeline_options import PipelineOptions
+from apache_beam.options.pipeline_options import SetupOptions
+
+from common.bigquery import source_bigquery_assets, generate_bigquery_assets, generate_quarantine_manifest_query, generate_quarantine_loaded_events_query
+from common.functions import parse_none_or_string, generate_gcs_file_list, safe_convert_list_to_sql_tuple, parse_argument
+from common.ingest import get_bigquery_asset_list
+from common.classes import GetGcsFileList, ReprocessQuarantinedFile, BuildBatchIdSet
+from common.quarantine import get_event_digest
+from common.gcs import generate_gcs_prefix_shards, prune_gcs_prefix_list
+from common.metrics import Metrics, collect_beam_metrics
+from apache_beam.io.gcp import gcsio
+
+import argparse
+import time
+import os
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--execution-environment', dest='execution_environment', default='DataflowRunner')
+parser.add_argument('--setup-file', dest='setup_file', default='src/setup.py')
+parser.add_argument('--gcp-region', dest='gcp_region', required=True)
+parser.add_argument('--environment', required=True)
+parser.add_argument('--location', required=True)  # {EU|US}
+parser.add_argument('--gcp', required=True)
+parser.add_argument('--bucket-name', dest='bucket_name', required=True)
+parser.add_argument('--event-schema', dest='event_schema', required=True)  # {improbable|playfab}
+parser.add_argument('--event-environment', dest='event_environment', required=True)
+parser.add_argument('--event-category', dest='event_category', type=parse_none_or_string, default='all')
+parser.add_argument('--event-ds-start', dest='event_ds_start', required=True)
+parser.add_argument('--event-ds-stop', dest='event_ds_stop', required=True)
+parser.add_argument('--event-time', dest='event_time', type=parse_none_or_string, default='all')  # {00-08|08-16|16-24}
+parser.add_argument('--sources', default='raw,unknown')  # Comma-separated, {raw|unknown}
+parser.add_argument('--retry-malformed', dest='retry_malformed', action='store_true')
+parser.add_argument('--metrics-file', dest='metrics_file', type=parse_none_or_string, default=None)
+
+report_schema = 'job_name:STRING,processed_timestamp:TIMESTAMP,batch_id:STRING,event_schema:STRING,event_environment:STRING,event_category:STRING,' \
+                'event_ds:DATE,event_time:STRING,gspath:STRING,status:STRING,source:STRING,recovered_events:INTEGER,failed_events:INTEGER,failure_sample:STRING'
+
+
+def parse_arguments(argv=None):
+
+    """ This function parses & validates the arguments of the reprocessing (sys.argv unless argv is passed).
+    """
+
+    args = parser.parse_args(argv)
+
+    supported_schemas = ['improbable', 'playfab']
+    if args.event_schema not in supported_schemas:
+        raise Exception(f"""Unknown schema passed {args.event_schema}. Currently only {f"`{'` and `'.join(supported_schemas)}`"} are supported.""")
+    if args.event_ds_start > args.event_ds_stop:
+        raise Exception('Error: ds_start cannot be later than ds_stop!')
+
+    args.source_list = args.sources.split(',')
+    if not set(args.source_list) <= {'raw', 'unknown'}:
+        raise Exception('Error: --sources must be a comma-separated list of {raw|unknown}!')
+
+    args.time_part_list, args.time_part_name = parse_argument(args.event_time, ['00-08', '08-16', '16-24'], 'time-parts')
+    args.category_list, args.category_name = parse_argument(args.event_category, ['external', 'native'], 'categories')
+    return args
+
+
+def generate_quarantine_prefix_list(args):
+
+    """ This function generates the gspath prefixes of the quarantined objects within the requested partitions.
+    """
+
+    for source in args.source_list:
+        data_type, event_schema = ('jsonl', f'{args.event_schema}-raw') if source == 'raw' else ('unknown', args.event_schema)
+        for gspath_prefix in generate_gcs_file_list(args.bucket_name, event_schema, args.event_environment, args.category_list,
+                                                    args.event_ds_start, args.event_ds_stop, args.time_part_list, data_type=data_type):
+            yield gspath_prefix
+
+
+def write_bigquery_table(project, dataset, table, **kwargs):
+
+    """ This function returns the PTransform the reprocessing loads rows into a BigQuery table with.
+    """
+
+    return beam.io.WriteToBigQuery(
+        table=table,
+        dataset=dataset,
+        project=project,
+        method='FILE_LOADS',
+        write_disposition=beam.io.gcp.bigquery.BigQueryDisposition.WRITE_APPEND,
+        **kwargs)
+
+
+def build_pipeline(p6, args, job_name, gcs_prefix_list, read_reprocessed_files, write_table=write_bigquery_table, gcsio_factory=None, read_loaded_events=None):
+
+    """ This function adds the reprocessing steps to pipeline p6: the objects below gcs_prefix_list are listed, those
+    read by the read_reprocessed_files PTransform (as {'gspath': ..} dictionaries) are subtracted from them, and the
+    remainder is reprocessed & written with write_table (see write_bigquery_table()). Whenever the read_loaded_events
+    PTransform is passed, the events it reads (as {'batch_id': .., 'event_id': ..} dictionaries) are not written again.
+    It returns the main PCollections by name, so their element counts can be measured.
+    """
+
+    fileListGcs = (p6 | 'CreateGcsIterators' >> beam.Create(gcs_prefix_list)
+                   | 'ShardGcsPrefixes' >> beam.FlatMap(generate_gcs_prefix_shards)
+                   | 'ReshuffleGcsPrefixes' >> beam.Reshuffle()
+                   | 'GetGcsFileList' >> beam.ParDo(GetGcsFileList(gcsio_factory=gcsio_factory)))
+
+    fileListBq = (p6 | 'ParseBqFileList' >> read_reprocessed_files)
+
+    reprocessList = ({'fileListGcs': fileListGcs | 'GcsListPairWithOne' >> beam.Map(lambda x: (x, 1)),
+                      'fileListBq': fileListBq | 'BqListPairWithOne' >> beam.Map(lambda x: (x['gspath'], 1))}
+                     | 'CoGroupByKey' >> beam.CoGroupByKey()
+                     | 'UnionMinusIntersect' >> beam.Filter(lambda x: (len(x[1]['fileListGcs']) == 1 and len(x[1]['fileListBq']) == 0))
+                     | 'ExtractKeysReprocessList' >> beam.Map(lambda x: x[0])
+                     # Quarantined objects vary wildly in size, so spread them over workers evenly:
+                     | 'ReshuffleReprocessList' >> beam.Reshuffle())
+
+    side_inputs = []
+    if read_loaded_events is not None:
+        # The events recovered before are broadcast as an exact set of their digests:
+        loadedEventSet = (p6 | 'ReadLoadedEvents' >> read_loaded_events
+                          | 'ExtractEventDigests' >> beam.Map(lambda x: get_event_digest(x['batch_id'], x['event_id']))
+                          | 'BuildLoadedEventSet' >> beam.CombineGlobally(BuildBatchIdSet()))
+        side_inputs.append(beam.pvalue.AsSingleton(loadedEventSet))
+
+    reprocessedList = (reprocessList | 'ReprocessQuarantinedFile' >> beam.ParDo(ReprocessQuarantinedFile(
+        args.event_schema, args.environment, job_name, gcsio_factory=gcsio_factory), *side_inputs).with_outputs('logs', 'manifest', 'report', main='rows'))
+
+    pcollections = {'gcs_files': fileListGcs, 'reprocessed_files': fileListBq, 'reprocess_list': reprocessList}
+    for name, pcollection, dataset, table in [
+            ('Native', reprocessedList.rows, 'native', f'events_{args.event_schema}_{args.environment}'),
+            ('Logs', reprocessedList.logs, 'logs', f'native_events_{args.environment}'),
+            ('Manifest', reprocessedList.manifest, 'logs', f'ingestion_manifest_{args.environment}')]:
+        pcollection | f'Write{name}Events' >> write_table(args.gcp, dataset, table, create_disposition=beam.io.gcp.bigquery.BigQueryDisposition.CREATE_NEVER)
+        pcollections[f'{name.lower()}_rows'] = pcollection
+
+    reprocessedList.report | 'WriteReport' >> write_table(
+        args.gcp, 'logs', f'quarantine_reprocess_{args.environment}',
+        create_disposition=beam.io.gcp.bigquery.BigQueryDisposition.CREATE_IF_NEEDED, schema=report_schema)
+    pcollections['report_rows'] = reprocessedList.report
+
+    return pcollections
+
+
+def run(args):
+
+    from google.cloud import bigquery
+
+    client_bq = bigquery.Client.from_service_account_json(os.environ['GOOGLE_APPLICATION_CREDENTIALS'], location=args.location)
+    bigquery_asset_list = get_bigquery_asset_list(args.environment, args.event_schema)
+    try:
+        source_bigquery_assets(client_bq, bigquery_asset_list)
+    except Exception:
+        generate_bigquery_assets(client_bq, bigquery_asset_list)
+
+    po, event_category = PipelineOptions(), args.event_category.replace('_', '-')
+    job_name = f'p6-gcs-quarantine-reprocess-{args.event_schema}-{event_category}-{args.event_ds_start}-to-{args.event_ds_stop}-{args.time_part_name}-{int(time.time())}'
+    # https://cloud.google.com/dataflow/docs/guides/specifying-exec-params
+    pipeline_options = po.from_dictionary({
+        'project': args.gcp,
+        'staging_location': f'gs://{args.bucket_name}/data_type=dataflow/batch/staging/{job_name}/',
+        'temp_location': f'gs://{args.bucket_name}/data_type=dataflow/batch/temp/{job_name}/',
+        'runner': args.execution_environment,  # {DirectRunner, DataflowRunner}
+        'setup_file': args.setup_file,
+        'service_account_email': f'dataflow-batch-{args.environment}@{args.gcp}.iam.gserviceaccount.com',
+        'job_name': job_name,
+        'region': args.gcp_region
+        })
+    pipeline_options.view_as(SetupOptions).save_main_session = True
+
+    p6 = beam.Pipeline(options=pipeline_options)
+    # Only list the prefixes whose partitions exist:
+    gcs_prefix_list = prune_gcs_prefix_list(gcsio.GcsIO().client, generate_quarantine_prefix_list(args))
+
+    query_args = (
+        args.gcp, args.environment, args.event_schema, args.event_environment,
+        (safe_convert_list_to_sql_tuple(args.category_list), args.category_name), args.event_ds_start, args.event_ds_stop,
+        (safe_convert_list_to_sql_tuple(args.time_part_list), args.time_part_name))
+    status_tuple = ('ingested',) if args.retry_malformed else ('ingested', 'malformed')
+    build_pipeline(p6, args, job_name, gcs_prefix_list, beam.io.Read(beam.io.BigQuerySource(
+        # "What was reprocessed before?"
+        query=generate_quarantine_manifest_query(*query_args, safe_convert_list_to_sql_tuple(list(status_tuple))),
+        use_standard_sql=True)),
+        # "Which of their events were recovered before?"
+        read_loaded_events=beam.io.Read(beam.io.BigQuerySource(query=generate_quarantine_loaded_events_query(*query_args), use_standard_sql=True)) if args.retry_malformed else None)
+
+    result = p6.run()
+    result.wait_until_finish()
+
+    # Export the metrics reported by our steps (see common/classes.py):
+    metrics = collect_beam_metrics(result, Metrics(namespace='analytics_quarantine'))
+    if args.metrics_file:
+        with open(args.metrics_file, 'w') as metrics_file:
+            metrics_file.write(metrics.render_prometheus())
+    else:
+        print(metrics.render_prometheus())
+
+    print(f"Recovered {metrics.total('events_recovered'):,} events, {metrics.total('events_failed'):,} still fail "
+          f"(in {metrics.total('files_failed'):,} objects, see logs.quarantine_reprocess_{args.environment}).")
+    return job_name
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    job_name = run(args)
+    print(f'Quarantine reprocessing job finished: {job_name}')
@@ -73,6 +73,7 @@ setuptools.setup(
     description='DataFlow Python Pipeline',
     install_requires=REQUIRED_PACKAGES,
     packages=setuptools.find_packages(),
+    package_data={'common': ['promoted_attributes.json']},
     cmdclass={
         'build': build,
         'CustomCommands': CustomCommands,
@@ -16,8 +16,15 @@ class CloudStorageURLSigner(object):
         self.client_id_email = client_id_email
         self.gcs_api_endpoint = 'https://storage.googleapis.com'
 
-        self.expiration = expiration or (datetime.datetime.now() + datetime.timedelta(minutes=30))
-        self.expiration = int(time.mktime(self.expiration.timetuple()))
+        self.expiration = expiration
+
+    def get_expiration(self):
+
+        """ Returns the unixtime signed URLs expire at: 30 minutes after they were signed, unless an expiration was passed.
+        """
+
+        expiration = self.expiration or (datetime.datetime.now() + datetime.timedelta(minutes=30))
+        return int(time.mktime(expiration.timetuple()))
 
     def base64_sign(self, plaintext):
 
@@ -29,28 +36,33 @@ class CloudStorageURLSigner(object):
         signature_bytes = signer.sign(shahash)
         return base64.b64encode(signature_bytes)
 
-    def make_signature_string(self, verb, path, content_md5, content_type):
+    def make_signature_string(self, verb, path, content_md5, content_type, expiration, extension_headers=None):
 
-        """ Creates the signature string for signing according to GCS docs.
+        """ Creates the signature string for signing according to GCS docs, in which
+        the canonical extension headers (x-goog-*) precede the resource.
         """
 
         signature_string = ('{verb}\n'
                             '{content_md5}\n'
                             '{content_type}\n'
                             '{expiration}\n'
+                            '{extension_headers}'
                             '{resource}')
-        return signature_string.format(verb=verb, content_md5=content_md5,
-          content_type=content_type, expiration=self.expiration, resource=path)
+        extension_headers = ''.join(f'{key.lower()}:{value}\n' for key, value in sorted((extension_headers or {}).items()))
+        return signature_string.format(verb=verb, content_md5=content_md5, content_type=content_type,
+          expiration=expiration, extension_headers=extension_headers, resource=path)
 
-    def make_url(self, verb, path, content_type='', content_md5=''):
+    def make_url(self, verb, path, content_type='', content_md5='', extension_headers=None):
 
         """ Forms and returns the full signed URL to access GCS.
         """
 
         base_url = '%s%s' % (self.gcs_api_endpoint, path)
-        signature_string = self.make_signature_string(verb=verb, path=path, content_md5=content_md5, content_type=content_type)
+        expiration = self.get_expiration()
+        signature_string = self.make_signature_string(verb=verb, path=path, content_md5=content_md5, content_type=content_type,
+                                                      expiration=expiration, extension_headers=extension_headers)
         signature_signed = self.base64_sign(signature_string)
-        query_params = {'GoogleAccessId': self.client_id_email, 'Expires': str(self.expiration), 'Signature': signature_signed}
+        query_params = {'GoogleAccessId': self.client_id_email, 'Expires': str(expiration), 'Signature': signature_signed}
         return base_url, query_params
 
     def put(self, path, content_type, md5_digest):
@@ -58,3 +70,24 @@ class CloudStorageURLSigner(object):
         headers = {'Content-Type': content_type, 'Content-MD5': md5_digest}
         request = requests.Request('PUT', base_url, params=query_params).prepare()
         return {'signed_url': request.url, 'headers': headers, 'md5_digest': md5_digest, 'statusCode': 200}
+
+    def resumable(self, path, content_type):
+
+        """ Returns a signed URL which starts a resumable upload session when POST'ed to with the returned
+        headers. The session URI is returned in the Location header of the response, to which chunks are PUT.
+        """
+
+        headers = {'Content-Type': content_type, 'x-goog-resumable': 'start'}
+        base_url, query_params = self.make_url(verb='POST', path=path, content_type=content_type, extension_headers={'x-goog-resumable': 'start'})
+        request = requests.Request('POST', base_url, params=query_params).prepare()
+        return {'signed_url': request.url, 'method': 'POST', 'headers': headers}
+
+    def put_part(self, path):
+
+        """ Returns a signed URL to PUT a part of a parallel upload to, whose MD5 digest is not known upfront.
+        """
+
+        content_type = 'application/octet-stream'
+        base_url, query_params = self.make_url(verb='PUT', path=path, content_type=content_type)
+        request = requests.Request('PUT', base_url, params=query_params).prepare()
+        return {'signed_url': request.url, 'method': 'PUT', 'headers': {'Content-Type': content_type}}
@@ -3,12 +3,16 @@ import json
 import time
 
 
-def try_format_improbable_event(index, event, batch_id, analytics_environment):
+def try_format_improbable_event(index, event, batch_id, analytics_environment, attributes_encoding='string'):
 
     """ This function tries to augment an event with several attributes, and casts
     eventAttributes as a string whenever it is a list or a dictionary. This enables
     it to be written into BigQuery as-is, and to be subsequently parsed with BigQuery JSON functions.
 
+    Whenever attributes_encoding is `nested`, eventAttributes are kept as a nested JSON document instead,
+    so they are only encoded once within the event (rather than escaped a second time as a string). The
+    ingestion serializes them into a string when writing them into BigQuery (see dataflow/common/ingest.py).
+
     It returns a list which contains as its first element a boolean indicating whether
     the operation succeeded, and either the formatted event if the first element is true,
     or the original event if false.
@@ -22,18 +26,19 @@ def try_format_improbable_event(index, event, batch_id, analytics_environment):
         new_event['analyticsEnvironment'] = analytics_environment
         try:
             if isinstance(event['eventAttributes'], (dict, list)):
-                new_event['eventAttributes'] = json.dumps(event['eventAttributes'])
+                if attributes_encoding != 'nested':
+                    new_event['eventAttributes'] = json.dumps(event['eventAttributes'])
             else:
                 new_event['eventAttributes'] = str(event['eventAttributes'])
         except KeyError:
-            new_event['eventAttributes'] = '{}'
+            new_event['eventAttributes'] = {} if attributes_encoding == 'nested' else '{}'
         return (True, new_event)
 
     except Exception:
         return (False, event)
 
 
-def try_format_playfab_event(index, event, batch_id, analytics_environment):
+def try_format_playfab_event(index, event, batch_id, analytics_environment, attributes_encoding='string'):
 
     """ Whenever URL paramter `&event_category=` is set to `playfab` when POST'ing events
     to our Cloud Endpoint, this event formatting function is used instead, which better
@@ -45,11 +50,15 @@ def try_format_playfab_event(index, event, batch_id, analytics_environment):
 
     Tip - You must set the `event_category` URL parameter to `playfab` for this to work properly!
 
+    All non-PlayFab keys are gathered into EventAttributes, which is kept as a nested JSON document
+    rather than a string whenever attributes_encoding is `nested` (see try_format_improbable_event()).
+
     Also see: https://api.playfab.com/docs/tutorials/landing-analytics/webhooks
     """
 
+    # SamplingRate & SamplingRule are added by the endpoint to events it sampled (see common/sampling.py):
     playfab_keys = ['TitleId', 'Timestamp', 'SourceType', 'Source', 'PlayFabEnvironment',
-                    'EventNamespace', 'EventName', 'EventId', 'EntityType', 'EntityId']
+                    'EventNamespace', 'EventName', 'EventId', 'EntityType', 'EntityId', 'SamplingRate', 'SamplingRule']
 
     try:
         new_event, new_event_attributes = dict(), dict()
@@ -64,7 +73,7 @@ def try_format_playfab_event(index, event, batch_id, analytics_environment):
         new_event['BatchId'] = batch_id
         new_event['ReceivedTimestamp'] = time.time()
         new_event['AnalyticsEnvironment'] = analytics_environment
-        new_event['EventAttributes'] = json.dumps(new_event_attributes)
+        new_event['EventAttributes'] = new_event_attributes if attributes_encoding == 'nested' else json.dumps(new_event_attributes)
         return (True, new_event)
 
     except Exception:
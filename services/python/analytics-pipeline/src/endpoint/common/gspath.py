@@ -0,0 +1 @@
+../../dataflow/common/gspath.py
\ No newline at end of file
@@ -0,0 +1,140 @@
+import fnmatch
+import hashlib
+import json
+import time
+import os
+
+# Events are matched against the rules of a JSON file (see EVENT_SAMPLING_RULES_FILE in ../main.py) in order, of which
+# the first matching rule decides whether an event is kept, dropped or sampled. Events matching no rule are kept:
+#
+# {
+#   "rules": [
+#     {"name": "drop-debug", "match": {"event_environment": "debug"}, "action": "drop"},
+#     {"name": "sample-ticks", "match": {"event_class": "telemetry", "event_type": ["tick", "frame_*"]}, "action": "sample", "rate": 0.05}
+#   ]
+# }
+#
+# Rules match on any of the keys below, whose values are (lists of) shell-style patterns. Sampling is deterministic per
+# session, so either all or none of the events of a session matching a rule are kept, and sessions kept at a rate are kept at
+# any higher rate as well. Sampled events which are kept record the rate & rule they were sampled at, so counts can be scaled up.
+sampling_match_keys = ['event_schema', 'event_category', 'event_environment', 'event_class', 'event_type']
+
+# {event_schema: (key of the event class, key of the event type, keys identifying the session, (keys of the sampling metadata))}
+sampling_event_keys = {
+    'improbable': ('eventClass', 'eventType', ['sessionId'], ('samplingRate', 'samplingRule')),
+    # PlayFab events do not belong to sessions, so they are sampled per entity (e.g. player) instead:
+    'playfab': ('EventNamespace', 'EventName', ['EntityId'], ('SamplingRate', 'SamplingRule'))
+}
+sampling_event_keys_default = ('eventClass', 'eventType', ['sessionId'], ('samplingRate', 'samplingRule'))
+
+
+def get_session_fraction(session_id):
+
+    """ This function maps a session id onto [0, 1) uniformly, which is compared with sampling rates.
+    """
+
+    return int(hashlib.md5(str(session_id).encode('utf-8')).hexdigest()[:13], 16) / 16 ** 13
+
+
+def compile_sampling_rules(rules):
+
+    """ This function validates the rules of a sampling rules file, returning them as a list of
+    (name, {match key: [pattern, ..]}, action, rate) tuples.
+    """
+
+    compiled_rules = []
+    for index, rule in enumerate(rules):
+        name, action = rule.get('name', f'rule-{index}'), rule.get('action', 'keep')
+        if action not in ['keep', 'drop', 'sample']:
+            raise ValueError(f'Rule {name} has an unknown action: {action}')
+        unknown_keys = set(rule.get('match', {})) - set(sampling_match_keys)
+        if unknown_keys:
+            raise ValueError(f"Rule {name} matches on unknown keys: {', '.join(sorted(unknown_keys))}")
+        rate = float(rule.get('rate', 1.0)) if action == 'sample' else None
+        if rate is not None and not 0.0 <= rate <= 1.0:
+            raise ValueError(f'Rule {name} has a rate outside of [0, 1]: {rate}')
+        match = {key: [str(pattern) for pattern in (value if isinstance(value, list) else [value])] for key, value in rule.get('match', {}).items()}
+        compiled_rules.append((name, match, action, rate))
+    return compiled_rules
+
+
+class EventSampler(object):
+
+    """ Decides which events the endpoint keeps, according to the sampling rules in the JSON file at path. The file is
+    checked for changes at most every check_interval seconds & reloaded whenever it changed, so rules can be updated
+    without restarting the endpoint. A file which cannot be loaded leaves the previous rules in place.
+    """
+
+    def __init__(self, path, check_interval=10.0, cache_size=10000):
+        self.path = path
+        self.check_interval = check_interval
+        self.cache_size = cache_size
+        self.rules, self.cache = [], dict()
+        self.mtime, self.checked = None, 0.0
+        self.reload()
+
+    def reload(self):
+        self.checked = time.time()
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path) as f:
+                rules = compile_sampling_rules(json.load(f).get('rules', []))
+        except FileNotFoundError:
+            # No (longer any) rules, e.g. as their optional ConfigMap does not exist:
+            if self.mtime is not None:
+                print(f'Removed the sampling rules, as {self.path} no longer exists.')
+            self.rules, self.cache, self.mtime = [], dict(), None
+            return
+        except Exception as e:
+            print(f'Could not load the sampling rules in {self.path}, keeping {len(self.rules)} rules: {e}')
+            return
+        # Replace both at once, as requests may be sampled concurrently:
+        self.rules, self.cache, self.mtime = rules, dict(), mtime
+        print(f'Loaded {len(rules)} sampling rules from {self.path}.')
+
+    def match(self, attributes):
+
+        """ This function returns the first rule matching a tuple of the values of sampling_match_keys, or None.
+        Matches are cached per tuple, as a few event types make up most events.
+        """
+
+        rules, cache = self.rules, self.cache
+        if attributes in cache:
+            return cache[attributes]
+        match = None
+        for rule in rules:
+            if all(any(fnmatch.fnmatchcase(str(value), pattern) for pattern in rule[1][key])
+                   for key, value in zip(sampling_match_keys, attributes) if key in rule[1]):
+                match = rule
+                break
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[attributes] = match
+        return match
+
+    def keep(self, event, event_schema, event_category, event_environment, session_id):
+
+        """ This function returns whether to keep an event, whose schema, category & environment are those of its batch.
+        Events which are sampled & kept have the rate & rule they were sampled at added. Session ids are taken from the
+        event whenever present, otherwise session_id is used.
+        """
+
+        if time.time() - self.checked > self.check_interval:
+            self.reload()
+        if not self.rules or not isinstance(event, dict):
+            return True
+
+        class_key, type_key, session_keys, (rate_key, rule_key) = sampling_event_keys.get(event_schema, sampling_event_keys_default)
+        rule = self.match((event_schema, event_category, event_environment, event.get(class_key, None), event.get(type_key, None)))
+        if rule is None or rule[2] == 'keep':
+            return True
+        if rule[2] == 'drop':
+            return False
+
+        session_id = next((event[key] for key in session_keys if event.get(key, None)), session_id)
+        if get_session_fraction(session_id) >= rule[3]:
+            return False
+        event[rate_key], event[rule_key] = rule[3], rule[0]
+        return True
@@ -0,0 +1,111 @@
+import math
+import re
+
+# Large files can be uploaded in chunks rather than with a single PUT request (see `v1/file` in ../main.py):
+#
+# - `resumable`: the client starts a resumable upload session by POST'ing to the signed URL, and PUTs the file to the
+#   session URI it receives (in its Location header) in chunks of chunk_size bytes. Whenever the connection drops, the
+#   client asks the session which bytes it persisted (a PUT with `Content-Range: bytes */{content_length}`) & resumes there.
+# - `parallel`: the client PUTs the parts of the file to their own signed URLs concurrently, each of which can be retried
+#   on its own, after which `v1/file/compose` composes the parts into the file server-side.
+#
+# Parts are uploaded into a bucket of their own (ANALYTICS_FILE_PART_BUCKET_NAME), of which the endpoint may read & delete
+# objects without being able to do so in the analytics bucket, & whose lifecycle rule removes the parts of abandoned uploads
+# (see ../../../../terraform/module-analytics/gcs.tf). Composed files are copied into the analytics bucket.
+#
+# Chunks of resumable uploads must be multiples of 256 KiB, which parts are aligned to as well.
+upload_chunk_alignment = 256 * 1024
+upload_chunk_size_default = 8 * 1024 * 1024
+upload_chunk_size_max = 256 * 1024 * 1024
+upload_part_count_max = 1024
+upload_parallelism_default = 4
+upload_parallelism_max = 32
+# The maximum number of objects a single compose request accepts:
+compose_source_max = 32
+
+file_object_location_regex = re.compile(r'^data_type=file/file_category=[^/]+/file_ds=[^/]+/file_time=[^/]+/[^/]+/[^/]+-[A-Z0-9]{6}$')
+
+
+def align_chunk_size(chunk_size):
+
+    """ This function rounds a chunk size up to a multiple of upload_chunk_alignment, within [alignment, upload_chunk_size_max].
+    """
+
+    chunk_size = min(max(int(chunk_size), 1), upload_chunk_size_max)
+    return int(math.ceil(chunk_size / upload_chunk_alignment)) * upload_chunk_alignment
+
+
+def negotiate_resumable_upload(chunk_size=None):
+
+    """ This function returns the chunk size of a resumable upload, given the one the client asked for (if any).
+    """
+
+    return align_chunk_size(chunk_size or upload_chunk_size_default)
+
+
+def negotiate_parallel_upload(content_length, chunk_size=None, parallelism=None):
+
+    """ This function splits a file of content_length bytes into parts, given the part size & parallelism the client asked
+    for (if any). Parts are made larger than requested whenever the file would otherwise consist of more than
+    upload_part_count_max parts. It returns the negotiated (part_size, parallelism, [(offset, length), ..]).
+    """
+
+    content_length = int(content_length)
+    if content_length <= 0:
+        raise ValueError('Parallel uploads require a positive content_length.')
+    part_size = align_chunk_size(max(chunk_size or upload_chunk_size_default, content_length / upload_part_count_max))
+    if part_size * upload_part_count_max < content_length:
+        raise ValueError(f'Files of {content_length} bytes exceed the maximum size of parallel uploads.')
+    part_list = [(offset, min(part_size, content_length - offset)) for offset in range(0, content_length, part_size)]
+    parallelism = min(max(int(parallelism or upload_parallelism_default), 1), upload_parallelism_max, len(part_list))
+    return part_size, parallelism, part_list
+
+
+def get_file_part_prefix(object_location):
+
+    """ This function returns the prefix of the parts of a parallel upload, which are kept apart from the files themselves.
+    """
+
+    return f"{object_location.replace('data_type=file/', 'data_type=file_part/', 1)}/"
+
+
+def get_file_part_location(object_location, index):
+    return f'{get_file_part_prefix(object_location)}part-{index:05d}'
+
+
+def compose_file_parts(part_bucket, bucket, object_location, part_count, content_type):
+
+    """ This function composes the parts of a parallel upload in part_bucket into object_location in bucket, returning the
+    composed blob. As a single compose request accepts at most compose_source_max objects, larger uploads are composed in
+    rounds of intermediate objects. Objects can only be composed within a bucket, so whenever part_bucket is not bucket, the
+    file is composed next to its parts & then copied (server-side) into bucket. All parts & intermediate objects are deleted
+    afterwards. Parts which do not exist raise google.api_core.exceptions.NotFound.
+    """
+
+    source_list = [part_bucket.blob(get_file_part_location(object_location, index)) for index in range(part_count)]
+    temporary_list, level = list(source_list), 0
+    while len(source_list) > compose_source_max:
+        intermediate_list = []
+        for index in range(0, len(source_list), compose_source_max):
+            intermediate = part_bucket.blob(get_file_part_location(object_location, index // compose_source_max) + f'-compose-{level}')
+            intermediate.content_type = content_type
+            intermediate.compose(source_list[index:index + compose_source_max])
+            intermediate_list.append(intermediate)
+        source_list, level = intermediate_list, level + 1
+        temporary_list.extend(intermediate_list)
+
+    blob = bucket.blob(object_location)
+    blob.content_type = content_type
+    if part_bucket.name == bucket.name:
+        blob.compose(source_list)
+    else:
+        composed = part_bucket.blob(f'{get_file_part_prefix(object_location)}composed')
+        composed.content_type = content_type
+        composed.compose(source_list)
+        temporary_list.append(composed)
+        # Large objects may take several rewrite requests, each of which returns the token to continue with:
+        token, _, _ = blob.rewrite(composed)
+        while token is not None:
+            token, _, _ = blob.rewrite(composed, token=token)
+    part_bucket.delete_blobs(temporary_list, on_error=lambda blob: None)
+    return blob
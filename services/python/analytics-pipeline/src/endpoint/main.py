@@ -3,7 +3,6 @@
 import Crypto.PublicKey.RSA as RSA
 import subprocess
 import logging
-import hashlib
 import string
 import json
 import gzip
@@ -12,6 +11,10 @@ import os
 from common.functions import get_date_time, try_format_improbable_event, try_format_playfab_event, \
     try_format_unknown_event
 from common.classes import CloudStorageURLSigner
+from common.gspath import encode_object_location, get_batch_id
+from common.sampling import EventSampler
+from common.uploads import negotiate_resumable_upload, negotiate_parallel_upload, get_file_part_prefix, get_file_part_location, \
+    compose_file_parts, file_object_location_regex, upload_part_count_max
 from flask import Flask, jsonify, request
 from six.moves import http_client
 from google.cloud import storage
@@ -21,12 +24,25 @@ from random import choices
 client_storage = storage.Client.from_service_account_json(os.environ['GOOGLE_SECRET_KEY_JSON_ANALYTICS_GCS_WRITER'])
 bucket = client_storage.get_bucket(os.environ['ANALYTICS_BUCKET_NAME'])
 
+# Provision the GCS Bucket the parts of parallel uploads are written into (see common/uploads.py), without which they are
+# rejected, as the endpoint may neither read nor delete the objects of the analytics bucket. The endpoint may manage the
+# objects of this bucket, but not the bucket itself, so its metadata is not fetched:
+part_bucket_name = os.environ.get('ANALYTICS_FILE_PART_BUCKET_NAME')
+part_bucket = client_storage.bucket(part_bucket_name) if part_bucket_name else None
+
 # Provision URL Signer for `v1/file`:
 with open(os.environ['GOOGLE_SECRET_KEY_DER_ANALYTICS_GCS_WRITER'], 'rb') as f:
     key_der = f.read()
 private_key = RSA.importKey(key_der)
 signer = CloudStorageURLSigner(private_key, os.environ['GOOGLE_SERVICE_ACCOUNT_EMAIL_ANALYTICS_GCS_WRITER'])
 
+# Either `string` (default) or `nested`, which stores eventAttributes within events without encoding them as a string first:
+event_attributes_encoding = os.environ.get('EVENT_ATTRIBUTES_ENCODING', 'string')
+
+# Optional, a JSON file of rules to drop or sample events with before they are stored (see common/sampling.py), which is
+# reloaded whenever it changes (e.g. when its ConfigMap is updated):
+event_sampler = EventSampler(os.environ['EVENT_SAMPLING_RULES_FILE']) if os.environ.get('EVENT_SAMPLING_RULES_FILE') else None
+
 app = Flask(__name__)
 
 
@@ -47,10 +63,10 @@ def store_event_in_gcs(bucket=bucket, bucket_name=os.environ['ANALYTICS_BUCKET_N
             payload = request.get_json(force=True)
 
             object_location, object_location_raw = [
-                f'data_type=jsonl/event_schema={_event_schema}/event_category={event_category}/event_environment={event_environment}/event_ds={event_ds}/event_time={event_time}/{session_id}/{ts_fmt}-{random}'
+                encode_object_location('jsonl', _event_schema, event_category, event_environment, event_ds, event_time, f'{session_id}/{ts_fmt}-{random}')
                 for _event_schema in [event_schema, f'{event_schema}-raw']]
             gspath_json = f'gs://{bucket_name}/{object_location}.jsonl'
-            batch_id_json = hashlib.md5(gspath_json.encode('utf-8')).hexdigest()
+            batch_id_json = get_batch_id(gspath_json)
             events_formatted, events_raw = [], []
 
             # If dict nest in list:
@@ -61,10 +77,14 @@ def store_event_in_gcs(bucket=bucket, bucket_name=os.environ['ANALYTICS_BUCKET_N
             if isinstance(payload, list):
                 for index, event in enumerate(payload):
 
+                    # Dropped events are not stored at all, though the event ids of the others stay their index within the payload:
+                    if event_sampler and not event_sampler.keep(event, event_schema, event_category, event_environment, session_id):
+                        continue
+
                     if event_schema == 'improbable':
-                        success, tried_event = try_format_improbable_event(index, event, batch_id_json, os.environ['ANALYTICS_ENVIRONMENT'])
+                        success, tried_event = try_format_improbable_event(index, event, batch_id_json, os.environ['ANALYTICS_ENVIRONMENT'], event_attributes_encoding)
                     elif event_schema == 'playfab':
-                        success, tried_event = try_format_playfab_event(index, event, batch_id_json, os.environ['ANALYTICS_ENVIRONMENT'])
+                        success, tried_event = try_format_playfab_event(index, event, batch_id_json, os.environ['ANALYTICS_ENVIRONMENT'], event_attributes_encoding)
                     else:
                         success, tried_event = try_format_unknown_event(index, event, batch_id_json, os.environ['ANALYTICS_ENVIRONMENT'])
 
@@ -89,7 +109,7 @@ def store_event_in_gcs(bucket=bucket, bucket_name=os.environ['ANALYTICS_BUCKET_N
 
         except Exception:
             payload = request.get_data(as_text=True)
-            object_location_unknown = f'data_type=unknown/event_schema={event_schema}/event_category={event_category}/event_environment={event_environment}/event_ds={event_ds}/event_time={event_time}/{session_id}/{ts_fmt}-{random}'
+            object_location_unknown = encode_object_location('unknown', event_schema, event_category, event_environment, event_ds, event_time, f'{session_id}/{ts_fmt}-{random}')
             blob = bucket.blob(object_location_unknown)
             blob.upload_from_string(payload, content_type='text/plain; charset=utf-8')
 
@@ -115,13 +135,58 @@ def return_signed_url_gcs():
         object_location = f'data_type=file/file_category={file_category}/file_ds={file_ds}/file_time={file_time}/{file_parent}/{file_child}-{random}'
         bucket_name = os.environ['ANALYTICS_BUCKET_NAME']
         file_path = f'/{bucket_name}/{object_location}'
-        signed = signer.put(path=file_path, content_type=payload['content_type'], md5_digest=payload['md5_digest'])
+
+        # Either `single` (default), `resumable` or `parallel` (see common/uploads.py):
+        upload_type = payload.get('upload_type', 'single')
+        if upload_type == 'resumable':
+            signed = signer.resumable(path=file_path, content_type=payload['content_type'])
+            signed.update({'upload_type': upload_type, 'object_location': object_location,
+                           'chunk_size': negotiate_resumable_upload(payload.get('chunk_size')), 'statusCode': 200})
+        elif upload_type == 'parallel':
+            if part_bucket is None:
+                return jsonify({'message': 'Parallel uploads are not enabled.', 'statusCode': 400})
+            part_size, parallelism, part_list = negotiate_parallel_upload(payload['content_length'], payload.get('chunk_size'), payload.get('parallelism'))
+            part_signed_list = []
+            for index, (offset, length) in enumerate(part_list):
+                part_signed = signer.put_part(path=f'/{part_bucket_name}/{get_file_part_location(object_location, index)}')
+                part_signed.update({'index': index, 'offset': offset, 'length': length})
+                part_signed_list.append(part_signed)
+            # Once all parts are uploaded, the client POSTs upload_id & part_count to `v1/file/compose`:
+            signed = {'upload_type': upload_type, 'upload_id': object_location, 'object_location': object_location, 'part_size': part_size,
+                      'parallelism': parallelism, 'part_count': len(part_list), 'parts': part_signed_list, 'statusCode': 200}
+        else:
+            signed = signer.put(path=file_path, content_type=payload['content_type'], md5_digest=payload['md5_digest'])
         return jsonify(signed)
 
     except Exception as e:
         return jsonify({'message': f'Exception: {type(e).__name__}', 'args': e.args})
 
 
+@app.route('/v1/file/compose', methods=['POST'])
+def compose_file_in_gcs(bucket=bucket, part_bucket=part_bucket):
+    try:
+        if part_bucket is None:
+            return jsonify({'message': 'Parallel uploads are not enabled.', 'statusCode': 400})
+        payload = request.get_json(force=True)
+        object_location, part_count = payload['upload_id'], int(payload['part_count'])
+
+        # Only compose the parts of uploads we handed out:
+        if not file_object_location_regex.match(object_location) or not 0 < part_count <= upload_part_count_max:
+            return jsonify({'message': 'Unknown upload_id or invalid part_count.', 'statusCode': 400})
+
+        part_location_set = set(blob.name for blob in part_bucket.list_blobs(prefix=get_file_part_prefix(object_location)))
+        missing_list = [index for index in range(part_count) if get_file_part_location(object_location, index) not in part_location_set]
+        if missing_list:
+            # Nothing is composed, so the client can upload the missing parts & try again:
+            return jsonify({'message': 'Parts are missing.', 'missing_parts': missing_list, 'statusCode': 409})
+
+        blob = compose_file_parts(part_bucket, bucket, object_location, part_count, payload.get('content_type', 'application/octet-stream'))
+        return jsonify({'object_location': object_location, 'crc32c': blob.crc32c, 'size': blob.size, 'statusCode': 200})
+
+    except Exception as e:
+        return jsonify({'message': f'Exception: {type(e).__name__}', 'args': e.args})
+
+
 @app.errorhandler(http_client.INTERNAL_SERVER_ERROR)
 def unexpected_error(e):
     """Handle exceptions by returning swagger-compliant json."""
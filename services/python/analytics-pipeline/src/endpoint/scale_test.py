@@ -13,6 +13,7 @@
 #   --scale-test-name=scale-test \
 
 from multiprocessing.pool import ThreadPool as Pool
+from common.gspath import encode_object_location
 from google.cloud import storage
 from datetime import datetime
 from six.moves import urllib
@@ -106,7 +107,7 @@ def run():
 
     end = datetime.now()
 
-    prefix = f'data_type=jsonl/event_schema={args.event_schema}/event_category={args.event_category}/event_environment={args.event_environment}/event_ds={event_ds}/event_time={event_time}/{scale_test_name}'
+    prefix = encode_object_location('jsonl', args.event_schema, args.event_category, args.event_environment, event_ds, event_time, scale_test_name)
     blobs = list(bucket.list_blobs(prefix=prefix))
 
     verbose(f'Number of threads used: {args.pool_size}')
@@ -1,43 +1,90 @@
 
-from common.functions import get_dict_value, cast_to_unix_timestamp, format_event_list, \
-  gunzip_bytes_obj, generator_split, generator_chunk, generator_load_json
+from common.functions import format_event_list, generator_split, generator_chunk
+from common.gspath import decode_gspath, get_batch_id
+from common.ingest import get_bigquery_asset_list, parse_gcs_notification, download_gcs_file, parse_event_chunk, format_manifest_row
+from common.metrics import Metrics
 from common.bigquery import source_bigquery_assets, generate_bigquery_assets
-from google.cloud import bigquery, storage
+from common.checkpoint import get_checkpoint_store
+from collections import deque
 
 import base64
-import json
-import time
 import os
 
 # Cloud Function acts as the service account named function-gcs-to-bq@[your Google project id].iam.gserviceaccount.com
-client_gcs, client_bq = storage.Client(), bigquery.Client(location=os.environ['LOCATION'])
+# Clients & tables are provisioned on first use and reused by warm instances afterwards, see get_clients():
+client_gcs, client_bq, bigquery_tables = None, None, None
+
+# Number of lines we parse & insert into BigQuery at once, which is also the unit we checkpoint:
+CHUNK_SIZE = 1000
+
+
+def get_clients():
+
+    """ This function returns the GCS & BigQuery clients, constructing them on first use. The
+    google-cloud libraries are only imported at that point, as importing them dominates the
+    cold start of the Cloud Function.
+    """
+
+    global client_gcs, client_bq
+    if client_gcs is None:
+        from google.cloud import storage
+        client_gcs = storage.Client()
+    if client_bq is None:
+        from google.cloud import bigquery
+        client_bq = bigquery.Client(location=os.environ['LOCATION'])
+    return client_gcs, client_bq
+
+
+def get_bigquery_tables(client_bq):
+
+    """ This function sources (or provisions) the required datasets & tables once per instance,
+    so only the first invocation pays for the table lookups.
+    """
+
+    global bigquery_tables
+    if bigquery_tables is None:
+        bigquery_asset_list = get_bigquery_asset_list(os.environ['ENVIRONMENT'], 'improbable')
+        try:
+            bigquery_tables = source_bigquery_assets(client_bq, bigquery_asset_list)
+        except Exception:
+            bigquery_tables = generate_bigquery_assets(client_bq, bigquery_asset_list)
+
+    return bigquery_tables
 
 
 def ingest_into_native_bigquery_storage(data, context):
 
     """ This is the primary function invoked whenever the Cloud Function is triggered.
-    It parses the Pub/Sub notification that triggered it by extracting the location of the
-    file in Google Cloud Storage (GCS). It subsequently downloads the contents of this file
-    from GCS, sanitizes & augments the events within it & finally writes them into native BigQuery storage.
+    It ingests the file the Pub/Sub notification points to (see ingest_file()) & afterwards
+    emits the metrics of the invocation as a single structured log line, regardless of whether it succeeded,
+    followed by a log line of the lag between receiving & inserting the events of the file.
     """
 
-    # Source required datasets & tables:
-    bigquery_asset_list = [
-        # (dataset, table_name, table_schema, table_partition_column)
-        ('logs', f'native_events_{os.environ["ENVIRONMENT"]}', 'logs', 'event_ds'),
-        ('logs', f'native_events_debug_{os.environ["ENVIRONMENT"]}', 'logs', 'event_ds'),
-        ('logs', f'dataflow_backfill_{os.environ["ENVIRONMENT"]}', 'logs', 'event_ds'),
-        ('native', f'events_improbable_{os.environ["ENVIRONMENT"]}', 'improbable', 'event_timestamp')]
-
+    metrics = Metrics()
     try:
-        table_logs, table_debug, _, table_function = source_bigquery_assets(client_bq, bigquery_asset_list)
-    except Exception:
-        table_logs, table_debug, _, table_function = generate_bigquery_assets(client_bq, bigquery_asset_list)
+        return ingest_file(data, metrics)
+    finally:
+        metrics.emit_log()
+        # From which the logs-based distribution of the ingestion lag is derived (see ../../../../terraform/module-analytics/logging.tf):
+        metrics.emit_histogram_log('ingestion_lag_seconds')
+
+
+def ingest_file(data, metrics):
+
+    """ This function parses the Pub/Sub notification that triggered the Cloud Function by extracting
+    the location of the file in Google Cloud Storage (GCS). It subsequently downloads the contents of this file
+    from GCS, sanitizes & augments the events within it & finally writes them into native BigQuery storage.
+    """
+
+    # Source required clients, datasets & tables:
+    client_gcs, client_bq = get_clients()
+    table_logs, table_debug, _, table_function, table_manifest = get_bigquery_tables(client_bq)
 
     # Parse payload:
-    payload = json.loads(base64.b64decode(data['data']).decode('utf-8'))
-    bucket_name, object_location = payload['bucket'], payload['name']
+    bucket_name, object_location = parse_gcs_notification(base64.b64decode(data['data']))
     gspath = f'gs://{bucket_name}/{object_location}'
+    batch_id = get_batch_id(gspath)
+    labels = {'event_schema': 'improbable', 'event_category': decode_gspath(gspath).event_category}
 
     # Write log to events_logs_function:
     malformed, failed_insertion = False, False
@@ -47,60 +94,78 @@ def ingest_into_native_bigquery_storage(data, context):
         failed_insertion = True
 
     # Get file from GCS:
-    bucket = client_gcs.get_bucket(bucket_name)
+    bucket = client_gcs.bucket(bucket_name)
     try:
-        data = bucket.get_blob(object_location).download_as_string().decode('utf8')
-    except UnicodeDecodeError:
-        print('Automatic decompressive transcoding failed, unzipping content..')
-        data = gunzip_bytes_obj(bucket.get_blob(object_location).download_as_string()).decode('utf-8')
+        with metrics.time_phase('download', **labels):
+            data = download_gcs_file(bucket, object_location)
+        metrics.inc('bytes_downloaded', len(data), **labels)
     except Exception:
+        metrics.inc('files_processed', status='failed', **labels)
         raise Exception(f'Could not retrieve file gs://{bucket_name}/{object_location} from GCS!')
 
+    # Source chunks committed by previous deliveries of this file, which we can skip, & whether any of them were malformed:
+    checkpoint_store = get_checkpoint_store(client_gcs)
+    committed_chunks, checkpointed_malformed = checkpoint_store.load(batch_id, CHUNK_SIZE)
+    checkpointed_chunks = set(committed_chunks)
+
     # We use generators in order to save memory usage, allowing the Cloud Function to use the smallest capacity template:
-    for chunk in generator_chunk(generator_split(data, '\n'), 1000):
-        events_batch_function, events_batch_debug = [], []
-        for event_tuple in generator_load_json(chunk):
-            if event_tuple[0]:
-                for event in event_tuple[1]:
-                    d = dict()
-                    # Sanitize:
-                    d['analytics_environment'] = get_dict_value(event, 'analyticsEnvironment', 'analytics_environment')
-                    d['event_environment'] = get_dict_value(event, 'eventEnvironment', 'event_environment')
-                    d['event_source'] = get_dict_value(event, 'eventSource', 'event_source')
-                    d['session_id'] = get_dict_value(event, 'sessionId', 'session_id')
-                    d['version_id'] = get_dict_value(event, 'versionId', 'version_id')
-                    d['batch_id'] = get_dict_value(event, 'batchId', 'batch_id')
-                    d['event_id'] = get_dict_value(event, 'eventId', 'event_id')
-                    d['event_index'] = get_dict_value(event, 'eventIndex', 'event_index')
-                    d['event_class'] = get_dict_value(event, 'eventClass', 'event_class')
-                    d['event_type'] = get_dict_value(event, 'eventType', 'event_type')
-                    d['player_id'] = get_dict_value(event, 'playerId', 'player_id')
-                    d['event_timestamp'] = cast_to_unix_timestamp(get_dict_value(event, 'eventTimestamp', 'event_timestamp'), ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M:%S %Z'])
-                    d['received_timestamp'] = get_dict_value(event, 'receivedTimestamp', 'received_timestamp')  # This value was set by our endpoint, so we already know it is in unixtime
-                    # Augment:
-                    d['inserted_timestamp'] = time.time()
-                    d['job_name'] = os.environ['FUNCTION_NAME']
-                    # Sanitize:
-                    d['event_attributes'] = get_dict_value(event, 'eventAttributes', 'event_attributes')
-                    events_batch_function.append(d)
-            else:
-                events_batch_debug.append(event_tuple[1])
+    for chunk_offset, chunk in enumerate(generator_chunk(generator_split(data, '\n'), CHUNK_SIZE)):
+        if chunk_offset in committed_chunks:
+            # Exhaust the chunk, as it shares its underlying iterator with the next chunk:
+            deque(chunk, maxlen=0)
+            continue
+
+        failed_chunk = False
+        events_batch_function, row_ids_function, events_batch_debug, row_ids_debug = \
+            parse_event_chunk(chunk, 'improbable', os.environ['FUNCTION_NAME'], batch_id, chunk_offset, metrics)
 
         if len(events_batch_function) > 0:
             # Write JSON to events_function:
-            errors = client_bq.insert_rows(table_function, events_batch_function)
+            with metrics.time_phase('insert', **labels):
+                errors = client_bq.insert_rows(table_function, events_batch_function, row_ids=row_ids_function)
             if errors:
                 print(f'Errors while inserting events: {str(errors)}')
-                failed_insertion = True
+                failed_insertion, failed_chunk = True, True
+                metrics.inc('rows_rejected', len(events_batch_function), reason='insert', **labels)
+            else:
+                metrics.inc('rows_inserted', len(events_batch_function), **labels)
+                metrics.observe_lag(events_batch_function, **labels)
 
         if len(events_batch_debug) > 0:
             # Write non-JSON to events_debug_function:
-            errors = client_bq.insert_rows(table_debug, format_event_list(events_batch_debug, str, os.environ['FUNCTION_NAME'], gspath))
+            metrics.inc('rows_rejected', len(events_batch_debug), reason='malformed', **labels)
+            with metrics.time_phase('insert', **labels):
+                errors = client_bq.insert_rows(table_debug, format_event_list(events_batch_debug, str, os.environ['FUNCTION_NAME'], gspath), row_ids=row_ids_debug)
             if errors:
                 print(f'Errors while inserting debug event: {str(errors)}')
-                failed_insertion = True
+                failed_insertion, failed_chunk = True, True
             malformed = True
 
+        if not failed_chunk:
+            committed_chunks.add(chunk_offset)
+            # Only files spanning multiple chunks benefit from checkpointing while we are still iterating:
+            if chunk_offset > 0:
+                checkpoint_store.save(batch_id, CHUNK_SIZE, committed_chunks, gspath, malformed or checkpointed_malformed)
+                checkpointed_chunks, checkpointed_malformed = set(committed_chunks), malformed or checkpointed_malformed
+
+    # Record the file in the ingestion manifest once all of its events are committed, which the backfill diffs against. Its
+    # malformed lines may have been committed by a previous delivery, which only raised on them then:
+    if not failed_insertion:
+        status = 'malformed' if malformed or checkpointed_malformed else 'ingested'
+        errors = client_bq.insert_rows(table_manifest, [format_manifest_row(gspath, status, os.environ['FUNCTION_NAME'])], row_ids=[batch_id])
+        if errors:
+            print(f'Errors while inserting manifest: {str(errors)}')
+            failed_insertion = True
+
+    # A file we are about to raise on will be redelivered, so record its progress. Otherwise clean up:
+    if failed_insertion or malformed:
+        if committed_chunks != checkpointed_chunks or malformed != checkpointed_malformed:
+            checkpoint_store.save(batch_id, CHUNK_SIZE, committed_chunks, gspath, malformed or checkpointed_malformed)
+    elif checkpointed_chunks:
+        checkpoint_store.delete(batch_id)
+
+    metrics.inc('files_processed', status='failed' if failed_insertion else 'malformed' if malformed else 'succeeded', **labels)
+
     # We only `raise` now because further iterations of the execution loop could have still succeeded:
     if failed_insertion and malformed:
         raise Exception(f'Failed to insert records into BigQuery, inspect logs! Non-JSON data present in gs://{bucket_name}/{object_location}')
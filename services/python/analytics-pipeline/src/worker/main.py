@@ -0,0 +1,257 @@
+# Python 3.7.1
+
+# PYTHONPATH=../dataflow python main.py \
+#   --gcp={{your_google_project_id}} \
+#   --subscription=analytics-worker-improbable-schema-subscription-{{your_environment}} \
+#   --event-schema=improbable \
+#   --environment={{your_environment}} \
+#   --location=EU \
+#   --max-messages=100 \
+#   --max-workers=16 \
+#   --metrics-port=9090
+
+# A long-running alternative to the Cloud Functions in ../functions/*/main.py. Instead of handling one
+# GCS notification per invocation, it pulls notifications in batches from a Pub/Sub subscription on the
+# same topic, downloads & parses the files concurrently with shared clients, and merges the rows of all
+# files into full BigQuery insert requests. Notifications are only acknowledged once all rows of their file
+# are committed, failed files are nack'ed & redelivered.
+
+# Note that you must not run this worker next to the Cloud Function of the same schema, as both would ingest
+# every file. Files containing malformed lines are acknowledged after their lines are written to the debug table.
+
+# Its subscriptions & Service Account are provisioned by ../../../../terraform/module-analytics once analytics_worker_enabled
+# is set, and it is deployed with ../../../../k8s/analytics-worker/deployment.yaml (see ../../../../docker/analytics-worker).
+
+# Whenever --metrics-port is set, ingestion metrics (see common/metrics.py) are served on http://0.0.0.0:{port}/metrics.
+
+from common.functions import format_event_list, generator_split, generator_chunk
+from common.gspath import decode_gspath, get_batch_id
+from common.ingest import get_bigquery_asset_list, parse_gcs_notification, download_gcs_file, parse_event_chunk, format_manifest_row
+from common.bigquery import source_bigquery_assets, generate_bigquery_assets
+from common.metrics import Metrics, serve_metrics
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import time
+
+# Number of lines we parse at once, which matches the chunks (and thereby row ids) of the Cloud Functions:
+CHUNK_SIZE = 1000
+
+
+class IngestWorker(object):
+
+    """ Pulls GCS notifications from a Pub/Sub subscription & ingests the files they point to into
+    native BigQuery storage. All clients are passed in, so the worker can be run against the local
+    stand-ins in common/fakes.py.
+
+    Flow control is configured with:
+    - max_messages: the number of notifications (files) pulled & processed per cycle;
+    - max_workers: the number of files downloaded & parsed concurrently, and of concurrent insert requests;
+    - max_rows_per_insert & max_bytes_per_insert: the size of the merged BigQuery insert requests;
+    - ack_deadline_seconds: the lease extended on pulled notifications while their cycle is in progress.
+
+    Ingestion metrics are recorded into metrics, a common.metrics.Metrics instance.
+    """
+
+    def __init__(self, client_subscriber, client_gcs, client_bq, subscription_path, event_schema, environment, job_name,
+                 max_messages=100, max_workers=16, max_rows_per_insert=5000, max_bytes_per_insert=8 * 1024 * 1024, ack_deadline_seconds=600, metrics=None):
+
+        self.client_subscriber = client_subscriber
+        self.client_gcs = client_gcs
+        self.client_bq = client_bq
+        self.subscription_path = subscription_path
+        self.event_schema = event_schema
+        self.job_name = job_name
+        self.max_messages = max_messages
+        self.max_rows_per_insert = max_rows_per_insert
+        self.max_bytes_per_insert = max_bytes_per_insert
+        self.ack_deadline_seconds = ack_deadline_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.metrics = metrics or Metrics()
+
+        bigquery_asset_list = get_bigquery_asset_list(environment, event_schema)
+        try:
+            self.table_logs, self.table_debug, _, self.table_native, self.table_manifest = source_bigquery_assets(client_bq, bigquery_asset_list)
+        except Exception:
+            self.table_logs, self.table_debug, _, self.table_native, self.table_manifest = generate_bigquery_assets(client_bq, bigquery_asset_list)
+
+    def process_file(self, received_message):
+
+        """ Downloads & parses the file a notification points to. Returns a dictionary with its
+        rows & the approximate size of each row, or the exception that occurred.
+        """
+
+        try:
+            bucket_name, object_location = parse_gcs_notification(received_message.message.data)
+            gspath = f'gs://{bucket_name}/{object_location}'
+            batch_id = get_batch_id(gspath)
+            labels = {'event_schema': self.event_schema, 'event_category': decode_gspath(gspath).event_category}
+            with self.metrics.time_phase('download', **labels):
+                data = download_gcs_file(self.client_gcs.bucket(bucket_name), object_location)
+            self.metrics.inc('bytes_downloaded', len(data), **labels)
+
+            rows, row_ids, malformed_lines, malformed_row_ids = [], [], [], []
+            for chunk_offset, chunk in enumerate(generator_chunk(generator_split(data, '\n'), CHUNK_SIZE)):
+                chunk_rows, chunk_row_ids, chunk_malformed_lines, chunk_malformed_row_ids = \
+                    parse_event_chunk(chunk, self.event_schema, self.job_name, batch_id, chunk_offset, self.metrics)
+                rows.extend(chunk_rows)
+                row_ids.extend(chunk_row_ids)
+                malformed_lines.extend(chunk_malformed_lines)
+                malformed_row_ids.extend(chunk_malformed_row_ids)
+
+            return {'ack_id': received_message.ack_id, 'gspath': gspath, 'error': None, 'labels': labels,
+                    'rows': rows, 'row_ids': row_ids, 'row_bytes': len(data) // max(len(rows) + len(malformed_lines), 1),
+                    'debug_rows': format_event_list(malformed_lines, str, self.job_name, gspath), 'debug_row_ids': malformed_row_ids}
+
+        except Exception as e:
+            return {'ack_id': received_message.ack_id, 'gspath': None, 'error': e}
+
+    def merge_insert_requests(self, files, rows_key, row_ids_key, row_bytes_key=None):
+
+        """ Merges the rows of several files into insert requests of at most max_rows_per_insert rows &
+        max_bytes_per_insert (approximate) bytes. Returns a list of (rows, row_ids, indices of their files).
+        """
+
+        requests, rows, row_ids, file_indices, request_bytes = [], [], [], set(), 0
+        for file_index, f in enumerate(files):
+            row_bytes = f[row_bytes_key] if row_bytes_key else 512
+            for row, row_id in zip(f[rows_key], f[row_ids_key]):
+                if rows and (len(rows) >= self.max_rows_per_insert or request_bytes + row_bytes > self.max_bytes_per_insert):
+                    requests.append((rows, row_ids, file_indices))
+                    rows, row_ids, file_indices, request_bytes = [], [], set(), 0
+                rows.append(row)
+                row_ids.append(row_id)
+                file_indices.add(file_index)
+                request_bytes += row_bytes
+        if rows:
+            requests.append((rows, row_ids, file_indices))
+        return requests
+
+    def insert_rows(self, table, rows, row_ids):
+        try:
+            with self.metrics.time_phase('insert', event_schema=self.event_schema):
+                errors = self.client_bq.insert_rows(table, rows, row_ids=row_ids)
+        except Exception as e:
+            errors = [str(e)]
+        if errors:
+            print(f'Errors while inserting into {table}: {str(errors)[:1000]}')
+        return not errors
+
+    def run_once(self):
+
+        """ Pulls a batch of notifications, ingests their files & acknowledges the notifications of
+        all files that were fully committed. Returns a dictionary of statistics about the cycle.
+        """
+
+        response = self.client_subscriber.pull(self.subscription_path, max_messages=self.max_messages, return_immediately=True)
+        received_messages = list(response.received_messages)
+        if not received_messages:
+            return {'files': 0, 'rows': 0, 'acked': 0, 'nacked': 0, 'insert_requests': 0}
+
+        # Extend the lease on all notifications pulled, as the whole batch is acknowledged together:
+        ack_ids = [received_message.ack_id for received_message in received_messages]
+        self.client_subscriber.modify_ack_deadline(self.subscription_path, ack_ids, self.ack_deadline_seconds)
+
+        results = list(self.executor.map(self.process_file, received_messages))
+        failed_ack_ids = set(result['ack_id'] for result in results if result['error'] is not None)
+        for result in results:
+            if result['error'] is not None:
+                print(f"Could not process notification {result['ack_id']}: {result['error']}")
+        files = [result for result in results if result['error'] is None]
+
+        # A single request logs all files as initiated:
+        logs = [log for f in files for log in format_event_list(['parse_initiated'], str, self.job_name, f['gspath'])]
+        requests = [(self.table_logs, logs, [None] * len(logs), set(range(len(files))))] if logs else []
+        requests += [(self.table_native,) + request for request in self.merge_insert_requests(files, 'rows', 'row_ids', 'row_bytes')]
+        requests += [(self.table_debug,) + request for request in self.merge_insert_requests(files, 'debug_rows', 'debug_row_ids')]
+
+        futures = [(self.executor.submit(self.insert_rows, table, rows, row_ids if any(row_ids) else None), file_indices)
+                   for table, rows, row_ids, file_indices in requests]
+        for future, file_indices in futures:
+            if not future.result():
+                failed_ack_ids.update(files[file_index]['ack_id'] for file_index in file_indices)
+
+        # Record the files whose events were all committed in the ingestion manifest, which the backfill diffs against:
+        committed_files = [f for f in files if f['ack_id'] not in failed_ack_ids]
+        if committed_files:
+            manifest_rows = [format_manifest_row(f['gspath'], 'malformed' if f['debug_rows'] else 'ingested', self.job_name) for f in committed_files]
+            if not self.insert_rows(self.table_manifest, manifest_rows, [row['batch_id'] for row in manifest_rows]):
+                failed_ack_ids.update(f['ack_id'] for f in committed_files)
+
+        acked_ids = [ack_id for ack_id in ack_ids if ack_id not in failed_ack_ids]
+        if acked_ids:
+            self.client_subscriber.acknowledge(self.subscription_path, acked_ids)
+        if failed_ack_ids:
+            # Nack, so the notifications are redelivered. Deterministic row ids deduplicate rows that did succeed:
+            self.client_subscriber.modify_ack_deadline(self.subscription_path, list(failed_ack_ids), 0)
+
+        self.metrics.inc('files_processed', len(received_messages) - len(files), status='failed', event_schema=self.event_schema)
+        for f in files:
+            failed = f['ack_id'] in failed_ack_ids
+            self.metrics.inc('files_processed', status='failed' if failed else 'malformed' if f['debug_rows'] else 'succeeded', **f['labels'])
+            self.metrics.inc('rows_rejected', len(f['debug_rows']), reason='malformed', **f['labels'])
+            if failed:
+                self.metrics.inc('rows_rejected', len(f['rows']), reason='insert', **f['labels'])
+            else:
+                self.metrics.inc('rows_inserted', len(f['rows']), **f['labels'])
+                self.metrics.observe_lag(f['rows'], **f['labels'])
+
+        return {'files': len(received_messages), 'rows': sum(len(f['rows']) for f in files), 'acked': len(acked_ids),
+                'nacked': len(failed_ack_ids), 'insert_requests': len(requests)}
+
+    def run(self, idle_sleep=1.0, max_cycles=None):
+
+        """ Runs cycles until max_cycles is reached (or forever if None), sleeping for idle_sleep
+        seconds whenever there were no notifications to pull.
+        """
+
+        cycles = 0
+        while max_cycles is None or cycles < max_cycles:
+            stats = self.run_once()
+            cycles += 1
+            if stats['files'] == 0:
+                time.sleep(idle_sleep)
+            else:
+                print(f'Cycle {cycles}: {stats}')
+
+
+if __name__ == '__main__':
+
+    from google.cloud import bigquery, pubsub_v1, storage
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gcp', required=True)
+    parser.add_argument('--subscription', required=True)
+    parser.add_argument('--event-schema', dest='event_schema', required=True)  # {improbable|playfab}
+    parser.add_argument('--environment', required=True)
+    parser.add_argument('--location', required=True)  # {EU|US}
+    parser.add_argument('--job-name', dest='job_name', default=None)
+    parser.add_argument('--max-messages', dest='max_messages', type=int, default=100)
+    parser.add_argument('--max-workers', dest='max_workers', type=int, default=16)
+    parser.add_argument('--max-rows-per-insert', dest='max_rows_per_insert', type=int, default=5000)
+    parser.add_argument('--max-bytes-per-insert', dest='max_bytes_per_insert', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--ack-deadline-seconds', dest='ack_deadline_seconds', type=int, default=600)
+    parser.add_argument('--idle-sleep', dest='idle_sleep', type=float, default=1.0)
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=None)
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    if args.metrics_port:
+        serve_metrics(metrics, args.metrics_port)
+
+    client_subscriber = pubsub_v1.SubscriberClient()
+    worker = IngestWorker(
+        client_subscriber=client_subscriber,
+        client_gcs=storage.Client(),
+        client_bq=bigquery.Client(location=args.location),
+        subscription_path=client_subscriber.subscription_path(args.gcp, args.subscription),
+        event_schema=args.event_schema,
+        environment=args.environment,
+        job_name=args.job_name or f'worker-{args.event_schema}-{args.environment}',
+        max_messages=args.max_messages,
+        max_workers=args.max_workers,
+        max_rows_per_insert=args.max_rows_per_insert,
+        max_bytes_per_insert=args.max_bytes_per_insert,
+        ack_deadline_seconds=args.ack_deadline_seconds,
+        metrics=metrics)
+    worker.run(idle_sleep=args.idle_sleep)
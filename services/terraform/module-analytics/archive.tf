@@ -33,6 +33,31 @@ data "archive_file" "cloud_function_improbable_schema" {
     content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/functions.py")}"
     filename = "common/functions.py"
   }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/gspath.py")}"
+    filename = "common/gspath.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/checkpoint.py")}"
+    filename = "common/checkpoint.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/ingest.py")}"
+    filename = "common/ingest.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/promoted_attributes.json")}"
+    filename = "common/promoted_attributes.json"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/metrics.py")}"
+    filename = "common/metrics.py"
+  }
 }
 
 data "archive_file" "cloud_function_playfab_schema" {
@@ -68,4 +93,29 @@ data "archive_file" "cloud_function_playfab_schema" {
     content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/functions.py")}"
     filename = "common/functions.py"
   }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/gspath.py")}"
+    filename = "common/gspath.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/checkpoint.py")}"
+    filename = "common/checkpoint.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/ingest.py")}"
+    filename = "common/ingest.py"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/promoted_attributes.json")}"
+    filename = "common/promoted_attributes.json"
+  }
+
+  source {
+    content  = "${file("${path.module}/../../python/analytics-pipeline/src/dataflow/common/metrics.py")}"
+    filename = "common/metrics.py"
+  }
 }
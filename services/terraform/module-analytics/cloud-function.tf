@@ -49,8 +49,9 @@ resource "google_cloudfunctions_function" "function_improbable_schema" {
   }
 
   environment_variables = {
-    LOCATION    = var.cloud_storage_location
-    ENVIRONMENT = var.environment
+    LOCATION               = var.cloud_storage_location
+    ENVIRONMENT            = var.environment
+    CHECKPOINT_BUCKET_NAME = google_storage_bucket.checkpoint_bucket.name
   }
 }
 
@@ -73,7 +74,8 @@ resource "google_cloudfunctions_function" "function_playfab_schema" {
   }
 
   environment_variables = {
-    LOCATION    = var.cloud_storage_location
-    ENVIRONMENT = var.environment
+    LOCATION               = var.cloud_storage_location
+    ENVIRONMENT            = var.environment
+    CHECKPOINT_BUCKET_NAME = google_storage_bucket.checkpoint_bucket.name
   }
 }
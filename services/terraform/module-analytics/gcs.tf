@@ -1,4 +1,4 @@
-# This file creates two GCS buckets.
+# This file creates four GCS buckets.
 
 resource "google_storage_bucket" "analytics_bucket" {
   name          = "${var.gcloud_project}-analytics-${var.environment}"
@@ -6,6 +6,43 @@ resource "google_storage_bucket" "analytics_bucket" {
   storage_class = "MULTI_REGIONAL"
 }
 
+# The parts of parallel file uploads (see `v1/file` of the endpoint), which are composed into files in the analytics bucket.
+# Parts of uploads which were never composed are removed after a day, as are leftovers of compositions which failed.
+resource "google_storage_bucket" "file_part_bucket" {
+  name          = "${var.gcloud_project}-analytics-file-parts-${var.environment}"
+  location      = var.cloud_storage_location
+  storage_class = "MULTI_REGIONAL"
+  force_destroy = true
+
+  lifecycle_rule {
+    action {
+      type = "Delete"
+    }
+    condition {
+      age = 1
+    }
+  }
+}
+
+# The chunk checkpoints of the Cloud Functions (see common/checkpoint.py), which are kept in a bucket of their own so the Service
+# Account of the functions cannot delete or overwrite the objects of the analytics bucket. A checkpoint only matters while its
+# file may still be redelivered, which Pub/Sub stops doing after 7 days.
+resource "google_storage_bucket" "checkpoint_bucket" {
+  name          = "${var.gcloud_project}-analytics-checkpoints-${var.environment}"
+  location      = var.cloud_storage_location
+  storage_class = "MULTI_REGIONAL"
+  force_destroy = true
+
+  lifecycle_rule {
+    action {
+      type = "Delete"
+    }
+    condition {
+      age = 7
+    }
+  }
+}
+
 resource "google_storage_bucket" "functions_bucket" {
   name          = "${var.gcloud_project}-cloud-functions-${var.environment}"
   location      = var.cloud_storage_location
@@ -7,3 +7,41 @@ resource "google_logging_project_exclusion" "exclude_gcs_bucket_info" {
   # Exclude all INFO severity messages relating to gcs_buckets
   filter      = "resource.type = gcs_bucket AND resource.labels.bucket_name=\"${var.gcloud_project}-analytics-${var.environment}\" AND severity = INFO"
 }
+
+# The Cloud Functions log the lag between the endpoint receiving & the function inserting the events of every file they
+# ingest as a structured log line (see emit_histogram_log() in ../../python/analytics-pipeline/src/dataflow/common/metrics.py),
+# from which this metric derives the distribution of the lag per schema & category. Its buckets match lag_buckets in there.
+resource "google_logging_metric" "ingestion_lag" {
+  name        = "analytics-ingestion-lag-${var.environment}"
+  description = "The lag between the endpoint receiving & the Cloud Functions inserting events, per file ingested."
+  filter      = "resource.type = cloud_function AND textPayload:\"analytics_ingest_ingestion_lag_seconds\""
+
+  metric_descriptor {
+    metric_kind  = "DELTA"
+    value_type   = "DISTRIBUTION"
+    unit         = "s"
+    display_name = "Analytics Ingestion Lag ${var.environment}"
+    labels {
+      key         = "event_schema"
+      value_type  = "STRING"
+      description = "The schema of the events, e.g. improbable or playfab."
+    }
+    labels {
+      key         = "event_category"
+      value_type  = "STRING"
+      description = "The category of the events, e.g. native or external."
+    }
+  }
+
+  value_extractor = "REGEXP_EXTRACT(textPayload, \"ingestion_lag_seconds.: ([[:digit:].eE+-]+)\")"
+  label_extractors = {
+    "event_schema"   = "REGEXP_EXTRACT(textPayload, \"event_schema.: .([[:alnum:]_.-]+)\")"
+    "event_category" = "REGEXP_EXTRACT(textPayload, \"event_category.: .([[:alnum:]_.-]+)\")"
+  }
+
+  bucket_options {
+    explicit_buckets {
+      bounds = [1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400]
+    }
+  }
+}
@@ -59,3 +59,21 @@ resource "google_storage_notification" "notifications_playfab_schema" {
   # Only trigger a message to Pub/Sub for files hitting this prefix:
   object_name_prefix = "data_type=jsonl/event_schema=playfab/event_category=native/"
 }
+
+# Create the pull subscriptions of the Pub/Sub worker, on the same topics the Cloud Functions are triggered by. Notifications
+# are leased for at most the 10 minutes Pub/Sub allows, which the worker extends while their files are in progress.
+resource "google_pubsub_subscription" "analytics_worker_improbable_schema" {
+  count                      = var.analytics_worker_enabled ? 1 : 0
+  name                       = "analytics-worker-improbable-schema-subscription-${var.environment}"
+  topic                      = google_pubsub_topic.cloud_function_improbable_schema.name
+  ack_deadline_seconds       = 600
+  message_retention_duration = "604800s"
+}
+
+resource "google_pubsub_subscription" "analytics_worker_playfab_schema" {
+  count                      = var.analytics_worker_enabled ? 1 : 0
+  name                       = "analytics-worker-playfab-schema-subscription-${var.environment}"
+  topic                      = google_pubsub_topic.cloud_function_playfab_schema.name
+  ack_deadline_seconds       = 600
+  message_retention_duration = "604800s"
+}
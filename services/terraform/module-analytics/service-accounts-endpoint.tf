@@ -26,6 +26,21 @@ resource "google_storage_bucket_iam_member" "analytics_gcs_writer_binding" {
   member = "serviceAccount:${google_service_account.analytics_gcs_writer_sa.email}"
 }
 
+# Grant the Service Account rights to compose & delete the parts of parallel uploads, which are written into a bucket of their
+# own so the Service Account cannot read or delete the objects of our analytics bucket. Composed files are copied into the
+# analytics bucket, which the objectCreator role above suffices for.
+resource "google_storage_bucket_iam_member" "analytics_gcs_writer_file_part_binding" {
+
+  # Ensures the file_part_bucket is created before this operation is attempted.
+  depends_on = [
+    google_storage_bucket.file_part_bucket
+  ]
+
+  bucket = "${var.gcloud_project}-analytics-file-parts-${var.environment}"
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${google_service_account.analytics_gcs_writer_sa.email}"
+}
+
 # Create a JSON key file for the Service Account.
 resource "google_service_account_key" "analytics_gcs_writer_key_json" {
   service_account_id = google_service_account.analytics_gcs_writer_sa.name
@@ -43,6 +43,20 @@ resource "google_storage_bucket_iam_member" "analytics_function_to_bq_binding" {
   member = "serviceAccount:${google_service_account.cloud_function_gcs_to_bq.email}"
 }
 
+# Grant the Service Account rights to write & delete chunk checkpoints, which are written into a bucket of their own so the
+# Service Account can only read the objects of our analytics bucket.
+resource "google_storage_bucket_iam_member" "analytics_function_checkpoint_binding" {
+
+  # Ensures the checkpoint_bucket is created before this operation is attempted.
+  depends_on = [
+    google_storage_bucket.checkpoint_bucket
+  ]
+
+  bucket = "${var.gcloud_project}-analytics-checkpoints-${var.environment}"
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${google_service_account.cloud_function_gcs_to_bq.email}"
+}
+
 # Add the roles/cloudfunctions.developer role.
 resource "google_project_iam_member" "cf_dev_role" {
   role   = "roles/cloudfunctions.developer"
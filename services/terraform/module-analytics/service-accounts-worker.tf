@@ -0,0 +1,59 @@
+# This file creates the Service Account we use for our Pub/Sub worker. It also creates
+# its key & mounts it into our Kubernetes cluster.
+
+# Provision Service Account.
+resource "google_service_account" "analytics_worker_sa" {
+  account_id   = "analytics-worker-${var.environment}"
+  display_name = "Analytics Pub/Sub Worker ${var.environment}"
+}
+
+# Grant the Service Account rights to pull & acknowledge the notifications of its subscriptions.
+resource "google_pubsub_subscription_iam_member" "analytics_worker_improbable_schema_binding" {
+  count        = var.analytics_worker_enabled ? 1 : 0
+  subscription = google_pubsub_subscription.analytics_worker_improbable_schema[0].name
+  role         = "roles/pubsub.subscriber"
+  member       = "serviceAccount:${google_service_account.analytics_worker_sa.email}"
+}
+
+resource "google_pubsub_subscription_iam_member" "analytics_worker_playfab_schema_binding" {
+  count        = var.analytics_worker_enabled ? 1 : 0
+  subscription = google_pubsub_subscription.analytics_worker_playfab_schema[0].name
+  role         = "roles/pubsub.subscriber"
+  member       = "serviceAccount:${google_service_account.analytics_worker_sa.email}"
+}
+
+# Add the roles/bigquery.dataEditor role, which allows it to provision its tables & insert rows into them.
+resource "google_project_iam_member" "analytics_worker_bq_role" {
+  role   = "roles/bigquery.dataEditor"
+  member = "serviceAccount:${google_service_account.analytics_worker_sa.email}"
+}
+
+# Grant the Service Account read rights to our specific GCS bucket.
+resource "google_storage_bucket_iam_member" "analytics_worker_binding" {
+
+  # Ensures the analytics_bucket is created before this operation is attempted.
+  depends_on = [
+    google_storage_bucket.analytics_bucket
+  ]
+  count  = length(var.bucket_read_roles)
+
+  bucket = "${var.gcloud_project}-analytics-${var.environment}"
+  role   = var.bucket_read_roles[count.index]
+  member = "serviceAccount:${google_service_account.analytics_worker_sa.email}"
+}
+
+# Create a JSON key file for the Service Account.
+resource "google_service_account_key" "analytics_worker_key_json" {
+  service_account_id = google_service_account.analytics_worker_sa.name
+  private_key_type   = "TYPE_GOOGLE_CREDENTIALS_FILE" # {TYPE_PKCS12_FILE, TYPE_GOOGLE_CREDENTIALS_FILE}
+}
+
+# Create a Kubernetes JSON secret.
+resource "kubernetes_secret" "analytics_worker_key_json_k8s" {
+  metadata {
+    name = "analytics-worker-json-${var.environment}"
+  }
+  data = {
+    "analytics-worker.json" = base64decode(google_service_account_key.analytics_worker_key_json.private_key)
+  }
+}
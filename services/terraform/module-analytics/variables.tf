@@ -6,3 +6,9 @@ variable "gcloud_project" {}
 variable "gcloud_region" {}
 variable "k8s_cluster_name" {}
 variable "environment" {}
+
+# Whether the Pub/Sub pull worker (see ../../python/analytics-pipeline/src/worker/main.py) ingests events instead of the Cloud
+# Functions. Its subscriptions only exist while it is enabled, as they would otherwise keep every notification for a week.
+variable "analytics_worker_enabled" {
+  default = false
+}